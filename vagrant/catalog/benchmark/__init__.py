@@ -0,0 +1,3 @@
+# Load benchmark for gamerater: fills a scratch database with a synthetic
+# catalog and measures every route. Run `python -m benchmark --help` from
+# the catalog folder.
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+#
+# Benchmarks gamerater against a synthetic catalog in a scratch database,
+# and writes the results as JSON so runs can be diffed between versions.
+#
+# Usage (from the catalog folder):
+#   python -m benchmark [--users 1000] [--games 500] [--ratings 20000]
+#                       [--requests 200] [--concurrency 4] [--seed 0]
+#                       [--routes home game ...] [--output benchmark.json]
+#
+import argparse
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+
+
+def format_number(value, number_format):
+    """
+    Returns value formatted with number_format, or "n/a" if it is None.
+
+    >>> format_number(None, '%.2f')
+    'n/a'
+    """
+    if value is None:
+        return 'n/a'
+    return number_format % value
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmark',
+        description="Benchmark gamerater's routes on a synthetic catalog.")
+    parser.add_argument('--users', type=int, default=1000,
+                        help="users to generate (default: %(default)s)")
+    parser.add_argument('--games', type=int, default=500,
+                        help="games to generate (default: %(default)s)")
+    parser.add_argument('--ratings', type=int, default=20000,
+                        help="ratings to generate (default: %(default)s)")
+    parser.add_argument('--requests', type=int, default=200,
+                        help="requests per route (default: %(default)s)")
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help="threads sending requests (default: "
+                             "%(default)s)")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="seed for the catalog and requests (default: "
+                             "%(default)s)")
+    parser.add_argument('--routes', nargs='+',
+                        help="names of the routes to run (default: all)")
+    parser.add_argument('--output', default='benchmark.json',
+                        help="file to write the results to (default: "
+                             "%(default)s)")
+    args = parser.parse_args()
+
+    # Point gamerater at a scratch database before it is imported
+    directory = tempfile.mkdtemp()
+    database_url = 'sqlite:///%s' % os.path.join(directory, 'benchmark.db')
+    os.environ['GAMERATER_DATABASE_URL'] = database_url
+    try:
+        import database_setup
+        import migrations
+        from benchmark import load, synthetic
+
+        migrations.upgrade(database_setup.engine)
+        start = time.time()
+        catalog = synthetic.generate_catalog(
+            database_setup.engine, args.users, args.games, args.ratings,
+            args.seed)
+        print "Generated the catalog in %.1f seconds." % (time.time() - start)
+
+        import gamerater
+        gamerater.app.secret_key = 'benchmark_secret_key'
+        gamerater.app.testing = True
+        gamerater.leaderboards.rebuild()
+        gamerater.session.remove()
+
+        routes = load.ROUTES
+        if args.routes:
+            routes = [route for route in routes if route.name in args.routes]
+        results = load.run_benchmark(
+            gamerater.app, database_setup.engine, catalog, routes,
+            args.requests, args.concurrency, args.seed)
+    finally:
+        shutil.rmtree(directory)
+
+    report = {
+        'config': {
+            'users': args.users,
+            'games': args.games,
+            'ratings': args.ratings,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'seed': args.seed,
+            'python': platform.python_version(),
+            'sqlite_profile': os.environ.get('SQLITE_PROFILE', 'wal')
+        },
+        'routes': results
+    }
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2, sort_keys=True)
+
+    print "%-20s %8s %8s %8s %9s %8s %7s" % (
+        'route', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s', 'queries', 'errors')
+    for route in routes:
+        result = results[route.name]
+        print "%-20s %8s %8s %8s %9s %8s %7d" % (
+            route.name, format_number(result['p50_ms'], '%.2f'),
+            format_number(result['p95_ms'], '%.2f'),
+            format_number(result['p99_ms'], '%.2f'),
+            format_number(result['throughput'], '%.1f'),
+            format_number(result['queries_per_request'], '%.2f'),
+            result['errors'])
+    print "Wrote %s" % args.output
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+#
+# Drives gamerater's routes through Flask's test client from several
+# threads, and reports each route's latency percentiles, throughput and SQL
+# queries per request.
+#
+import math
+import random
+import threading
+import time
+
+from sqlalchemy import event
+
+
+class Route(object):
+    """
+    A route to benchmark. make_request(rng, catalog, worker) returns the
+    (method, url, form data) of one request, where worker is a dict the
+    route can keep state in. If prepare is given, it is called with the
+    same arguments and the test client before each request, untimed.
+    """
+
+    def __init__(self, name, make_request, prepare=None):
+        self.name = name
+        self.make_request = make_request
+        self.prepare = prepare
+
+
+def get(url):
+    """
+    Returns a make_request function for GETs of url, formatted with random
+    ids, categories and search words from the catalog.
+    """
+
+    def make_request(rng, catalog, worker):
+        return 'GET', url % {
+            'user_id': rng.choice(catalog['user_ids']),
+            'game_id': rng.choice(catalog['game_ids']),
+            'category': rng.choice(catalog['categories']),
+            'word': rng.choice(catalog['words'])[:3]
+        }, None
+    return make_request
+
+
+def rate_game(rng, catalog, worker):
+    return 'POST', '/gamerater/rate-game/', {
+        'submit': 'Submit', 'name': rng.choice(catalog['game_names']),
+        'rating': rng.randint(0, 10)}
+
+
+def add_game(rng, catalog, worker):
+    worker['added'] = worker.get('added', 0) + 1
+    return 'POST', '/gamerater/add-game/', {
+        'submit': 'Submit',
+        'name': 'Benchmark Game %s-%s' % (worker['user_id'],
+                                          worker['added']),
+        'category': rng.choice(catalog['categories']),
+        'description': 'Added by the benchmark', 'rating': 5}
+
+
+def rate_before_delete(rng, catalog, worker, client):
+    # Make sure the user has a rating to delete
+    index = rng.randrange(len(catalog['game_ids']))
+    worker['game_id'] = catalog['game_ids'][index]
+    client.post('/gamerater/rate-game/', data={
+        'submit': 'Submit', 'name': catalog['game_names'][index],
+        'rating': 5}).close()
+
+
+def delete_rating(rng, catalog, worker):
+    return 'POST', '/gamerater/delete_rating/%s/' % worker['game_id'], {
+        'submit': 'Yes, delete my rating.'}
+
+
+def update_user(rng, catalog, worker):
+    return 'POST', '/update_user', {
+        'submit': 'Submit', 'username': 'User %s' % worker['user_id']}
+
+
+ROUTES = [
+    Route('home', get('/gamerater/')),
+    Route('home_json', get('/gamerater/json/')),
+    Route('users_json', get('/gamerater/users/json/')),
+    Route('games_json', get('/gamerater/games/json/')),
+    Route('ratings_json',
+          get('/gamerater/ratings/json/?user_id=%(user_id)s')),
+    Route('search', get('/gamerater/search/?q=%(word)s')),
+    Route('top_json', get('/gamerater/top/json/?category=%(category)s')),
+    Route('game', get('/gamerater/game/%(game_id)s/')),
+    Route('game_json', get('/gamerater/game/%(game_id)s/json/')),
+    Route('user', get('/gamerater/user/%(user_id)s/')),
+    Route('user_json', get('/gamerater/user/%(user_id)s/json/')),
+    Route('game_similar', get('/gamerater/game/%(game_id)s/similar/')),
+    Route('user_recommendations',
+          get('/gamerater/user/%(user_id)s/recommendations/')),
+    Route('game_trend', get('/gamerater/game/%(game_id)s/trend/')),
+    Route('my_games', get('/gamerater/my-games/')),
+    Route('my_games_json', get('/gamerater/my-games/json/')),
+    Route('rate_game_form', get('/gamerater/rate-game/')),
+    Route('add_game_form', get('/gamerater/add-game/')),
+    Route('rate_game', rate_game),
+    Route('add_game', add_game),
+    Route('delete_rating', delete_rating, prepare=rate_before_delete),
+    Route('update_user', update_user),
+]
+
+
+def percentile(values, percent):
+    """
+    Returns the given percentile of the sorted list values, using the
+    nearest rank.
+
+    >>> percentile([1, 2, 3, 4], 50)
+    2
+    """
+    if not values:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+def to_ms(seconds):
+    """Returns seconds in milliseconds, or None if seconds is None."""
+    if seconds is None:
+        return None
+    return round(seconds * 1000, 2)
+
+
+class QueryCounter(object):
+    """Counts the SQL statements each thread runs on an engine."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.local = threading.local()
+
+    def before_cursor_execute(self, conn, cursor, statement, *args):
+        self.local.count = getattr(self.local, 'count', 0) + 1
+
+    def reset(self):
+        self.local.count = 0
+
+    @property
+    def count(self):
+        return getattr(self.local, 'count', 0)
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute',
+                     self.before_cursor_execute)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute',
+                     self.before_cursor_execute)
+
+
+def run_route(app, counter, catalog, route, request_count, concurrency,
+              seed=0):
+    """
+    Sends request_count requests to route from concurrency threads, each
+    logged in as a different user, and returns the route's results.
+    Requests answered with a server error, or that raise, count as errors;
+    the latencies and query counts are of the requests that didn't raise,
+    and are None if none of them did.
+    """
+    latencies = []
+    queries = []
+    errors = [0]
+    raised = [0]
+    lock = threading.Lock()
+
+    def worker(index, count):
+        rng = random.Random('%s-%s-%s' % (seed, route.name, index))
+        state = {'user_id': catalog['user_ids'][
+            index % len(catalog['user_ids'])]}
+        client = app.test_client()
+        with client.session_transaction() as login_session:
+            login_session['username'] = 'User %s' % state['user_id']
+            login_session['user_id'] = state['user_id']
+
+        for i in range(count):
+            try:
+                if route.prepare is not None:
+                    route.prepare(rng, catalog, state, client)
+                method, url, data = route.make_request(rng, catalog, state)
+                counter.reset()
+                start = time.time()
+                response = client.open(url, method=method, data=data)
+                # Read streamed bodies in full before stopping the clock
+                response.get_data()
+                response.close()
+                elapsed = time.time() - start
+            except Exception:
+                with lock:
+                    raised[0] += 1
+                continue
+            with lock:
+                latencies.append(elapsed)
+                queries.append(counter.count)
+                if response.status_code >= 500:
+                    errors[0] += 1
+
+    # Split the requests as evenly as possible between the threads
+    counts = [request_count // concurrency +
+              (1 if i < request_count % concurrency else 0)
+              for i in range(concurrency)]
+    threads = [threading.Thread(target=worker, args=(i, count))
+               for i, count in enumerate(counts) if count]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.time() - start
+
+    latencies.sort()
+    return {
+        'requests': len(latencies) + raised[0],
+        'errors': errors[0] + raised[0],
+        'seconds': round(seconds, 3),
+        'throughput': round(len(latencies) / seconds, 1) if seconds else None,
+        'p50_ms': to_ms(percentile(latencies, 50)),
+        'p95_ms': to_ms(percentile(latencies, 95)),
+        'p99_ms': to_ms(percentile(latencies, 99)),
+        'queries_per_request': round(
+            float(sum(queries)) / len(queries), 2) if queries else None,
+        'max_queries': max(queries) if queries else None
+    }
+
+
+def run_benchmark(app, engine, catalog, routes=ROUTES, request_count=200,
+                  concurrency=4, seed=0):
+    """
+    Runs every route in turn and returns a dict of route name to results.
+    Reads come before writes in ROUTES, so they see the generated catalog.
+    """
+    results = {}
+    with QueryCounter(engine) as counter:
+        for route in routes:
+            results[route.name] = run_route(app, counter, catalog, route,
+                                            request_count, concurrency, seed)
+    return results
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+#
+# Measures sustained rating writes per second through gamerater's rating
+# write path, committing each rating on its own and with group commit at
+# each of the given windows. Writer threads save random ratings for as
+# long as asked; set SQLITE_PROFILE=durable to see the cost of one fsync
+# per commit.
+#
+# Usage (from the catalog folder):
+#   python -m benchmark.ratings [--seconds 5] [--writers 8]
+#                               [--windows 0 2 5] [--users 1000]
+#                               [--games 500] [--seed 0]
+#
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+
+def run_writers(gamerater, catalog, seconds, writers, seed):
+    """
+    Saves random ratings from writers threads for seconds, and returns the
+    number of ratings saved per second and the number of errors.
+    """
+    saved = [0] * writers
+    errors = [0] * writers
+    deadline = time.time() + seconds
+
+    def run(index):
+        rng = random.Random(seed + index)
+        while time.time() < deadline:
+            try:
+                gamerater.save_rating(rng.choice(catalog['user_ids']),
+                                      rng.choice(catalog['game_ids']),
+                                      rng.randint(0, 10))
+                saved[index] += 1
+            except Exception:
+                errors[index] += 1
+            finally:
+                gamerater.session.remove()
+
+    threads = [threading.Thread(target=run, args=(index,))
+               for index in range(writers)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(saved) / (time.time() - start), sum(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmark.ratings',
+        description="Benchmark rating writes with and without group commit.")
+    parser.add_argument('--seconds', type=float, default=5,
+                        help="seconds per run (default: %(default)s)")
+    parser.add_argument('--writers', type=int, default=8,
+                        help="threads saving ratings (default: %(default)s)")
+    parser.add_argument('--windows', type=float, nargs='+',
+                        default=[0, 2, 5],
+                        help="group commit windows in milliseconds to run, "
+                             "0 for a commit per rating (default: "
+                             "%(default)s)")
+    parser.add_argument('--users', type=int, default=1000,
+                        help="users to generate (default: %(default)s)")
+    parser.add_argument('--games', type=int, default=500,
+                        help="games to generate (default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="seed for the catalog and ratings (default: "
+                             "%(default)s)")
+    args = parser.parse_args()
+
+    # Point gamerater at a scratch database before it is imported
+    directory = tempfile.mkdtemp()
+    database_url = 'sqlite:///%s' % os.path.join(directory, 'benchmark.db')
+    os.environ['GAMERATER_DATABASE_URL'] = database_url
+    try:
+        import database_setup
+        import migrations
+        from benchmark import synthetic
+        from group_commit import GroupCommitter
+
+        migrations.upgrade(database_setup.engine)
+        catalog = synthetic.generate_catalog(
+            database_setup.engine, args.users, args.games, 0, args.seed)
+
+        import gamerater
+        print "SQLite profile: %s, %s writers" % (
+            os.environ.get('SQLITE_PROFILE', 'wal'), args.writers)
+        print "%-14s %10s %11s %7s" % (
+            'mode', 'ratings/s', 'group size', 'errors')
+        for window in args.windows:
+            if window > 0:
+                committer = GroupCommitter(gamerater.session,
+                                           window=window / 1000.0)
+                mode = 'group %gms' % window
+            else:
+                committer = None
+                mode = 'single'
+            gamerater.rating_committer = committer
+            per_second, errors = run_writers(gamerater, catalog,
+                                             args.seconds, args.writers,
+                                             args.seed)
+            if committer is not None and committer.groups:
+                group_size = float(committer.writes) / committer.groups
+            else:
+                group_size = 1
+            print "%-14s %10.1f %11.1f %7d" % (mode, per_second, group_size,
+                                                errors)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
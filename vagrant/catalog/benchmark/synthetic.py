@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+#
+# Generates synthetic catalogs of users, games and ratings. The same seed
+# and sizes always give the same catalog, so runs of the benchmark against
+# different versions of gamerater can be compared.
+#
+import random
+
+from datetime import datetime, timedelta
+
+import ranking
+from database_setup import Game, UsersGames, User
+
+# Rows written per executemany
+CHUNK_SIZE = 5000
+
+# Ratings are spread over the year before this time
+START = datetime(2017, 1, 1)
+
+CATEGORIES = ('Action', 'Adventure', 'Puzzle', 'Racing', 'RPG', 'Shooter',
+              'Simulation', 'Sports', 'Strategy')
+ADJECTIVES = ('Ancient', 'Broken', 'Crimson', 'Dark', 'Endless', 'Final',
+              'Golden', 'Hidden', 'Iron', 'Lost', 'Mystic', 'Silent',
+              'Super', 'Wild')
+NOUNS = ('Dungeon', 'Empire', 'Frontier', 'Galaxy', 'Kingdom', 'Legend',
+         'Odyssey', 'Quest', 'Raider', 'Samurai', 'Saga', 'Tower', 'Voyage',
+         'Warrior')
+
+
+def get_game_name(rng, number):
+    """
+    Returns a unique game name for the game with the given number.
+
+    >>> get_game_name(random.Random(1), 7)
+    'Crimson Quest 7'
+    """
+    return '%s %s %s' % (rng.choice(ADJECTIVES), rng.choice(NOUNS), number)
+
+
+def insert_rows(connection, table, rows):
+    """Inserts rows into table in chunks of CHUNK_SIZE."""
+    for start in range(0, len(rows), CHUNK_SIZE):
+        connection.execute(table.insert(), rows[start:start + CHUNK_SIZE])
+
+
+def generate_catalog(engine, user_count, game_count, rating_count, seed=0):
+    """
+    Fills an empty gamerater database with user_count users, game_count
+    games and up to rating_count ratings (one per user and game at most),
+    with the games' rating totals filled in. Returns a dict of the ids,
+    names and categories created, for building requests.
+    """
+    rng = random.Random(seed)
+    rating_count = min(rating_count, user_count * game_count)
+
+    # Rate distinct (user, game) pairs with random ratings and times
+    ratings = {}
+    while len(ratings) < rating_count:
+        pair = (rng.randint(1, user_count), rng.randint(1, game_count))
+        if pair not in ratings:
+            ratings[pair] = (rng.randint(0, 10), START + timedelta(
+                seconds=rng.randint(0, 365 * 24 * 60 * 60)))
+
+    totals = {}
+    user_modified = {}
+    for (user_id, game_id), (rating, modified) in ratings.items():
+        rating_sum, count, game_modified = totals.get(game_id, (0, 0, START))
+        totals[game_id] = (rating_sum + rating, count + 1,
+                           max(game_modified, modified))
+        user_modified[user_id] = max(user_modified.get(user_id, START),
+                                     modified)
+
+    users = [{'id': user_id, 'name': 'User %s' % user_id,
+              'email': 'user%s@example.com' % user_id, 'picture': '',
+              'modified': user_modified.get(user_id, START)}
+             for user_id in range(1, user_count + 1)]
+    games = []
+    for game_id in range(1, game_count + 1):
+        rating_sum, count, modified = totals.get(game_id, (0, 0, START))
+        games.append({
+            'id': game_id,
+            'name': get_game_name(rng, game_id),
+            'category': rng.choice(CATEGORIES),
+            'description': ' '.join(rng.choice(ADJECTIVES + NOUNS)
+                                    for i in range(8)),
+            'avg_rating': float(rating_sum) / count if count else 0,
+            'rating_sum': rating_sum,
+            'rating_count': count,
+            'modified': modified
+        })
+
+    with engine.begin() as connection:
+        insert_rows(connection, User.__table__, users)
+        insert_rows(connection, Game.__table__, games)
+        insert_rows(connection, UsersGames.__table__, [
+            {'user_id': user_id, 'game_id': game_id, 'rating': rating,
+             'modified': modified}
+            for (user_id, game_id), (rating, modified) in
+            sorted(ratings.items())])
+        ranking.rank_games(connection)
+
+    return {
+        'user_ids': [user['id'] for user in users],
+        'game_ids': [game['id'] for game in games],
+        'game_names': [game['name'] for game in games],
+        'categories': list(CATEGORIES),
+        'words': [word.lower() for word in ADJECTIVES + NOUNS]
+    }
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+#
+# A small in-process cache for page fragments that are expensive to build
+# but rarely change.
+#
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Thread safe cache holding at most max_size values. When it is full, the
+    least recently used value is evicted. Values older than max_age seconds
+    (if given) are rebuilt, which bounds how stale a value can get in worker
+    processes that didn't see an invalidation.
+
+    >>> cache = LRUCache(max_size=100)
+    >>> cache.get_or_set('top_ten_games', get_top_ten_games)
+    [{'id': 3, 'name': 'Nioh', ...}, ...]
+    """
+
+    def __init__(self, max_size, max_age=None):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._values = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Returns the value for key, or default if it isn't cached."""
+        with self._lock:
+            try:
+                stored, value = self._values.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if self.max_age is not None and (
+                    time.time() - stored > self.max_age):
+                self.misses += 1
+                return default
+
+            # Move the key to the most recently used end
+            self._values[key] = (stored, value)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, generation=None):
+        """
+        Caches value for key. If generation is given and the cache has been
+        invalidated since it was read, the value may be stale and is not
+        cached.
+        """
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._values.pop(key, None)
+            self._values[key] = (time.time(), value)
+            while len(self._values) > self.max_size:
+                self._values.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_set(self, key, function):
+        """
+        Returns the value for key, calling function to build and cache it
+        if it isn't cached.
+        """
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            generation = self._generation
+            value = function()
+            self.set(key, value, generation)
+        return value
+
+    def invalidate(self, *keys):
+        """Removes the given keys, or every key if none are given."""
+        with self._lock:
+            self._generation += 1
+            if keys:
+                for key in keys:
+                    self._values.pop(key, None)
+            else:
+                self._values.clear()
+
+    @property
+    def stats(self):
+        """Returns the cache's counters in easily serializable format."""
+        with self._lock:
+            return {
+                'size': len(self._values),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
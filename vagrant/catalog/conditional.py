@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+#
+# Helpers for answering conditional GET requests (If-None-Match and
+# If-Modified-Since) from cheap validators, before the full response is
+# built.
+#
+import hashlib
+
+from datetime import datetime
+from time import mktime
+
+from flask import request, make_response
+
+
+def make_etag(*parts):
+    """
+    Returns an ETag for the given validator parts, e.g. the latest modified
+    time and number of rows behind a response.
+
+    >>> make_etag('game', 3, datetime(2017, 5, 1, 12, 30))
+    '0c4f6a...'
+    """
+    return hashlib.sha1(repr(parts)).hexdigest()
+
+
+def latest(*times):
+    """Returns the latest of the given times, ignoring any that are None."""
+    times = [time for time in times if time is not None]
+    if times:
+        return max(times)
+    return None
+
+
+def to_http_date(modified):
+    """
+    Converts a local modified time, as stored in the database, to the UTC
+    time used in Last-Modified headers, without microseconds.
+    """
+    if modified is None:
+        return None
+    return datetime.utcfromtimestamp(mktime(modified.timetuple()))
+
+
+def is_not_modified(etag, last_modified=None):
+    """
+    Returns True if the request's If-None-Match or If-Modified-Since header
+    shows the client already has the current response. If-None-Match is
+    used when both are sent.
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if request.if_modified_since and last_modified is not None:
+        return to_http_date(last_modified) <= request.if_modified_since
+    return False
+
+
+def add_validators(response, etag, last_modified=None):
+    """
+    Sets the ETag and Last-Modified headers on response, and asks clients
+    to check with them before reusing it.
+    """
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = to_http_date(last_modified)
+    response.cache_control.no_cache = True
+    return response
+
+
+def not_modified(etag, last_modified=None):
+    """Returns an empty 304 Not Modified response with the validators."""
+    return add_validators(make_response('', 304), etag, last_modified)
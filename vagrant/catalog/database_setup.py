@@ -1,12 +1,20 @@
+import os
 import sys
 
 from time import mktime
 
-from sqlalchemy import Column, ForeignKey, Integer, String, Float, DateTime
+from sqlalchemy import (Column, ForeignKey, Integer, String, Float, DateTime,
+                        Index)
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy import inspect
+from sqlalchemy.orm import relationship, sessionmaker, scoped_session
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.pool import QueuePool
 from sqlalchemy import create_engine
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from shared import sqlite_profile
+
 
 Base = declarative_base()
 
@@ -18,10 +26,24 @@ class User(Base):
 
     # create columns
     name = Column(String(80), nullable = False)
-    email = Column(String(255))
+    email = Column(String(255), index = True)
     picture = Column(String(255))
     id = Column(Integer, primary_key=True)
 
+    # last change to the user or their set of ratings
+    modified = Column(DateTime, index = True)
+
+
+    @classmethod
+    def get_users_by_id(cls, id_list):
+        """
+        Returns the users with the given ids in the same order, and a list
+        of the ids that have no user. See load_by_ids.
+
+        >>>get_users_by_id((3, 1))
+        ([Sam, Paul], [])
+        """
+        return load_by_ids(session, cls, id_list)
 
     @property
     def serialize(self):
@@ -33,12 +55,21 @@ class User(Base):
         else:
             ratings = "No ratings"
 
+        user_data = self.serialize_summary
+        user_data['ratings'] = ratings
+        return user_data
+
+    @property
+    def serialize_summary(self):
+        """
+        Returns object data in easily serializable format, without the
+        user's ratings.
+        """
         return {
             'name' : self.name,
             'email' : self.email,
             'picture' : self.picture,
-            'id' : self.id,
-            'ratings' : ratings
+            'id' : self.id
         }
 
 
@@ -50,27 +81,34 @@ class Game(Base):
 
     # create columns
     id = Column(Integer, primary_key = True)
-    name = Column(String(80), nullable = False)
+    name = Column(String(80), nullable = False, index = True)
     category = Column(String(40))
     description = Column(String(1020))
-    avg_rating = Column(Float)
-    modified = Column(DateTime)
+    avg_rating = Column(Float, index = True)
+    modified = Column(DateTime, index = True)
+
+    # running totals of the game's ratings, kept in step with UsersGames
+    # so avg_rating can be updated without reading every rating
+    rating_sum = Column(Integer, nullable = False, default = 0,
+                        server_default = '0')
+    rating_count = Column(Integer, nullable = False, default = 0,
+                          server_default = '0')
+
+    # the game's average rating blended with the average of every rating,
+    # so games with few ratings don't outrank well rated popular games.
+    # Kept in step with the totals; see ranking.py
+    rank_score = Column(Float, index = True)
 
     @classmethod
     def get_games_by_id(cls, id_list):
         """
-        Returns the games with the given ids.
+        Returns the games with the given ids in the same order, and a list
+        of the ids that have no game. See load_by_ids.
 
-        >>>get_games_by_id((1, 2, 3))
-        Mass Effect, Nioh, Tomb Raider
+        >>>get_games_by_id((1, 2, 3, 99))
+        ([Mass Effect, Nioh, Tomb Raider], [99])
         """
-        games = []
-
-        for id in id_list:
-            game = session.query(cls).filter_by(id = id).one()
-            games.append(game)
-
-        return games
+        return load_by_ids(session, cls, id_list)
 
     @property
     def serialize(self):
@@ -80,6 +118,7 @@ class Game(Base):
             'id' : self.id,
             'category' : self.category,
             'avg_rating' : self.avg_rating,
+            'rank_score' : self.rank_score,
             'description' : self.description,
             'last modified' : int(mktime(self.modified.timetuple()))
         }
@@ -91,6 +130,16 @@ class UsersGames(Base):
     # set variable for table name
     __tablename__ = 'usersgames'
 
+    # create indexes for looking up a user's top and latest ratings, a
+    # game's ratings (or one user's rating of it, which also keeps each
+    # user to one rating per game), and the latest ratings
+    __table_args__ = (
+        Index('ix_usersgames_user_id_rating', 'user_id', 'rating'),
+        Index('ix_usersgames_user_id_modified', 'user_id', 'modified'),
+        Index('ix_usersgames_game_id_user_id', 'game_id', 'user_id',
+              unique = True),
+        Index('ix_usersgames_modified', 'modified'),
+    )
 
     # create columns
     id = Column(Integer, primary_key = True)
@@ -134,15 +183,208 @@ class UsersGames(Base):
             'rating' : self.rating
         }
 
-        
+
+class RatingEvent(Base):
+    """
+    Table logging every rating created (old_rating is None), changed, or
+    deleted (new_rating is None). Rows are only ever appended, and deleted
+    by trends.py once they are old and rolled up.
+    """
+
+    # set variable for table name
+    __tablename__ = 'rating_event'
+
+    # never reuse the ids of deleted events, which trends.py has already
+    # rolled up past
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    # create columns
+    id = Column(Integer, primary_key = True)
+    user_id = Column(Integer, ForeignKey('user.id'), nullable = False)
+    game_id = Column(Integer, ForeignKey('game.id'), nullable = False)
+    old_rating = Column(Integer)
+    new_rating = Column(Integer)
+    created = Column(DateTime, nullable = False, index = True)
+
+
+class RatingRollup(Base):
+    """
+    Table for each game's rating events summed per hour and per day, kept
+    up to date by trends.py.
+    """
+
+    # set variable for table name
+    __tablename__ = 'rating_rollup'
+
+    # create an index for looking up a game's buckets in time order, which
+    # also keeps each bucket unique
+    __table_args__ = (
+        Index('ix_rating_rollup_game_id_period_start',
+              'game_id', 'period', 'start', unique = True),
+    )
+
+    # create columns
+    id = Column(Integer, primary_key = True)
+    game_id = Column(Integer, ForeignKey('game.id'), nullable = False)
+    period = Column(String(4), nullable = False)
+    start = Column(DateTime, nullable = False)
+
+    # number of events, the sum and number of the ratings given, and the
+    # change in the game's number of ratings
+    events = Column(Integer, nullable = False, default = 0)
+    rating_sum = Column(Integer, nullable = False, default = 0)
+    rating_count = Column(Integer, nullable = False, default = 0)
+    count_change = Column(Integer, nullable = False, default = 0)
+
+    @property
+    def serialize(self):
+        """Returns object data in easily serializable format."""
+        if self.rating_count:
+            avg_rating = float(self.rating_sum) / self.rating_count
+        else:
+            avg_rating = None
+        return {
+            'start' : int(mktime(self.start.timetuple())),
+            'events' : self.events,
+            'rating_count' : self.rating_count,
+            'avg_rating' : avg_rating,
+            'count_change' : self.count_change
+        }
+
+
+class RollupProgress(Base):
+    """
+    Table holding the id of the last rating event rolled up. Has one row,
+    updated by trends.py.
+    """
+
+    # set variable for table name
+    __tablename__ = 'rollup_progress'
+
+    # create columns
+    id = Column(Integer, primary_key = True)
+    last_event_id = Column(Integer, nullable = False, default = 0)
+    modified = Column(DateTime)
+
+
+class RatingPrior(Base):
+    """
+    Table holding the average of every rating, and the number of those
+    average ratings blended into each game's rank_score. Has one row,
+    rewritten by ranking.py.
+    """
+
+    # set variable for table name
+    __tablename__ = 'rating_prior'
+
+    # create columns
+    id = Column(Integer, primary_key = True)
+    mean = Column(Float, nullable = False)
+    weight = Column(Float, nullable = False)
+    modified = Column(DateTime)
+
+
+class GameSimilarity(Base):
+    """
+    Table for each game's most similar games by their ratings, ranked from
+    1. Rebuilt in the background by recommendations.py.
+    """
+
+    # set variable for table name
+    __tablename__ = 'game_similarity'
+
+    # create an index for looking up a game's similar games in rank order
+    __table_args__ = (
+        Index('ix_game_similarity_game_id_rank', 'game_id', 'rank'),
+    )
+
+    # create columns
+    id = Column(Integer, primary_key = True)
+    game_id = Column(Integer, ForeignKey('game.id'), nullable = False)
+    similar_game_id = Column(Integer, ForeignKey('game.id'),
+                             nullable = False)
+    rank = Column(Integer, nullable = False)
+    score = Column(Float, nullable = False)
+
+
+
+
+def load_by_ids(session, cls, id_list, chunk_size = None):
+    """
+    Returns the objects of class cls with the given ids in the same order,
+    and a list of the ids that have no object. Objects already loaded in
+    session are reused from its identity map; the rest are loaded with one
+    IN (...) query per chunk_size ids.
+
+    >>>load_by_ids(session, User, (3, 1, 99))
+    ([Sam, Paul], [99])
+    """
+    chunk_size = chunk_size or LOAD_CHUNK_SIZE
+    found = {}
+    to_load = []
+
+    for obj_id in set(id_list):
+        obj = session.identity_map.get(identity_key(cls, obj_id))
+        if obj is not None and not inspect(obj).expired:
+            found[obj_id] = obj
+        else:
+            to_load.append(obj_id)
+
+    for start in range(0, len(to_load), chunk_size):
+        chunk = to_load[start:start + chunk_size]
+        for obj in session.query(cls).filter(cls.id.in_(chunk)):
+            found[obj.id] = obj
+
+    objects = []
+    missing = []
+    for obj_id in id_list:
+        if obj_id in found:
+            objects.append(found[obj_id])
+        else:
+            missing.append(obj_id)
+    return objects, missing
+
+
+def create_db_engine(url):
+    """
+    Returns an engine for url with a fixed size connection pool, so each
+    worker thread checks out its own connection and returns it when its
+    request's session is removed. SQLite connections also get the PRAGMAs
+    of the SQLITE_PROFILE profile (WAL by default), see shared/sqlite_profile.
+    """
+    pool_args = dict(poolclass = QueuePool,
+                     pool_size = POOL_SIZE,
+                     max_overflow = POOL_MAX_OVERFLOW,
+                     pool_timeout = POOL_TIMEOUT,
+                     pool_recycle = POOL_RECYCLE)
+    if url.startswith('sqlite'):
+        # Pooled connections are handed between threads, one at a time
+        return sqlite_profile.create_sqlite_engine(
+            url, connect_args = {'check_same_thread': False}, **pool_args)
+    return create_engine(url, **pool_args)
 
 
 ##################### EOF code
-engine = create_engine('sqlite:///favoritegames.db')
+DATABASE_URL = os.environ.get('GAMERATER_DATABASE_URL',
+                              'sqlite:///favoritegames.db')
+
+# Most ids to load in one IN (...) query; SQLite allows 999 parameters
+LOAD_CHUNK_SIZE = 500
+
+# Connection pool settings: connections kept open, extra connections
+# allowed under load, seconds to wait for a free connection, and seconds
+# before a connection is replaced
+POOL_SIZE = 5
+POOL_MAX_OVERFLOW = 10
+POOL_TIMEOUT = 30
+POOL_RECYCLE = 3600
+
+engine = create_db_engine(DATABASE_URL)
 
 Base.metadata.create_all(engine)
 
-# Create database connector
+# Create database connector. The session is scoped to the current thread;
+# gamerater removes it when each request's app context is torn down.
 DBSession = sessionmaker(bind = engine)
-session = DBSession()
+session = scoped_session(DBSession)
 ##################### EOF code
\ No newline at end of file
@@ -1,35 +1,120 @@
 from flask import (Flask, render_template, url_for, redirect, request,
-                   flash, jsonify, make_response)
+                   flash, jsonify, make_response, Markup)
 from flask import session as login_session
-from sqlalchemy import create_engine, desc
-from sqlalchemy.orm import sessionmaker
-from database_setup import Base, Game, UsersGames, User
+from sqlalchemy import desc, func, and_, case
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.exc import NoResultFound
+import database_setup
+import migrations
+import ranking
+import recommendations
+import search
+import trends
+from database_setup import (Game, UsersGames, User, GameSimilarity,
+                            RatingEvent, RatingRollup)
+from json_stream import stream_json, iter_serialized
+from cache import LRUCache
+from leaderboard import Leaderboards
+from group_commit import GroupCommitter
+# database_setup puts the shared folder on the path
+from shared.sql_stats import SQLStats, debug_only
+from shared.oauth_client import ProviderClient, ProviderError
+from shared.oauth_config import (SecretsFile, ConfigError, make_google_flow,
+                                 validate_google_secrets,
+                                 validate_facebook_secrets)
+from shared.session_store import ServerSessionInterface, create_store
+from shared import prefork
+from conditional import (make_etag, latest, is_not_modified, add_validators,
+                         not_modified)
 from datetime import datetime
-from oauth2client.client import flow_from_clientsecrets
 from oauth2client.client import FlowExchangeError
+import argparse
 import httplib2
 import random
 import json
+import os
+import socket
 import string
-import requests
 
 app = Flask(__name__)
 
-CLIENT_ID = json.loads(
-    open('client_secrets.json', 'r').read())['web']['client_id']
+# Keep login sessions on the server, with only their id in the cookie
+app.session_interface = ServerSessionInterface(create_store())
+
+# Client secrets, loaded once and reloaded when the files change. The
+# Google secrets are loaded now so a bad file stops the app from starting.
+google_secrets = SecretsFile('client_secrets.json', validate_google_secrets)
+facebook_secrets = SecretsFile('fb_client_secrets.json',
+                               validate_facebook_secrets)
+google_secrets.load()
+
 APPLICATION_NAME = "Gamerater"
 
-# Create database
-engine = create_engine('sqlite:///favoritegames.db')
-Base.metadata.create_all(engine)
+# Pooled, timeout-bounded client for the Google and Facebook APIs
+provider_client = ProviderClient()
 
-# Create database connector
-DBSession = sessionmaker(bind=engine)
-session = DBSession()
+# Share database_setup's engine and thread scoped session, so each
+# request gets its own session
+session = database_setup.session
+
+# Bring the database schema up to date, and the rank scores' prior in step
+# with the ratings
+migrations.upgrade(database_setup.engine)
+with database_setup.engine.begin() as connection:
+    ranking.refresh_prior(connection)
 
 # Methods used
 methods = ['GET', 'POST']
 
+# Default and largest number of items in a page of a JSON collection
+app.config.setdefault('JSON_PAGE_SIZE', 50)
+app.config.setdefault('JSON_MAX_PAGE_SIZE', 200)
+
+# Default and largest number of games returned by a search
+app.config.setdefault('SEARCH_LIMIT', 10)
+app.config.setdefault('SEARCH_MAX_LIMIT', 50)
+
+# Count and time the SQL statements of each route, see /debug/sql-stats.
+# The /debug pages are only served in debug mode or with DEBUG_STATS=1.
+sql_stats = SQLStats(app, database_setup.engine)
+app.config.setdefault('DEBUG_STATS', os.environ.get('DEBUG_STATS') == '1')
+
+# Default and largest number of games in a leaderboard
+app.config.setdefault('LEADERBOARD_SIZE', 10)
+app.config.setdefault('LEADERBOARD_MAX_SIZE', 100)
+
+# Default and largest number of similar or recommended games returned
+app.config.setdefault('RECOMMENDATIONS_SIZE', 10)
+app.config.setdefault('RECOMMENDATIONS_MAX_SIZE', 50)
+
+# Default and largest number of buckets in a game's rating trend
+app.config.setdefault('TREND_SIZE', 30)
+app.config.setdefault('TREND_MAX_SIZE', 24 * 31)
+
+# Commit rating writes arriving within GROUP_COMMIT_MS milliseconds of each
+# other together, to save a commit per rating under load (off by default)
+GROUP_COMMIT_MS = float(os.environ.get('GROUP_COMMIT_MS', 0))
+if GROUP_COMMIT_MS > 0:
+    rating_committer = GroupCommitter(database_setup.session,
+                                      window=GROUP_COMMIT_MS / 1000)
+else:
+    rating_committer = None
+
+# Rebuilds the similar games in the background when the ratings change;
+# started by __main__, so importing gamerater doesn't start a thread
+similarity_refresher = recommendations.SimilarityRefresher(
+    database_setup.engine)
+
+# Cache for the home page fragments. The fragments are invalidated by the
+# routes that change them; max_age bounds how stale they can get in other
+# worker processes.
+fragment_cache = LRUCache(max_size=100, max_age=300)
+HOME_FRAGMENTS = ('recent_ratings', 'user_summaries')
+
+# Cache for the rendered user cards on the home page, keyed by what each
+# card shows, so a card is only rendered again after its user changes
+card_cache = LRUCache(max_size=5000)
+
 # Helper functions
 
 
@@ -61,13 +146,21 @@ def get_game_by_name(game_name):
 
 
 def get_ratings_by_game_id(game_id):
-    """Returns the ratings with the given game_id."""
-    return session.query(UsersGames).filter_by(game_id=game_id).all()
+    """
+    Returns the ratings with the given game_id, with their users loaded in
+    the same query.
+    """
+    return session.query(UsersGames).options(
+        joinedload(UsersGames.user)).filter_by(game_id=game_id).all()
 
 
 def get_ratings_by_user_id(user_id):
-    """Returns the ratings for user with the given id."""
-    return session.query(UsersGames).filter_by(
+    """
+    Returns the ratings for user with the given id, highest first, with
+    their games loaded in the same query.
+    """
+    return session.query(UsersGames).options(
+        joinedload(UsersGames.game)).filter_by(
         user_id=user_id).order_by(desc(UsersGames.rating)).all()
 
 
@@ -77,45 +170,407 @@ def get_rating_by_user_and_game(user_id, game_id):
         UsersGames.user_id == user_id, UsersGames.game_id == game_id).one()
 
 
+def get_rated_games(users_ratings):
+    """
+    Returns a list of dicts holding the rating and game for each of the
+    given ratings (from get_ratings_by_user_id, which loads their games),
+    skipping ratings of games that no longer exist.
+    """
+    return [{'rating': rating.rating, 'game': rating.game}
+            for rating in users_ratings if rating.game is not None]
+
+
 def get_top_game_by_user_id(user_id):
     """
     Returns the game with the highest rating by the user with
-    id user_id.
+    id user_id, loaded in the same query as the rating.
     """
-    top_rating = session.query(UsersGames).filter_by(
+    top_rating = session.query(UsersGames).options(
+        joinedload(UsersGames.game)).filter_by(
         user_id=user_id).order_by(desc(UsersGames.rating)).limit(1).one()
-    return get_game_by_id(top_rating.game_id)
+    return top_rating.game
 
 
 def get_latest_game_by_user_id(user_id):
-    """Returns the game most recently rated by the given user_id."""
-    latest_rating = session.query(UsersGames).filter_by(
+    """
+    Returns the game most recently rated by the given user_id, loaded in
+    the same query as the rating.
+    """
+    latest_rating = session.query(UsersGames).options(
+        joinedload(UsersGames.game)).filter_by(
         user_id=user_id).order_by(desc(UsersGames.modified)).limit(1).one()
-    return get_game_by_id(latest_rating.game_id)
+    return latest_rating.game
+
+
+def get_recent_ratings(limit=10):
+    """
+    Returns the most recent ratings as dicts holding the rating's
+    serialized user and game, rating and modified time. The users and
+    games are loaded in the same query as the ratings.
+    """
+    recent_ratings = session.query(UsersGames, User, Game).join(
+        User, UsersGames.user_id == User.id).join(
+        Game, UsersGames.game_id == Game.id).order_by(
+        desc(UsersGames.modified)).limit(limit)
+
+    recent_games = []
+    for rating, user, game in recent_ratings:
+        recent_game = {
+            "user": user.serialize_summary,
+            "game": game.serialize,
+            "rating": rating.rating,
+            "modified": rating.modified
+        }
+        recent_games.append(recent_game)
+    return recent_games
+
+
+def get_game_names_by_user_max(column):
+    """
+    Returns a dict of user id to the name of the game each user rated
+    with the highest value of column, i.e. UsersGames.rating for the
+    favorite game or UsersGames.modified for the latest game. Ties go to
+    the game with the lowest id.
+    """
+    user_max = session.query(
+        UsersGames.user_id.label('user_id'),
+        func.max(column).label('max_value')).group_by(
+        UsersGames.user_id).subquery()
+
+    rows = session.query(UsersGames.user_id, Game.name).join(
+        Game, UsersGames.game_id == Game.id).join(
+        user_max, and_(UsersGames.user_id == user_max.c.user_id,
+                       column == user_max.c.max_value)).order_by(
+        UsersGames.user_id, Game.id)
+
+    game_names = {}
+    for user_id, game_name in rows:
+        game_names.setdefault(user_id, game_name)
+    return game_names
+
+
+def load_leaderboard_games():
+    """Yields every serialized game, for building the leaderboards."""
+    return iter_serialized(session.query(Game))
+
+
+def get_top_games(limit=10, category=None):
+    """
+    Returns the serialized games with the highest average ratings, in the
+    given category if one is given, from the leaderboards.
+    """
+    return leaderboards.top(limit, category)
+
+
+def update_leaderboards(game_id):
+    """
+    Moves the game to its place in the leaderboards after a change to its
+    average rating. Call after committing the change.
+    """
+    game = session.query(Game).filter_by(id=game_id).first()
+    if game is None:
+        leaderboards.remove(game_id)
+    else:
+        leaderboards.update(game.serialize)
+
+
+def get_similar_games(game_id, limit=10):
+    """
+    Returns the serialized games rated most like the game, best first, each
+    with its similarity score, from the precomputed game_similarity table.
+    """
+    rows = session.query(Game, GameSimilarity.score).join(
+        GameSimilarity, GameSimilarity.similar_game_id == Game.id).filter(
+        GameSimilarity.game_id == game_id).order_by(
+        GameSimilarity.rank).limit(limit)
+    return [dict(game.serialize, score=round(score, 4))
+            for game, score in rows]
+
+
+def get_recommended_games(user_id, limit=10):
+    """
+    Returns serialized games the user hasn't rated, each with a score, from
+    the precomputed similar games of the games they rated. Each rated game
+    adds its similarity times how far the user's rating is above their
+    average rating, so games like the ones they rated low are left out.
+    """
+    average = session.query(func.avg(UsersGames.rating)).filter(
+        UsersGames.user_id == user_id).scalar()
+    if average is None:
+        return []
+
+    rated = session.query(UsersGames.game_id).filter(
+        UsersGames.user_id == user_id)
+    score = func.sum(GameSimilarity.score * (UsersGames.rating - average))
+    rows = session.query(GameSimilarity.similar_game_id, score).join(
+        UsersGames, UsersGames.game_id == GameSimilarity.game_id).filter(
+        UsersGames.user_id == user_id,
+        ~GameSimilarity.similar_game_id.in_(rated)).group_by(
+        GameSimilarity.similar_game_id).having(score > 0).order_by(
+        desc(score), GameSimilarity.similar_game_id).limit(limit).all()
+
+    games, missing = Game.get_games_by_id([row[0] for row in rows])
+    games_by_id = dict((game.id, game) for game in games)
+    return [dict(games_by_id[game_id].serialize, score=round(score, 4))
+            for game_id, score in rows if game_id in games_by_id]
+
+
+def get_user_summaries():
+    """
+    Returns a list of dicts with each serialized user and the names of
+    their favorite and latest games. Uses the same number of queries no
+    matter how many users there are.
+    """
+    favorite_games = get_game_names_by_user_max(UsersGames.rating)
+    latest_games = get_game_names_by_user_max(UsersGames.modified)
+    no_rating = "This user does not have a rating yet."
+
+    users = []
+    for user in session.query(User).order_by(User.id):
+        user_data = {
+            'user': user.serialize_summary,
+            'modified': user.modified,
+            'favorite_game': favorite_games.get(user.id, no_rating),
+            'latest_game': latest_games.get(user.id, no_rating)
+        }
+        users.append(user_data)
+    return users
 
 
-def update_game_avg_rating(game_id):
-    """Refreshes the average rating for game_id."""
+def render_user_cards(users):
+    """
+    Returns the rendered user_small.html card for each of the given user
+    summaries. Cards are cached by the user's id, modified time and games,
+    which change whenever the user rates a game or updates their name, so
+    only new and changed cards are rendered.
+    """
+    cards = []
+    for user in users:
+        key = (user['user']['id'], user['modified'], user['favorite_game'],
+               user['latest_game'])
+        card = card_cache.get(key)
+        if card is None:
+            card = Markup(render_template('user_small.html', user=user))
+            card_cache.set(key, card)
+        cards.append(card)
+    return cards
+
+
+def invalidate_home_fragments():
+    """
+    Removes the cached home page fragments. Called after any write that
+    changes ratings, games or user names.
+    """
+    fragment_cache.invalidate(*HOME_FRAGMENTS)
+
+
+def touch_user(user_id):
+    """
+    Sets the user's modified time to now, for changes to the user or their
+    set of ratings. Does not commit.
+    """
+    session.query(User).filter_by(id=user_id).update(
+        {User.modified: datetime.now()}, synchronize_session=False)
 
-    # Get the game for the game ID
-    existing_game = get_game_by_id(game_id)
 
-    # Get the existing game ratings, then divide by num ratings
-    existing_ratings = session.query(UsersGames).filter_by(
-        game_id=existing_game.id)
-    ratings_count = existing_ratings.count()
+def get_game_validators(game_id):
+    """
+    Returns the ETag and last modified time for the game's JSON, or
+    (None, None) if there is no game with that id.
+    """
+    game = session.query(Game.id, Game.modified).filter_by(
+        id=game_id).first()
+    if game is None:
+        return None, None
+    return make_etag('game', game.id, game.modified), game.modified
+
+
+def get_user_validators(user_id):
+    """
+    Returns the ETag and last modified time for the user's JSON, or
+    (None, None) if there is no user with that id. Covers changes to the
+    user, their ratings, and the games they rated, which hold the favorite
+    game's average rating.
+    """
+    user = session.query(
+        User.id, User.modified, func.count(UsersGames.id),
+        func.max(UsersGames.modified), func.max(Game.modified)).outerjoin(
+        UsersGames, UsersGames.user_id == User.id).outerjoin(
+        Game, Game.id == UsersGames.game_id).filter(
+        User.id == user_id).group_by(User.id).first()
+    if user is None:
+        return None, None
+
+    user_id, user_modified, count, ratings_modified, games_modified = user
+    last_modified = latest(user_modified, ratings_modified, games_modified)
+    return (make_etag('user', user_id, count, last_modified), last_modified)
 
-    if ratings_count > 0:
-        all_ratings = []
-        for rating in existing_ratings.all():
-            all_ratings.append(rating.rating)
-        avg_rating = float(sum(all_ratings)) / ratings_count
+
+def get_home_validators():
+    """
+    Returns the ETag and last modified time for a page of the home JSON,
+    from the latest change to any rating, game or user, and the newest
+    rating and user ids, which also cover rows added with older times, as
+    imports do. Deleting a rating changes its game and user. Each value is
+    looked up in an index by its own subquery, as SQLite only does that for
+    a single MAX.
+    """
+    (ratings_id, ratings_modified, games_modified, users_id,
+     users_modified) = session.query(*[
+         session.query(func.max(column)).as_scalar() for column in (
+             UsersGames.id, UsersGames.modified, Game.modified, User.id,
+             User.modified)]).one()
+
+    last_modified = latest(ratings_modified, games_modified, users_modified)
+    return (make_etag('home', request.query_string, ratings_id, users_id,
+                      last_modified),
+            last_modified)
+
+
+def adjust_game_rating_totals(game_id, old_rating=None, new_rating=None):
+    """
+    Adjusts the game's rating sum, count, average and rank score for a
+    single rating being added (old_rating is None), changed, or deleted
+    (new_rating is None). The update is done in one UPDATE statement using
+    the stored totals and prior, so the cost doesn't grow with the number
+    of ratings. Does not commit; the caller commits it with the rating
+    change, which also refreshes any loaded Game objects.
+
+    adjust_game_rating_totals(1, old_rating=7, new_rating=9)
+    """
+    sum_change = (new_rating or 0) - (old_rating or 0)
+    count_change = (new_rating is not None) - (old_rating is not None)
+
+    new_sum = Game.rating_sum + sum_change
+    new_count = Game.rating_count + count_change
+    session.query(Game).filter_by(id=game_id).update({
+        Game.rating_sum: new_sum,
+        Game.rating_count: new_count,
+        Game.avg_rating: case([(new_count > 0, new_sum * 1.0 / new_count)],
+                              else_=0),
+        Game.rank_score: ranking.get_stored_score(new_sum, new_count),
+        Game.modified: datetime.now()
+    }, synchronize_session=False)
+
+
+def log_rating_event(user_id, game_id, old_rating=None, new_rating=None):
+    """
+    Appends a rating being added (old_rating is None), changed, or deleted
+    (new_rating is None) to the rating event log, for the trends. Does not
+    commit; the caller commits it with the rating change.
+    """
+    session.add(RatingEvent(user_id=user_id, game_id=game_id,
+                            old_rating=old_rating, new_rating=new_rating,
+                            created=datetime.now()))
+
+
+def write_rating(user_id, game_id, rating):
+    """
+    Adds, changes or deletes (rating is None) the user's rating of the game,
+    along with the game's totals, the rating event and the user's modified
+    time, and returns the old rating (None if there wasn't one). Does not
+    commit; see save_rating.
+    """
+    # Write first, taking SQLite's write lock, so a concurrent write of the
+    # same rating waits for this one instead of reading the same old rating
+    touch_user(user_id)
+    try:
+        existing_rating = get_rating_by_user_and_game(user_id=user_id,
+                                                      game_id=game_id)
+    except NoResultFound:
+        existing_rating = None
+    if existing_rating is None and rating is None:
+        return None
+
+    old_rating = None
+    if existing_rating is None:
+        session.add(UsersGames(user_id=user_id, game_id=game_id,
+                               rating=rating, modified=datetime.now()))
+    elif rating is None:
+        old_rating = existing_rating.rating
+        session.delete(existing_rating)
     else:
-        avg_rating = 0
-    existing_game.avg_rating = avg_rating
-    existing_game.modified = datetime.now()
-    session.add(existing_game)
+        old_rating = existing_rating.rating
+        existing_rating.rating = rating
+        existing_rating.modified = datetime.now()
+
+    adjust_game_rating_totals(game_id=game_id, old_rating=old_rating,
+                              new_rating=rating)
+    log_rating_event(user_id=user_id, game_id=game_id,
+                     old_rating=old_rating, new_rating=rating)
+    return old_rating
+
+
+def save_rating(user_id, game_id, rating):
+    """
+    Writes a rating change with write_rating and commits it in one
+    transaction, or in the next group commit if they are turned on. Returns
+    the old rating.
+
+    >>> save_rating(1, 3, 9)
+    7
+    """
+    if rating_committer is None:
+        old_rating = write_rating(user_id, game_id, rating)
+        session.commit()
+        return old_rating
+
+    old_rating = rating_committer.submit(write_rating, user_id, game_id,
+                                         rating)
+    # End the request's own transaction, so it sees the committed write
     session.commit()
+    return old_rating
+
+
+def get_rating_trend(game_id, period='day', limit=30):
+    """
+    Returns the game's latest limit hourly or daily buckets of rating
+    events, oldest first, read from the rollups only.
+    """
+    buckets = session.query(RatingRollup).filter_by(
+        game_id=game_id, period=period).order_by(
+        desc(RatingRollup.start)).limit(limit).all()
+    return [bucket.serialize for bucket in reversed(buckets)]
+
+
+def get_page_args():
+    """
+    Returns the cursor and page size from the request's query string. The
+    cursor is the id of the last item on the previous page, or None for the
+    first page. The page size is capped at JSON_MAX_PAGE_SIZE.
+
+    /gamerater/json/?cursor=50&limit=25 -> (50, 25)
+    """
+    cursor = request.args.get('cursor', type=int)
+    limit = request.args.get('limit', app.config['JSON_PAGE_SIZE'], type=int)
+    limit = max(1, min(limit, app.config['JSON_MAX_PAGE_SIZE']))
+    return cursor, limit
+
+
+def get_page(query, id_column, cursor, limit):
+    """
+    Returns a page of up to limit items from query, ordered by id_column
+    and starting after the cursor id, along with the cursor for the next
+    page (None if this is the last page). Uses the id index to seek to the
+    page instead of an OFFSET, so every page costs the same.
+    """
+    if cursor is not None:
+        query = query.filter(id_column > cursor)
+    items = query.order_by(id_column).limit(limit + 1).all()
+
+    if len(items) > limit:
+        items = items[:limit]
+        return items, items[-1].id
+    return items, None
+
+
+def get_next_page_url(cursor, limit, **values):
+    """
+    Returns the url for the page after cursor, or None if there isn't one.
+    """
+    if cursor is None:
+        return None
+    return url_for(request.endpoint, cursor=cursor, limit=limit, **values)
 
 
 def make_json_response(message, code):
@@ -132,9 +587,11 @@ def make_json_response(message, code):
 def create_user(login_session):
     new_user = User(name=login_session['username'],
                     email=login_session['email'],
-                    picture=login_session['picture'])
+                    picture=login_session['picture'],
+                    modified=datetime.now())
     session.add(new_user)
     session.commit()
+    invalidate_home_fragments()
     return new_user
 
 
@@ -146,6 +603,8 @@ def login_or_create_user(login_session):
     else:
         user = get_user_by_id(user_id)
 
+    # Log in under a new session id
+    login_session.regenerate()
     login_session['user_id'] = user.id
 
     if user.name:
@@ -163,6 +622,48 @@ def login_or_create_user(login_session):
     return output
 
 
+# Highest rated games overall and in each category, kept up to date by the
+# routes that change ratings; max_age bounds how stale they can get in other
+# worker processes.
+leaderboards = Leaderboards(load_leaderboard_games, max_age=300)
+leaderboards.rebuild()
+session.remove()
+
+
+@app.teardown_appcontext
+def remove_session(exception=None):
+    """Closes the request's database session and returns its connection."""
+    session.remove()
+
+
+def dispose_connections():
+    """
+    Closes the pooled database and session store connections, so a forked
+    worker process opens its own instead of sharing its parent's.
+    """
+    session.remove()
+    database_setup.engine.dispose()
+    app.session_interface.store.dispose()
+
+
+def create_app(config=None):
+    """
+    Returns the app set up for a prefork server: debug off, the secret key
+    from GAMERATER_SECRET_KEY, config applied on top of the defaults, and
+    every template compiled. Call once in the master process before the
+    workers are forked; each worker then opens its own connections.
+
+    >>> application = create_app({'LEADERBOARD_SIZE': 20})
+    """
+    app.debug = False
+    app.secret_key = prefork.get_secret_key('GAMERATER_SECRET_KEY')
+    if config:
+        app.config.update(config)
+    prefork.preload_templates(app)
+    prefork.register_after_fork(dispose_connections)
+    return app
+
+
 # Route handling functions
 @app.route('/gconnect', methods=['POST'])
 def gconnect():
@@ -174,19 +675,21 @@ def gconnect():
 
     try:
         # Upgrade the authorization code into a credentials object
-        oauth_flow = flow_from_clientsecrets('client_secrets.json', scope='')
-        oauth_flow.redirect_uri = 'postmessage'
-        credentials = oauth_flow.step2_exchange(code)
+        oauth_flow = make_google_flow(google_secrets.config)
+        credentials = oauth_flow.step2_exchange(
+            code, http=provider_client.http())
     except FlowExchangeError:
         return make_json_response(
             'Failed to upgrade the authorization code', 401)
+    except (httplib2.HttpLib2Error, socket.error):
+        return make_json_response('Could not reach Google.', 502)
 
     # Check that the access token is valid
     access_token = credentials.access_token
-    url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?access_token=%s' % (
-        access_token))
-    h = httplib2.Http()
-    result = json.loads(h.request(url, 'GET')[1])
+    try:
+        result = provider_client.google_tokeninfo(access_token)
+    except ProviderError:
+        return make_json_response('Could not reach Google.', 502)
 
     # If there was an error in the access token info, abort.
     if result.get('error') is not None:
@@ -199,7 +702,7 @@ def gconnect():
         return make_json_response(message, 401)
 
     # Verify that the access token is valid for this app
-    if result['issued_to'] != CLIENT_ID:
+    if result['issued_to'] != google_secrets.config['client_id']:
         message = "Token's client ID does not match app's."
         print message
         return make_json_response(message, 401)
@@ -215,10 +718,10 @@ def gconnect():
     login_session['gplus_id'] = gplus_id
 
     # Get user info
-    userinfo_url = "https://www.googleapis.com/oauth2/v1/userinfo"
-    params = {'access_token': credentials.access_token, 'alt': 'json'}
-    answer = requests.get(userinfo_url, params=params)
-    data = json.loads(answer.text)
+    try:
+        data = provider_client.google_userinfo(credentials.access_token)
+    except ProviderError:
+        return make_json_response('Could not reach Google.', 502)
 
     login_session['username'] = data['name']
     login_session['picture'] = data['picture']
@@ -243,13 +746,12 @@ def gdisconnect():
         return make_json_response("Current user not connected.", 401)
 
     # Execute HTTP GET request to revoke current token.
-    access_token = credentials.access_token
-    url = ('https://accounts.google.com/o/oauth2/revoke?token=%s' % (
-        access_token))
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[0]
+    try:
+        revoked = provider_client.google_revoke(credentials.access_token)
+    except ProviderError:
+        revoked = False
 
-    if result['status'] == '200':
+    if revoked:
         return make_json_response('Successfully disconnected.', 200)
     else:
         # For whatever reason, the given token was invalid.
@@ -267,40 +769,26 @@ def fbconnect():
     # /oauth/access_token?grant_type=fb_exchange_token&client_id=
     # {app-id}&client_secret={app-secret}&fb_exchange_token=
     # {short-lived-token}
-    app_id = json.loads(
-        open('fb_client_secrets.json', 'r').read())['web']['app_id']
-    app_secret = json.loads(
-        open('fb_client_secrets.json', 'r').read())['web']['app_secret']
-    url = ('https://graph.facebook.com/oauth/access_token?grant_type='
-           'fb_exchange_token&client_id='
-           '%s&client_secret=%s&fb_exchange_token=%s' % (
-            app_id, app_secret, access_token))
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[1]
-
-    # Use token to user info from API
-    userinfo_url = "https://graph.facebook.com/v2.4/me"
-    # Strip expire tag from access token
-    token = result.split("&")[0]
-
-    url = 'https://graph.facebook.com/v2.4/me?%s&fields=name,id,email' % token
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[1]
-    data = json.loads(result)
+    try:
+        secrets = facebook_secrets.config
+    except ConfigError as e:
+        print e
+        return make_json_response('Facebook login is not configured.', 500)
+
+    try:
+        token = provider_client.facebook_exchange_token(
+            secrets['app_id'], secrets['app_secret'], access_token)
+
+        # Get the user's info and picture at the same time
+        data, picture = provider_client.facebook_user(token)
+    except ProviderError:
+        return make_json_response('Could not reach Facebook.', 502)
+
     login_session['provider'] = 'facebook'
     login_session['username'] = data["name"]
     login_session['email'] = data["email"]
     login_session['facebook_id'] = data["id"]
-    login_session['provider'] = 'facebook'
-
-    # Get user picture
-    url = ('https://graph.facebook.com/v2.4/me/picture?%s&redirect=0'
-           '&height=100&width=100' % token)
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[1]
-    data = json.loads(result)
-
-    login_session['picture'] = data['data']['url']
+    login_session['picture'] = picture
 
     # See if user exists, and create the user if not.
     output = login_or_create_user(login_session)
@@ -312,9 +800,10 @@ def fbconnect():
 @app.route('/fbdisconnect/')
 def fbdisconnect():
     facebook_id = login_session['facebook_id']
-    url = 'https://graph.facebook.com/%s/permissions' % facebook_id
-    h = httplib2.Http()
-    result = h.request(url, 'DELETE')[1]
+    try:
+        provider_client.facebook_revoke(facebook_id)
+    except ProviderError:
+        pass
 
 
 @app.route('/disconnect/')
@@ -375,8 +864,10 @@ def update_user():
 
         print "adding username to session"
         user.name = username
+        user.modified = datetime.now()
         session.add(user)
         session.commit()
+        invalidate_home_fragments()
 
         login_session['username'] = username
 
@@ -390,65 +881,115 @@ def update_user():
 @app.route('/gamerater/')
 def gamerater_home():
     # Get the 10 most recent games
-    recent_ten_ratings = session.query(UsersGames).order_by(
-        desc(UsersGames.modified)).limit(10)
-    recent_games = []
-    for rating in recent_ten_ratings:
-        recent_game = {
-            "user": get_user_by_id(rating.user_id),
-            "game": get_game_by_id(rating.game_id),
-            "rating": rating.rating,
-            "modified": rating.modified
-        }
-        recent_games.append(recent_game)
+    recent_games = fragment_cache.get_or_set(
+        'recent_ratings', get_recent_ratings)
 
     # Get the 10 highest ratings
-    top_ten_games = session.query(Game).order_by(
-        desc(Game.avg_rating)).limit(10)
+    top_ten_games = get_top_games()
 
-    # Get all users
-    all_users = session.query(User).all()
-
-    users = []
-
-    for user in all_users:
-        try:
-            favorite_game = get_top_game_by_user_id(user.id).name
-            latest_game = get_latest_game_by_user_id(user.id).name
-        except:
-            favorite_game = "This user does not have a rating yet."
-            latest_game = "This user does not have a rating yet."
-
-        user_data = {
-            'user': user,
-            'favorite_game': favorite_game,
-            'latest_game': latest_game
-        }
-        users.append(user_data)
+    # Get all users with their favorite and latest games
+    users = fragment_cache.get_or_set(
+        'user_summaries', get_user_summaries)
 
     return render_template("home.html",
                            recent_games=recent_games,
                            top_ten_games=top_ten_games,
-                           users=users)
+                           user_cards=render_user_cards(users))
 
 
 @app.route('/gamerater/json/')
 def gamerater_home_json():
+    # Answer from the validators if the client is up to date
+    etag, last_modified = get_home_validators()
+    if is_not_modified(etag, last_modified):
+        return not_modified(etag, last_modified)
+
     # Get the 10 most recent games
     recent_ten_ratings = session.query(UsersGames).order_by(
         desc(UsersGames.modified)).limit(10)
 
     # Get the 10 highest ratings
-    top_ten_games = session.query(Game).order_by(
-        desc(Game.avg_rating)).limit(10)
+    top_ten_games = get_top_games()
+
+    # Get a page of users. Their ratings are paged separately at
+    # /gamerater/ratings/json/?user_id=<id>
+    cursor, limit = get_page_args()
+    users, next_cursor = get_page(session.query(User), User.id, cursor, limit)
+
+    response = stream_json(
+        UsersGames=iter_serialized(recent_ten_ratings),
+        Game=top_ten_games,
+        User=[user.serialize_summary for user in users],
+        next=get_next_page_url(next_cursor, limit))
+    return add_validators(response, etag, last_modified)
+
+
+@app.route('/gamerater/users/json/')
+def all_users_json():
+    # Stream every user, without their ratings
+    users = session.query(User).order_by(User.id)
+    return stream_json(User=iter_serialized(users, 'serialize_summary'))
 
-    # Get all users
-    all_users = session.query(User).all()
+
+@app.route('/gamerater/games/json/')
+def all_games_json():
+    # Stream every game
+    games = session.query(Game).order_by(Game.id)
+    return stream_json(Game=iter_serialized(games))
+
+
+@app.route('/gamerater/ratings/json/')
+def ratings_json():
+    # Get a page of ratings, optionally for one user or game
+    cursor, limit = get_page_args()
+    user_id = request.args.get('user_id', type=int)
+    game_id = request.args.get('game_id', type=int)
+
+    ratings = session.query(UsersGames)
+    if user_id is not None:
+        ratings = ratings.filter(UsersGames.user_id == user_id)
+    if game_id is not None:
+        ratings = ratings.filter(UsersGames.game_id == game_id)
+    ratings, next_cursor = get_page(ratings, UsersGames.id, cursor, limit)
 
     return jsonify(
-        UsersGames=[rating.serialize for rating in recent_ten_ratings],
-        Game=[game.serialize for game in top_ten_games],
-        User=[user.serialize for user in all_users])
+        UsersGames=[rating.serialize for rating in ratings],
+        next=get_next_page_url(next_cursor, limit,
+                               user_id=user_id, game_id=game_id))
+
+
+@app.route('/gamerater/search/')
+def search_games_json():
+    # Search the games for the text typed so far
+    text = request.args.get('q', '')
+    limit = request.args.get('limit', app.config['SEARCH_LIMIT'], type=int)
+    limit = max(1, min(limit, app.config['SEARCH_MAX_LIMIT']))
+
+    games, fuzzy = search.search_games(session.connection(), text, limit)
+    return jsonify(Game=games, fuzzy=fuzzy)
+
+
+@app.route('/gamerater/top/json/')
+def top_games_json():
+    # Get the highest rated games, optionally in one category
+    category = request.args.get('category')
+    limit = request.args.get('limit', app.config['LEADERBOARD_SIZE'],
+                             type=int)
+    limit = max(1, min(limit, app.config['LEADERBOARD_MAX_SIZE']))
+    return jsonify(Game=get_top_games(limit, category), category=category)
+
+
+@app.route('/debug/cache-stats')
+@debug_only
+def cache_stats():
+    return jsonify(fragment_cache=fragment_cache.stats,
+                   card_cache=card_cache.stats)
+
+
+@app.route('/debug/sql-stats')
+@debug_only
+def sql_stats_json():
+    return jsonify(sql_stats.stats)
 
 
 @app.route('/gamerater/game/<int:game_id>/')
@@ -460,14 +1001,16 @@ def game_info(game_id):
         flash("We're sorry, that's not a valid game id!")
         return redirect(url_for('gamerater_home'))
 
-    # Get the ratings info
+    # Get the ratings info, with their users
     rating_data = get_ratings_by_game_id(game_id=game_id)
 
     # Set up data for the page
     ratings = []
     for rating in rating_data:
+        if rating.user is None:
+            continue
         user_rating = {
-            "user": get_user_by_id(rating.user_id),
+            "user": rating.user,
             "user_id": rating.user_id,
             "rating": rating.rating
         }
@@ -477,14 +1020,53 @@ def game_info(game_id):
 
 @app.route('/gamerater/game/<int:game_id>/json/')
 def game_info_json(game_id):
-    # Try getting the game info. If an exception occurs, return error
+    # Check the game exists, and answer from the validators if the client
+    # is up to date
+    etag, last_modified = get_game_validators(game_id)
+    if etag is None:
+        flash("We're sorry, that's not a valid game id!")
+        return redirect(url_for('gamerater_home'))
+    if is_not_modified(etag, last_modified):
+        return not_modified(etag, last_modified)
+
+    game = get_game_by_id(game_id)
+    return add_validators(jsonify(game.serialize), etag, last_modified)
+
+
+@app.route('/gamerater/game/<int:game_id>/similar/')
+def similar_games_json(game_id):
+    # Try getting the game. If an exception occurs, return error
     try:
         game = get_game_by_id(game_id)
     except:
         flash("We're sorry, that's not a valid game id!")
         return redirect(url_for('gamerater_home'))
 
-    return jsonify(game.serialize)
+    # Get the games rated most like it
+    limit = request.args.get('limit', app.config['RECOMMENDATIONS_SIZE'],
+                             type=int)
+    limit = max(1, min(limit, app.config['RECOMMENDATIONS_MAX_SIZE']))
+    return jsonify(game=game.serialize,
+                   Game=get_similar_games(game_id, limit))
+
+
+@app.route('/gamerater/game/<int:game_id>/trend/')
+def game_trend_json(game_id):
+    # Try getting the game. If an exception occurs, return error
+    try:
+        game = get_game_by_id(game_id)
+    except:
+        flash("We're sorry, that's not a valid game id!")
+        return redirect(url_for('gamerater_home'))
+
+    # Get the game's ratings per hour or day, from the rollups
+    period = request.args.get('period', 'day')
+    if period not in trends.PERIODS:
+        return make_json_response("period must be hour or day", 400)
+    limit = request.args.get('limit', app.config['TREND_SIZE'], type=int)
+    limit = max(1, min(limit, app.config['TREND_MAX_SIZE']))
+    return jsonify(game=game.serialize, period=period,
+                   Trend=get_rating_trend(game_id, period, limit))
 
 
 @app.route('/gamerater/user/<int:user_id>/')
@@ -496,28 +1078,18 @@ def user_info(user_id):
         flash("We're sorry, that user id does not exist.")
         return redirect(url_for('gamerater_home'))
 
-    # Get the user's ratings
+    # Get the user's ratings, highest first, with their games
     try:
         users_ratings = get_ratings_by_user_id(user.id)
     except:
         users_ratings = None
 
-    # Setup the ratings for the page
+    # Setup the ratings for the page. The first is the user's top rating.
     if users_ratings:
-        ratings = []
-        for rating in users_ratings:
-            new_rating = {
-                'rating': rating.rating,
-                'game': get_game_by_id(rating.game_id)
-            }
-            ratings.append(new_rating)
+        ratings = get_rated_games(users_ratings)
+        game = users_ratings[0].game
     else:
         ratings = None
-
-    # Get the user's top rating
-    try:
-        game = get_top_game_by_user_id(user_id=user_id)
-    except:
         game = None
 
     return render_template("user.html",
@@ -528,19 +1100,42 @@ def user_info(user_id):
 
 @app.route('/gamerater/user/<int:user_id>/json/')
 def user_info_json(user_id):
-    # Get the user info
-    try:
-        user = get_user_by_id(user_id)
-    except:
+    # Check the user exists, and answer from the validators if the client
+    # is up to date
+    etag, last_modified = get_user_validators(user_id)
+    if etag is None:
         flash("We're sorry, that user id does not exist.")
         return redirect(url_for('gamerater_home'))
+    if is_not_modified(etag, last_modified):
+        return not_modified(etag, last_modified)
+
+    # Get the user info
+    user = get_user_by_id(user_id)
 
     # Get the user's top rating
     try:
         game = get_top_game_by_user_id(user_id=user_id)
-        return jsonify(user=user.serialize, favorite_game=game.serialize)
+        response = jsonify(user=user.serialize, favorite_game=game.serialize)
     except:
-        return jsonify(user.serialize)
+        response = jsonify(user.serialize)
+    return add_validators(response, etag, last_modified)
+
+
+@app.route('/gamerater/user/<int:user_id>/recommendations/')
+def user_recommendations_json(user_id):
+    # Try getting the user. If an exception occurs, return error
+    try:
+        user = get_user_by_id(user_id)
+    except:
+        flash("We're sorry, that user id does not exist.")
+        return redirect(url_for('gamerater_home'))
+
+    # Get the games the user might also like
+    limit = request.args.get('limit', app.config['RECOMMENDATIONS_SIZE'],
+                             type=int)
+    limit = max(1, min(limit, app.config['RECOMMENDATIONS_MAX_SIZE']))
+    return jsonify(user=user.serialize_summary,
+                   Game=get_recommended_games(user_id, limit))
 
 
 @app.route('/gamerater/add-game/', methods=methods)
@@ -596,18 +1191,15 @@ def add_game():
             new_game = Game(name=game_name,
                             category=category,
                             description=description,
-                            avg_rating=rating_int,
+                            avg_rating=0,
                             modified=datetime.now())
             session.add(new_game)
+            session.flush()
+            write_rating(login_session['user_id'], new_game.id, rating_int)
             session.commit()
-            game_to_rate = get_game_by_name(game_name=game_name)
-            new_rating = UsersGames(user_id=login_session['user_id'],
-                                    game_id=game_to_rate.id,
-                                    rating=rating_int,
-                                    modified=datetime.now())
-            session.add(new_rating)
-            session.commit()
-            flash('%s has been rated!' % game_to_rate.name)
+            invalidate_home_fragments()
+            leaderboards.update(new_game.serialize)
+            flash('%s has been rated!' % new_game.name)
             return redirect(url_for('my_games'))
     else:
         game_name = request.args.get('game_name')
@@ -666,29 +1258,18 @@ def rate_game():
                                     game_name=game_name,
                                     rating=rating))
 
-        # Check if there's an existing rating. Update if so.
-        try:
-            existing_rating = get_rating_by_user_and_game(
-                user_id=login_session['user_id'],
-                game_id=existing_game.id)
-            existing_rating.rating = rating_int
-            existing_rating.modified = datetime.now()
-            session.add(existing_rating)
-            session.commit()
-            flash("The rating for %s has been updated with %s!" % (
-                existing_game.name, existing_rating.rating))
-        except:
-            # Create a new rating if there isn't an existing one
-            new_rating = UsersGames(user_id=login_session['user_id'],
-                                    game_id=existing_game.id,
-                                    rating=rating_int,
-                                    modified=datetime.now())
-            session.add(new_rating)
-            session.commit()
-            flash("%s has been rated." % existing_game.name)
-
-        # Update the game's average rating
-        update_game_avg_rating(game_id=existing_game.id)
+        # Add or update the rating, the game's average rating and the
+        # event log in one transaction
+        old_rating = save_rating(login_session['user_id'], existing_game.id,
+                                 rating_int)
+        if old_rating is None:
+            message = "%s has been rated." % existing_game.name
+        else:
+            message = "The rating for %s has been updated with %s!" % (
+                existing_game.name, rating_int)
+        invalidate_home_fragments()
+        update_leaderboards(existing_game.id)
+        flash(message)
 
         return redirect(url_for('my_games'))
 
@@ -733,12 +1314,11 @@ def delete_rating(game_id):
             print "No was in submit \n"
             return redirect(url_for('my_games'))
 
-        # Delete the rating
-        session.delete(rating_to_delete)
-        session.commit()
-
-        # Update the game's average rating
-        update_game_avg_rating(game_id=game.id)
+        # Delete the rating and update the game's average rating in one
+        # transaction
+        save_rating(login_session['user_id'], game.id, None)
+        invalidate_home_fragments()
+        update_leaderboards(game.id)
 
         flash("Your rating for %s has been deleted." % game.name)
         return redirect(url_for('my_games'))
@@ -758,30 +1338,18 @@ def my_games():
     user_id = login_session['user_id']
     user = get_user_by_id(user_id)
 
-    # Get the user's ratings
+    # Get the user's ratings, highest first, with their games
     try:
         users_ratings = get_ratings_by_user_id(user_id)
     except:
         users_ratings = None
 
-    # Setup the ratings for the page
+    # Setup the ratings for the page. The first is the user's top rating.
     if users_ratings:
-        ratings = []
-        for rating in users_ratings:
-            new_rating = {
-                'rating': rating.rating,
-                'game': get_game_by_id(rating.game_id)
-            }
-            ratings.append(new_rating)
+        ratings = get_rated_games(users_ratings)
+        game = users_ratings[0].game
     else:
         ratings = None
-
-    # Get the user's top rating
-    try:
-        top_rating = session.query(UsersGames).filter_by(
-            user_id=user_id).order_by(desc(UsersGames.rating)).limit(1).one()
-        game = get_game_by_id(top_rating.game_id)
-    except:
         game = None
 
     return render_template("my_games.html",
@@ -800,17 +1368,31 @@ def my_games_json():
     user_id = login_session['user_id']
     user = get_user_by_id(user_id)
 
-    # Get the top rating
+    # Get the top rating's game
     try:
-        top_rating = session.query(UsersGames).filter_by(
-            user_id=user_id).order_by(desc(UsersGames.rating)).limit(1).one()
-        game = get_game_by_id(top_rating.game_id)
+        game = get_top_game_by_user_id(user_id=user_id)
         return jsonify(user=user.serialize, top_game=game.serialize)
     except:
         return jsonify(user.serialize)
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the Gamerater server.")
+    parser.add_argument('--processes', type=int, default=1,
+                        help="number of worker processes; with the default "
+                             "of 1, requests are served by threads")
+    args = parser.parse_args()
+
     app.secret_key = 'super_secret_key'
     app.debug = True
-    app.run(host='0.0.0.0', port=8000)
+
+    # Don't hand the connections opened at import to forked workers
+    dispose_connections()
+    similarity_refresher.start()
+    ranking.start_refresher(database_setup.engine)
+    trends.start_refresher(database_setup.engine)
+    if args.processes > 1:
+        app.run(host='0.0.0.0', port=8000, processes=args.processes,
+                use_reloader=False)
+    else:
+        app.run(host='0.0.0.0', port=8000, threaded=True)
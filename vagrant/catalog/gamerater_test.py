@@ -0,0 +1,1744 @@
+#!/usr/bin/env python
+#
+# Test cases for gamerater.py
+# Run from the catalog folder (i.e. `python gamerater_test.py`). The app
+# and each test use scratch databases in a temporary folder, which is
+# deleted when the tests finish, so favoritegames.db and sessions.db are
+# left untouched.
+
+import atexit
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+from datetime import datetime, timedelta
+from StringIO import StringIO
+
+from threading import Thread
+
+# Point the app at the scratch folder before it is imported
+TEST_DIRECTORY = tempfile.mkdtemp(prefix='gamerater_test')
+atexit.register(shutil.rmtree, TEST_DIRECTORY, True)
+os.environ['GAMERATER_DATABASE_URL'] = 'sqlite:///%s' % os.path.join(
+    TEST_DIRECTORY, 'favoritegames.db')
+os.environ['SESSION_STORE_URL'] = 'sqlite:///%s' % os.path.join(
+    TEST_DIRECTORY, 'sessions.db')
+
+from flask import Flask
+from sqlalchemy import desc, event, func
+
+import database_setup
+import gamerater
+import import_ratings
+import json_stream
+import migrations
+import ranking
+import recommendations
+import reconcile_ratings
+import search
+import trends
+from benchmark import load, synthetic
+from group_commit import GroupCommitter
+from leaderboard import Leaderboards
+from shared import prefork
+from shared.oauth_client import (ProviderClient, ProviderError,
+                                 call_concurrently)
+from shared.oauth_config import (SecretsFile, ConfigError,
+                                 validate_facebook_secrets)
+from shared.session_store import SQLiteSessionStore
+from shared.sql_stats import SQLStats
+from database_setup import Game, UsersGames, User
+
+
+def use_scratch_database():
+    """
+    Points gamerater at a new, empty database file and returns its engine.
+    """
+    db_file, db_path = tempfile.mkstemp(suffix='.db', dir=TEST_DIRECTORY)
+    os.close(db_file)
+    engine = database_setup.create_db_engine('sqlite:///%s' % db_path)
+    migrations.upgrade(engine)
+
+    database_setup.session.remove()
+    database_setup.session.configure(bind=engine)
+    gamerater.fragment_cache.invalidate()
+    gamerater.leaderboards.invalidate()
+    gamerater.card_cache.invalidate()
+    return engine
+
+
+def count_queries(engine, function):
+    """Calls function and returns the number of SQL statements it ran."""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        function()
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+    return len(statements)
+
+
+def add_users_with_ratings(session, count, games):
+    """Adds count users, each rating every game in games."""
+    now = datetime.now()
+    for i in xrange(count):
+        user = User(name="User %s" % i, email="user%s@example.com" % i)
+        session.add(user)
+        session.flush()
+        for j, game in enumerate(games):
+            session.add(UsersGames(user_id=user.id,
+                                   game_id=game.id,
+                                   rating=(i + j) % 11,
+                                   modified=now - timedelta(minutes=j)))
+    session.commit()
+
+
+def test_home_query_count_is_flat():
+    """
+    Test that the home page runs the same number of queries no matter
+    how many users there are.
+    """
+    engine = use_scratch_database()
+    session = gamerater.session
+    games = []
+    for name in ("Mass Effect", "Nioh", "Tomb Raider"):
+        game = Game(name=name, category="RPG", description=name,
+                    avg_rating=5, modified=datetime.now())
+        session.add(game)
+        games.append(game)
+    session.commit()
+    gamerater.leaderboards.rebuild()
+
+    client = gamerater.app.test_client()
+
+    add_users_with_ratings(session, 5, games)
+    gamerater.invalidate_home_fragments()
+    few_users = count_queries(engine, lambda: client.get('/gamerater/'))
+
+    # The request removed the session, so load the games again
+    games = session.query(Game).order_by(Game.id).all()
+    add_users_with_ratings(session, 50, games)
+    gamerater.invalidate_home_fragments()
+    many_users = count_queries(engine, lambda: client.get('/gamerater/'))
+
+    if few_users != many_users:
+        raise ValueError(
+            "The home page should run the same number of queries for 5 and "
+            "55 users. Got {0} and {1}".format(few_users, many_users))
+    print "1. The home page query count does not grow with the user count."
+
+    summaries = gamerater.get_user_summaries()
+    first = summaries[0]
+    if first['favorite_game'] != "Tomb Raider":
+        raise ValueError(
+            "A user's favorite game should be their highest rated game. "
+            "Got {0}".format(first['favorite_game']))
+    if first['latest_game'] != "Mass Effect":
+        raise ValueError(
+            "A user's latest game should be their most recently rated game. "
+            "Got {0}".format(first['latest_game']))
+    print "2. User summaries list each user's favorite and latest games."
+
+
+def log_in(client, user_id, username="Tester"):
+    """Logs the user with the given id in on the test client."""
+    with client.session_transaction() as login_session:
+        login_session['username'] = username
+        login_session['user_id'] = user_id
+
+
+def test_rating_totals_follow_writes():
+    """
+    Test that rating, re-rating and deleting keep the game's rating
+    totals and average in step, and that reconcile finds no drift.
+    """
+    use_scratch_database()
+    session = gamerater.session
+    game = Game(name="Nioh", category="RPG", description="Nioh",
+                avg_rating=0, modified=datetime.now())
+    first = User(name="First", email="first@example.com")
+    second = User(name="Second", email="second@example.com")
+    session.add_all([game, first, second])
+    session.commit()
+    game_id, first_id, second_id = game.id, first.id, second.id
+
+    client = gamerater.app.test_client()
+    for user_id, rating in ((first_id, 4), (second_id, 9), (first_id, 8)):
+        log_in(client, user_id)
+        client.post('/gamerater/rate-game/', data={
+            'submit': 'Rate', 'name': 'Nioh', 'rating': rating})
+    game = session.query(Game).get(game_id)
+    if (game.rating_sum, game.rating_count, game.avg_rating) != (17, 2, 8.5):
+        raise ValueError(
+            "After two ratings and an update, the totals should be 17, 2 "
+            "and 8.5. Got {0}, {1} and {2}".format(
+                game.rating_sum, game.rating_count, game.avg_rating))
+    print "3. Rating and re-rating a game keep its totals up to date."
+
+    client.post('/gamerater/delete_rating/%s/' % game_id,
+                data={'submit': 'Yes'})
+    game = session.query(Game).get(game_id)
+    if (game.rating_sum, game.rating_count, game.avg_rating) != (9, 1, 9):
+        raise ValueError(
+            "After deleting a rating, the totals should be 9, 1 and 9. "
+            "Got {0}, {1} and {2}".format(
+                game.rating_sum, game.rating_count, game.avg_rating))
+    print "4. Deleting a rating keeps the game's totals up to date."
+
+    if reconcile_ratings.find_drift(session):
+        raise ValueError("Reconcile should find no drift after writes.")
+    game = session.query(Game).get(game_id)
+    game.rating_sum = 3
+    session.commit()
+    drift = reconcile_ratings.find_drift(session)
+    if len(drift) != 1 or drift[0]['actual_sum'] != 9:
+        raise ValueError("Reconcile should report the drifted game.")
+    reconcile_ratings.fix_drift(session, drift)
+    if reconcile_ratings.find_drift(session):
+        raise ValueError("Reconcile should fix the drifted game.")
+    print "5. Reconcile reports and fixes drifted rating totals."
+
+
+def get_all_pages(client, url):
+    """
+    Follows the next links from url and returns the list of pages of
+    decoded JSON.
+    """
+    pages = []
+    while url:
+        pages.append(json.loads(client.get(url).data))
+        url = pages[-1]['next']
+    return pages
+
+
+def test_json_collections_are_paged():
+    """
+    Test that the home JSON pages through users and the ratings JSON pages
+    through ratings, with each page capped in size.
+    """
+    use_scratch_database()
+    session = gamerater.session
+    games = []
+    for name in ("Mass Effect", "Nioh"):
+        game = Game(name=name, category="RPG", description=name,
+                    avg_rating=5, modified=datetime.now())
+        session.add(game)
+        games.append(game)
+    session.commit()
+    add_users_with_ratings(session, 7, games)
+
+    client = gamerater.app.test_client()
+    pages = get_all_pages(client, '/gamerater/json/?limit=3')
+    page_sizes = [len(page['User']) for page in pages]
+    if page_sizes != [3, 3, 1]:
+        raise ValueError(
+            "Seven users in pages of three should be split 3, 3, 1. "
+            "Got {0}".format(page_sizes))
+    user_ids = [user['id'] for page in pages for user in page['User']]
+    if user_ids != sorted(set(user_ids)):
+        raise ValueError("Each user should appear once, in id order.")
+    print "6. The home JSON pages through users with next links."
+
+    user_id = user_ids[0]
+    pages = get_all_pages(
+        client, '/gamerater/ratings/json/?user_id=%s&limit=1' % user_id)
+    ratings = [rating for page in pages for rating in page['UsersGames']]
+    if (len(pages) != 2 or
+            set(rating['user_id'] for rating in ratings) != set([user_id])):
+        raise ValueError(
+            "A user's two ratings in pages of one should take two pages.")
+
+    gamerater.app.config['JSON_MAX_PAGE_SIZE'] = 5
+    page = json.loads(client.get('/gamerater/ratings/json/?limit=100').data)
+    gamerater.app.config['JSON_MAX_PAGE_SIZE'] = 200
+    if len(page['UsersGames']) != 5:
+        raise ValueError("Pages should be capped at JSON_MAX_PAGE_SIZE.")
+    print "7. The ratings JSON pages through ratings, capped in size."
+
+
+def test_json_exports_are_streamed():
+    """
+    Test that the user and game exports are streamed in chunks and decode
+    to every user and game.
+    """
+    use_scratch_database()
+    session = gamerater.session
+    for i in xrange(30):
+        session.add(Game(name="Game %s" % i, category="RPG",
+                         description="Game %s" % i, avg_rating=5,
+                         modified=datetime.now()))
+    session.commit()
+    add_users_with_ratings(session, 12, [])
+
+    client = gamerater.app.test_client()
+    response = client.get('/gamerater/games/json/')
+    if not response.is_streamed:
+        raise ValueError("The games export should be streamed.")
+    games = json.loads(response.data)['Game']
+    if [game['name'] for game in games] != ["Game %s" % i for i in xrange(30)]:
+        raise ValueError("The games export should hold every game in order.")
+
+    users = json.loads(client.get('/gamerater/users/json/').data)['User']
+    if len(users) != 12 or 'ratings' in users[0]:
+        raise ValueError(
+            "The users export should hold every user without ratings.")
+    for collection in (iter([{'id': 1}]), ({'id': 1} for i in range(1)),
+                       [{'id': 1}]):
+        streamed = ''.join(json_stream.iter_json_object(
+            {'Game': collection, 'next': None}))
+        if streamed != '{"Game": [{"id": 1}], "next": null}':
+            raise ValueError(
+                "Iterators should be written out as arrays. Got {0}".format(
+                    streamed))
+    print "8. The user and game exports are streamed."
+
+
+def test_sessions_are_request_scoped():
+    """
+    Test that concurrent requests from several threads each get their own
+    session, and that the session is removed after each request.
+    """
+    use_scratch_database()
+    session = gamerater.session
+    game = Game(name="Nioh", category="RPG", description="Nioh",
+                avg_rating=0, modified=datetime.now())
+    session.add(game)
+    session.commit()
+    add_users_with_ratings(session, 8, [])
+    user_ids = [user.id for user in session.query(User)]
+    session.remove()
+
+    errors = []
+
+    def rate_and_browse(user_id, rating):
+        client = gamerater.app.test_client()
+        log_in(client, user_id)
+        try:
+            for i in xrange(5):
+                responses = [
+                    client.post('/gamerater/rate-game/', data={
+                        'submit': 'Rate', 'name': 'Nioh', 'rating': rating}),
+                    client.get('/gamerater/'),
+                    client.get('/gamerater/json/')]
+                for response in responses:
+                    # Read streamed bodies to the end, like a server would
+                    response.get_data()
+                    response.close()
+                    if response.status_code >= 500:
+                        errors.append(response.status_code)
+            if session.registry.has():
+                errors.append("session left open after request")
+        except Exception as e:
+            errors.append(e)
+
+    threads = [Thread(target=rate_and_browse, args=(user_id, i % 11))
+               for i, user_id in enumerate(user_ids)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise ValueError(
+            "Concurrent requests should not fail. Got {0}".format(errors))
+    game = session.query(Game).one()
+    if game.rating_count != 8 or game.rating_sum != sum(range(8)):
+        raise ValueError(
+            "Concurrent ratings should all be counted. Got {0} ratings "
+            "summing to {1}".format(game.rating_count, game.rating_sum))
+    print "9. Concurrent requests each use their own session."
+
+
+def test_migrations_upgrade_old_database():
+    """
+    Test that migrations bring a database made before the rating totals
+    and indexes up to date, and that the lookups use the new indexes.
+    """
+    db_file, db_path = tempfile.mkstemp(suffix='.db', dir=TEST_DIRECTORY)
+    os.close(db_file)
+    engine = database_setup.create_db_engine('sqlite:///%s' % db_path)
+    for statement in (
+            'CREATE TABLE user (name VARCHAR(80) NOT NULL, '
+            'email VARCHAR(255), picture VARCHAR(255), '
+            'id INTEGER NOT NULL PRIMARY KEY)',
+            'CREATE TABLE game (id INTEGER NOT NULL PRIMARY KEY, '
+            'name VARCHAR(80) NOT NULL, category VARCHAR(40), '
+            'description VARCHAR(1020), avg_rating FLOAT, modified DATETIME)',
+            'CREATE TABLE usersgames (id INTEGER NOT NULL PRIMARY KEY, '
+            'user_id INTEGER NOT NULL, game_id INTEGER NOT NULL, '
+            'rating INTEGER, modified DATETIME)',
+            "INSERT INTO game VALUES (1, 'Nioh', 'RPG', 'Nioh', 6.5, NULL)",
+            "INSERT INTO usersgames VALUES (1, 1, 1, 4, NULL)",
+            "INSERT INTO usersgames VALUES (2, 2, 1, 9, NULL)",
+            "INSERT INTO usersgames VALUES (3, 2, 1, 5, NULL)",
+            'CREATE TABLE rating_event (id INTEGER NOT NULL PRIMARY KEY, '
+            'user_id INTEGER NOT NULL, game_id INTEGER NOT NULL, '
+            'old_rating INTEGER, new_rating INTEGER, '
+            'created DATETIME NOT NULL)',
+            'CREATE INDEX ix_rating_event_created ON rating_event (created)'):
+        engine.execute(statement)
+
+    if migrations.upgrade(engine) != [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]:
+        raise ValueError("An old database should get every migration.")
+    if migrations.upgrade(engine) != []:
+        raise ValueError("Migrations should only be applied once.")
+
+    # A process that read schema_version before another applied the
+    # migrations must not apply them again
+    get_applied_versions = migrations.get_applied_versions
+    migrations.get_applied_versions = lambda engine: set()
+    try:
+        if migrations.upgrade(engine) != []:
+            raise ValueError(
+                "Migrations should be checked again before being applied.")
+    finally:
+        migrations.get_applied_versions = get_applied_versions
+
+    # A failing migration leaves no trace, even of its DDL
+    def add_column_and_fail(connection):
+        connection.execute('ALTER TABLE game ADD COLUMN doomed INTEGER')
+        raise ValueError("migration failed")
+
+    try:
+        migrations.apply_migration(engine, 99, add_column_and_fail)
+    except ValueError:
+        pass
+    columns = [row[1] for row in engine.execute('PRAGMA table_info(game)')]
+    if 'doomed' in columns or 99 in migrations.get_applied_versions(engine):
+        raise ValueError("A failed migration should be rolled back.")
+    totals = engine.execute(
+        'SELECT rating_sum, rating_count FROM game').fetchone()
+    if tuple(totals) != (9, 2):
+        raise ValueError(
+            "Migrating should fill in the rating totals, keeping each "
+            "user's latest rating of a game. Got {0}".format(tuple(totals)))
+    table_sql = engine.execute(
+        "SELECT sql FROM sqlite_master WHERE name = 'rating_event'").scalar()
+    events = engine.execute('SELECT COUNT(*) FROM rating_event').scalar()
+    if 'AUTOINCREMENT' not in table_sql or events != 3:
+        raise ValueError(
+            "The rating event log should be rebuilt with AUTOINCREMENT ids, "
+            "keeping its events. Got {0} events".format(events))
+    print "10. Migrations add the rating totals to an old database once."
+
+    plans = {
+        'ix_usersgames_user_id_rating':
+            'SELECT game_id FROM usersgames WHERE user_id = 1 '
+            'ORDER BY rating DESC LIMIT 1',
+        'ix_usersgames_user_id_modified':
+            'SELECT game_id FROM usersgames WHERE user_id = 1 '
+            'ORDER BY modified DESC LIMIT 1',
+        'ix_usersgames_game_id_user_id':
+            'SELECT * FROM usersgames WHERE game_id = 1 AND user_id = 1',
+        'ix_game_name': "SELECT * FROM game WHERE name = 'Nioh'",
+        'ix_game_rank_score':
+            'SELECT * FROM game ORDER BY rank_score DESC LIMIT 10',
+        'ix_user_email': "SELECT * FROM user WHERE email = 'a@example.com'"}
+    for index, query in plans.items():
+        plan = ' '.join(str(row[-1]) for row in
+                        engine.execute('EXPLAIN QUERY PLAN ' + query))
+        if index not in plan:
+            raise ValueError(
+                "{0} should be used for {1}. Got {2}".format(
+                    index, query, plan))
+    print "11. Lookups by user, game, name and email use the new indexes."
+
+
+def test_home_fragments_are_cached():
+    """
+    Test that the home page fragments are served from the cache until a
+    rating changes them.
+    """
+    engine = use_scratch_database()
+    session = gamerater.session
+    game = Game(name="Nioh", category="RPG", description="Nioh",
+                avg_rating=0, modified=datetime.now())
+    session.add(game)
+    session.commit()
+    add_users_with_ratings(session, 3, [])
+    user_id = session.query(User).first().id
+
+    client = gamerater.app.test_client()
+    client.get('/gamerater/')
+    hits = gamerater.fragment_cache.hits
+    cached = count_queries(engine, lambda: client.get('/gamerater/'))
+    stats = json.loads(client.get('/debug/cache-stats').data)
+    if cached != 0 or stats['fragment_cache']['hits'] != hits + 2:
+        raise ValueError(
+            "A second home page view should be served from the cache. Got "
+            "{0} queries and {1}".format(cached, stats['fragment_cache']))
+    print "12. The home page fragments are cached."
+
+    log_in(client, user_id)
+    client.post('/gamerater/rate-game/', data={
+        'submit': 'Rate', 'name': 'Nioh', 'rating': 7})
+    page = client.get('/gamerater/').data
+    if 'Nioh' not in page.split('Top Rated Games')[0]:
+        raise ValueError("A new rating should show up in recent updates.")
+    print "13. Rating a game invalidates the cached home page fragments."
+
+
+def test_json_conditional_get():
+    """
+    Test that the game, user and home JSON answer 304 Not Modified from
+    their validators, and change their validators after a rating.
+    """
+    engine = use_scratch_database()
+    session = gamerater.session
+    game = Game(name="Nioh", category="RPG", description="Nioh",
+                avg_rating=0, modified=datetime.now() - timedelta(days=1))
+    session.add(game)
+    session.commit()
+    add_users_with_ratings(session, 2, [game])
+    game_id = game.id
+    user_id = session.query(User).first().id
+    session.remove()
+
+    client = gamerater.app.test_client()
+    urls = ['/gamerater/game/%s/json/' % game_id,
+            '/gamerater/user/%s/json/' % user_id,
+            '/gamerater/json/?limit=1']
+    etags = {}
+    for url in urls:
+        response = client.get(url)
+        etag = response.headers.get('ETag')
+        if response.status_code != 200 or not etag:
+            raise ValueError("{0} should send an ETag.".format(url))
+        etags[url] = etag
+
+        queries = []
+        not_modified = count_queries(engine, lambda: queries.append(
+            client.get(url, headers={'If-None-Match': etag})))
+        if queries[0].status_code != 304:
+            raise ValueError(
+                "{0} should be 304 for a matching ETag. Got {1}".format(
+                    url, queries[0].status_code))
+        if not_modified > 3:
+            raise ValueError(
+                "{0} should only run its validator queries for a 304. Got "
+                "{1} queries".format(url, not_modified))
+
+        last_modified = response.headers.get('Last-Modified')
+        response = client.get(url,
+                              headers={'If-Modified-Since': last_modified})
+        if response.status_code != 304:
+            raise ValueError(
+                "{0} should be 304 when not modified since {1}.".format(
+                    url, last_modified))
+    print "14. The JSON endpoints answer 304 when nothing has changed."
+
+    log_in(client, user_id)
+    client.post('/gamerater/rate-game/', data={
+        'submit': 'Rate', 'name': 'Nioh', 'rating': 3})
+    for url in urls:
+        response = client.get(url, headers={'If-None-Match': etags[url]})
+        if response.status_code != 200:
+            raise ValueError(
+                "{0} should change after a rating. Got {1}".format(
+                    url, response.status_code))
+    print "15. The JSON endpoints change their ETag after a rating."
+
+    # Imported ratings keep their own, older, times
+    home_url = '/gamerater/json/?limit=1'
+    etag = client.get(home_url, buffered=True).headers.get('ETag')
+    other = User(name="Importer", email="importer@example.com",
+                 modified=datetime.now() - timedelta(days=2))
+    session.add(other)
+    session.flush()
+    session.add(UsersGames(user_id=other.id, game_id=game_id, rating=5,
+                           modified=datetime.now() - timedelta(days=2)))
+    session.commit()
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        response = client.get(home_url, headers={'If-None-Match': etag},
+                              buffered=True)
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+    if response.status_code != 200:
+        raise ValueError("Rows added with older times should change the "
+                         "home ETag.")
+    with engine.connect() as connection:
+        plan = connection.execute('EXPLAIN QUERY PLAN ' + statements[0],
+                                  []).fetchall()
+    scans = [row[3] for row in plan if row[3].startswith('SCAN') and
+             row[3] != 'SCAN CONSTANT ROW']
+    if scans:
+        raise ValueError(
+            "The home validators should only look up indexes. Got "
+            "{0}".format(scans))
+    print "16. The home ETag is read from indexes and covers imported rows."
+
+
+def test_games_are_loaded_in_bulk():
+    """
+    Test that games are loaded in chunks, in the order asked for, with
+    missing ids reported and loaded games reused.
+    """
+    engine = use_scratch_database()
+    session = gamerater.session
+    for i in xrange(1200):
+        session.add(Game(name="Game %s" % i, category="RPG",
+                         description="Game %s" % i, avg_rating=5,
+                         modified=datetime.now()))
+    session.commit()
+
+    ids = range(1200, 0, -1) + [5000]
+    result = []
+    queries = count_queries(
+        engine, lambda: result.extend(Game.get_games_by_id(ids)))
+    games, missing = result
+    if [game.id for game in games] != ids[:-1] or missing != [5000]:
+        raise ValueError(
+            "Games should be returned in the order asked for, with missing "
+            "ids reported.")
+    if queries != 3:
+        raise ValueError(
+            "1200 games should be loaded in 3 chunks. Got {0} queries".format(
+                queries))
+    print "17. Games are loaded in chunks, in order, with missing ids."
+
+    queries = count_queries(engine, lambda: Game.get_games_by_id(ids[:10]))
+    if queries != 0:
+        raise ValueError(
+            "Games already in the session should be reused. Got {0} "
+            "queries".format(queries))
+    print "18. Games already loaded in the session are reused."
+
+    other_session = database_setup.DBSession(bind=engine)
+    try:
+        queries = count_queries(engine, lambda: database_setup.load_by_ids(
+            other_session, Game, ids[:10]))
+        other_games, missing = database_setup.load_by_ids(
+            other_session, Game, ids[:10])
+        loaded = all(game in other_session for game in other_games)
+    finally:
+        other_session.close()
+    if queries != 1 or missing or not loaded:
+        raise ValueError(
+            "Games should be loaded into the session passed in. Got {0} "
+            "queries".format(queries))
+    print "19. Games are loaded into the session they are asked for with."
+
+    add_users_with_ratings(session, 1, games[:40])
+    user_id = session.query(User).first().id
+    session.remove()
+    client = gamerater.app.test_client()
+    queries = count_queries(
+        engine, lambda: client.get('/gamerater/user/%s/' % user_id))
+    if queries > 5:
+        raise ValueError(
+            "The user page should load the user's games at once. Got {0} "
+            "queries".format(queries))
+    print "20. The user page loads the user's games at once."
+
+
+def test_ratings_are_imported_in_bulk():
+    """
+    Test that importing ratings creates missing users and games, keeps the
+    newest rating of each game by each user, skips bad rows, and leaves
+    the game totals correct.
+    """
+    engine = use_scratch_database()
+    session = gamerater.session
+    game = Game(name="Nioh", category="RPG", description="Nioh",
+                avg_rating=0, modified=datetime.now())
+    session.add(game)
+    session.commit()
+    add_users_with_ratings(session, 1, [game])
+    session.remove()
+
+    ratings_csv = StringIO(
+        "email,game,rating,timestamp\n"
+        "user0@example.com,Nioh,9,2030-01-01T00:00:00\n"
+        "new@example.com,Nioh,4,2017-05-01T12:30:00\n"
+        "new@example.com,Nioh,6,2017-05-02T12:30:00\n"
+        "new@example.com,Tomb Raider,8,\n"
+        "new@example.com,Tomb Raider,eleven,\n"
+        "new@example.com,Tomb Raider,11,\n")
+    imported, errors = import_ratings.import_ratings(
+        engine, ratings_csv, 'csv', batch_size=2)
+    if imported != 4 or len(errors) != 2:
+        raise ValueError(
+            "Four rows should be imported and two skipped. Got {0} and "
+            "{1}".format(imported, errors))
+
+    totals = dict((game.name, (game.rating_sum, game.rating_count))
+                  for game in session.query(Game))
+    if totals != {'Nioh': (15, 2), 'Tomb Raider': (8, 1)}:
+        raise ValueError(
+            "Imported ratings should replace older ones and update the "
+            "totals. Got {0}".format(totals))
+    if session.query(User).filter_by(email='new@example.com').count() != 1:
+        raise ValueError("Importing should create a missing user once.")
+    if reconcile_ratings.find_drift(session):
+        raise ValueError("Importing should leave no drift in the totals.")
+    print "21. Ratings are imported in bulk with users and games created."
+
+    ratings_jsonl = StringIO(
+        '{"email": "new@example.com", "game": "Nioh", "rating": 2, '
+        '"timestamp": "2030-01-01T00:00:00"}\n'
+        '{"email": "new@example.com", "game": \n'
+        '{"email": 7, "game": "Nioh", "rating": 5}\n'
+        '["new@example.com", "Nioh", 5]\n'
+        '\n'
+        '{"email": "other@example.com", "game": "Nioh", "rating": 10}\n')
+    imported, errors = import_ratings.import_ratings(
+        engine, ratings_jsonl, 'jsonl', batch_size=1)
+    lines = [error.split(':')[0] for error in errors]
+    if imported != 2 or lines != ['line 2', 'line 3', 'line 4']:
+        raise ValueError(
+            "Bad JSON lines and values should be reported and skipped. Got "
+            "{0} and {1}".format(imported, errors))
+    nioh = session.query(Game).filter_by(name="Nioh").one()
+    if (nioh.rating_sum, nioh.rating_count) != (21, 3):
+        raise ValueError(
+            "The rows after a bad line should be imported and counted. Got "
+            "{0}".format((nioh.rating_sum, nioh.rating_count)))
+    print "22. Malformed JSON lines and values are reported and skipped."
+
+
+def test_games_are_searchable():
+    """
+    Test that the search finds games by name prefix first, then by category
+    or description, falls back to similar names, and stays in step with
+    changes to the games.
+    """
+    use_scratch_database()
+    session = gamerater.session
+    for name, category, description, avg_rating in (
+            ("Nioh", "RPG", "Samurai action", 8),
+            ("Nioh 2", "RPG", "More samurai action", 9),
+            ("Onimusha", "Action", "Nioh-like samurai game", 7),
+            ("Tomb Raider", "Adventure", "Raiding tombs", 6),
+            ("Zelda", "Adventure", "Link to the past", 9),
+            ("Okami", "Adventure", "Painting wolf", 1)):
+        session.add(Game(name=name, category=category,
+                         description=description, avg_rating=avg_rating,
+                         modified=datetime.now()))
+    # Many better rated games of the same length as Okami
+    for i in xrange(search.FUZZY_CANDIDATES + 100):
+        session.add(Game(name="G%04d" % i, category="Filler",
+                         description="Filler", avg_rating=10,
+                         modified=datetime.now()))
+    session.commit()
+
+    client = gamerater.app.test_client()
+
+    def search_names(text):
+        data = json.loads(client.get(
+            '/gamerater/search/?q=%s' % text).data)
+        return [game['name'] for game in data['Game']], data['fuzzy']
+
+    names, fuzzy = search_names('nioh')
+    if names != ["Nioh", "Nioh 2", "Onimusha"] or fuzzy:
+        raise ValueError(
+            "An exact name should come first, then other names starting "
+            "with it, then description matches. Got {0}".format(names))
+    names, fuzzy = search_names('tom rai')
+    if names != ["Tomb Raider"]:
+        raise ValueError(
+            "Every word should match as a prefix. Got {0}".format(names))
+    print "23. Games are found by name prefix, category and description."
+
+    names, fuzzy = search_names('niho')
+    if not fuzzy or names[:1] != ["Nioh"]:
+        raise ValueError(
+            "A misspelled name should find similar names. Got {0}".format(
+                names))
+    for text, name in (('zleda', "Zelda"), ('pelda', "Zelda"),
+                       ('ukami', "Okami")):
+        names, fuzzy = search_names(text)
+        if not fuzzy or names[:1] != [name]:
+            raise ValueError(
+                "Typos in the first letters should find similar names. Got "
+                "{0} for {1}".format(names, text))
+    print "24. Misspelled names find similar games."
+
+    game = session.query(Game).filter_by(name="Tomb Raider").one()
+    game.name = "Rise of the Tomb Raider"
+    session.commit()
+    if (search_names('rise')[0] != ["Rise of the Tomb Raider"] or
+            search_names('rise of the tomb riader')[0][:1] !=
+            ["Rise of the Tomb Raider"]):
+        raise ValueError("Renamed games should be found by their new name.")
+    game_id = session.query(Game).filter_by(name="Onimusha").one().id
+    session.delete(session.query(Game).get(game_id))
+    session.commit()
+    if ("Onimusha" in search_names('samurai')[0] or
+            "Onimusha" in search_names('onimusah')[0]):
+        raise ValueError("Deleted games should not be found.")
+    if session.execute('SELECT COUNT(*) FROM game_trigram WHERE game_id = '
+                       ':game_id', {'game_id': game_id}).scalar():
+        raise ValueError("Deleted games' trigrams should be removed.")
+    print "25. The search stays in step with changes to the games."
+
+
+def test_sqlite_profile_is_applied():
+    """
+    Test that SQLite connections get the default profile's settings: a
+    write-ahead log and a sync at checkpoints only.
+    """
+    engine = use_scratch_database()
+    with engine.connect() as connection:
+        journal_mode = connection.execute('PRAGMA journal_mode').scalar()
+        synchronous = connection.execute('PRAGMA synchronous').scalar()
+    if journal_mode != 'wal':
+        raise ValueError(
+            "The journal mode should be wal. Got {0}".format(journal_mode))
+    # 1 is NORMAL
+    if synchronous != 1:
+        raise ValueError(
+            "Synchronous should be NORMAL. Got {0}".format(synchronous))
+    print "26. SQLite connections use the write-ahead log profile."
+
+
+def test_leaderboards_follow_ratings():
+    """
+    Test that the leaderboards list the highest rated games overall and
+    per category without queries, and move games as they are rated.
+    """
+    engine = use_scratch_database()
+    session = gamerater.session
+    for name, category, avg_rating in (("Nioh", "RPG", 8),
+                                       ("Mass Effect", "RPG", 7),
+                                       ("Tomb Raider", "Adventure", 9),
+                                       ("Portal", "Puzzle", 6)):
+        session.add(Game(name=name, category=category, description=name,
+                         avg_rating=avg_rating, rating_sum=avg_rating,
+                         rating_count=1, modified=datetime.now()))
+    session.commit()
+    with engine.begin() as connection:
+        ranking.rank_games(connection)
+    add_users_with_ratings(session, 1, [])
+    user_id = session.query(User).first().id
+    gamerater.leaderboards.rebuild()
+
+    client = gamerater.app.test_client()
+
+    def top_names(query_string=''):
+        data = json.loads(client.get(
+            '/gamerater/top/json/' + query_string).data)
+        return [game['name'] for game in data['Game']]
+
+    queries = count_queries(engine, lambda: top_names('?category=RPG'))
+    if queries != 0:
+        raise ValueError(
+            "Top games should be served without queries. Got {0}".format(
+                queries))
+    if top_names('?limit=2') != ["Tomb Raider", "Nioh"]:
+        raise ValueError("Top games should be ordered by average rating.")
+    if top_names('?category=RPG') != ["Nioh", "Mass Effect"]:
+        raise ValueError("Top games should be limited to the category.")
+    print "27. Top games are served from the leaderboards, per category."
+
+    log_in(client, user_id)
+    client.post('/gamerater/rate-game/', data={
+        'submit': 'Rate', 'name': 'Mass Effect', 'rating': 10})
+    if top_names('?category=RPG') != ["Mass Effect", "Nioh"]:
+        raise ValueError("A rating should move a game in its category.")
+    client.post('/gamerater/add-game/', data={
+        'submit': 'Rate', 'name': 'Zelda', 'category': 'Adventure',
+        'description': 'Zelda', 'rating': 10})
+    if top_names('?category=Adventure') != ["Zelda", "Tomb Raider"]:
+        raise ValueError("A new game should join the leaderboards.")
+    game_id = session.query(Game).filter_by(name="Zelda").one().id
+    client.post('/gamerater/delete_rating/%s/' % game_id, data={
+        'submit': 'Yes'})
+    if top_names()[-1] != "Zelda":
+        raise ValueError(
+            "Deleting a game's only rating should drop it to the bottom.")
+    print "28. The leaderboards follow new, changed and deleted ratings."
+
+    # Expired lists are rebuilt once, while the old ones are still served
+    loads = []
+
+    def load_games():
+        loads.append(1)
+        time.sleep(0.2)
+        return [{'id': 1, 'category': 'RPG', 'rank_score': len(loads)}]
+
+    boards = Leaderboards(load_games, max_age=60)
+    boards.rebuild()
+    boards._built -= 120
+    scores = []
+    threads = [Thread(target=lambda: scores.append(
+        boards.top(1)[0]['rank_score'])) for i in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if len(loads) != 2 or sorted(scores) != [1, 1, 1, 1, 2]:
+        raise ValueError(
+            "Expired leaderboards should be rebuilt by one thread while the "
+            "others use the old lists. Got {0} loads and scores {1}".format(
+                len(loads), scores))
+
+    def fail_to_load():
+        raise ValueError("database is locked")
+
+    boards.load_games = fail_to_load
+    try:
+        boards.rebuild()
+    except ValueError:
+        pass
+    boards.update({'id': 2, 'category': 'RPG', 'rank_score': 5})
+    if boards._pending is not None:
+        raise ValueError("A failed rebuild should stop collecting updates.")
+    print "29. Expired leaderboards are rebuilt by one thread at a time."
+
+
+def test_benchmark_runs_on_synthetic_catalog():
+    """
+    Test that the benchmark generates the same catalog from the same seed,
+    and reports latency percentiles and query counts for each route.
+    """
+    catalogs = []
+    for i in range(2):
+        engine = use_scratch_database()
+        catalog = synthetic.generate_catalog(engine, 20, 10, 50, seed=3)
+        ratings = engine.execute(
+            'SELECT user_id, game_id, rating FROM usersgames '
+            'ORDER BY id').fetchall()
+        catalogs.append((catalog, ratings))
+    if catalogs[0] != catalogs[1] or len(catalogs[0][1]) != 50:
+        raise ValueError("The same seed should generate the same catalog.")
+    summed = engine.execute(
+        'SELECT count(*) FROM game WHERE rating_count != (SELECT count(*) '
+        'FROM usersgames WHERE game_id = game.id)').scalar()
+    if summed:
+        raise ValueError("Generated games should have their rating totals.")
+    print "30. Synthetic catalogs are generated from a seed."
+
+    gamerater.leaderboards.rebuild()
+    routes = [route for route in load.ROUTES
+              if route.name in ('game_json', 'game_trend', 'rate_game')]
+    results = load.run_benchmark(gamerater.app, engine, catalog, routes,
+                                 request_count=10, concurrency=2)
+    for name in ('game_json', 'game_trend', 'rate_game'):
+        result = results[name]
+        if (result['requests'] != 10 or result['errors'] or
+                not result['p50_ms'] <= result['p95_ms'] <=
+                result['p99_ms'] or result['queries_per_request'] < 1):
+            raise ValueError(
+                "The benchmark should report each route. Got {0}".format(
+                    result))
+    print "31. The benchmark reports latency and queries for each route."
+
+    def broken_request(rng, catalog, worker):
+        raise ValueError("no such game")
+
+    result = load.run_route(gamerater.app, load.QueryCounter(engine),
+                            catalog, load.Route('broken', broken_request), 4,
+                            2)
+    if (result['requests'], result['errors'], result['p50_ms'],
+            result['queries_per_request']) != (4, 4, None, None):
+        raise ValueError(
+            "Requests that raise should count as errors. Got {0}".format(
+                result))
+    print "32. Requests that raise are counted as benchmark errors."
+
+
+def test_sql_stats_per_route():
+    """
+    Test that /debug/sql-stats counts each route's queries, and flags
+    statements repeated within one request as N+1 suspects.
+    """
+    engine = use_scratch_database()
+    gamerater.sql_stats.listen(engine)
+    session = gamerater.session
+    for name in ("Nioh", "Portal"):
+        session.add(Game(name=name, category="RPG", description=name,
+                         avg_rating=5, modified=datetime.now()))
+    session.commit()
+    game_id = session.query(Game).first().id
+
+    client = gamerater.app.test_client()
+    gamerater.sql_stats.reset()
+    client.get('/gamerater/game/%s/json/' % game_id)
+    client.get('/gamerater/game/%s/json/' % game_id)
+    gamerater.app.config['DEBUG_STATS'] = False
+    hidden = [client.get(path).status_code
+              for path in ('/debug/sql-stats', '/debug/cache-stats')]
+    gamerater.app.config['DEBUG_STATS'] = True
+    if hidden != [404, 404]:
+        raise ValueError(
+            "The /debug pages should only be served in debug mode or with "
+            "DEBUG_STATS. Got {0}".format(hidden))
+    stats = json.loads(client.get('/debug/sql-stats').data)
+    game_stats = stats['endpoints']['game_info_json']
+    if game_stats['requests'] != 2 or game_stats['mean_queries'] != 2:
+        raise ValueError(
+            "Each game JSON request should run 2 queries. Got {0}".format(
+                game_stats))
+    print "33. SQL statements are counted and timed per route, in debug."
+
+    # A view loading each game with its own query
+    app = Flask(__name__)
+    sql_stats = SQLStats(app)
+
+    @app.route('/games/')
+    def games():
+        game_ids = [row[0] for row in session.query(Game.id)]
+        names = [session.query(Game).filter_by(id=game_id).one().name
+                 for game_id in game_ids * 3]
+        session.remove()
+        return ', '.join(names)
+
+    app.test_client().get('/games/')
+    suspects = sql_stats.stats['endpoints']['games']['n_plus_one_suspects']
+    if len(suspects) != 1 or suspects[0]['max_repeats'] != 6:
+        raise ValueError(
+            "A query run per game should be an N+1 suspect. Got {0}".format(
+                suspects))
+    print "34. Statements repeated within a request are flagged as N+1."
+
+
+class StubProviderServer(ThreadingMixIn, HTTPServer):
+    """
+    Local stand-in for the Google and Facebook APIs, counting the requests
+    for each path. The Facebook profile and picture each take delay
+    seconds, and /slow takes longer than any test timeout.
+    """
+    daemon_threads = True
+    delay = 0.3
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubProviderHandler)
+        self.counts = {}
+        self.url = 'http://127.0.0.1:%s' % self.server_port
+
+
+class StubProviderHandler(BaseHTTPRequestHandler):
+    responses = {
+        '/oauth2/v1/tokeninfo': {'user_id': '42', 'issued_to': 'gamerater',
+                                 'expires_in': 3600},
+        '/oauth/access_token': {'access_token': 'long-lived-token'},
+        '/v2.4/me': {'name': 'Stub User', 'id': '42',
+                     'email': 'stub@example.com'},
+        '/v2.4/me/picture': {'data': {'url': 'http://example.com/stub.png'}}
+    }
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        counts = self.server.counts
+        counts[path] = counts.get(path, 0) + 1
+        if path.startswith('/v2.4/me'):
+            time.sleep(self.server.delay)
+        elif path == '/slow':
+            time.sleep(2)
+        body = json.dumps(self.responses.get(path, {}))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_provider_client():
+    """
+    Test that the OAuth provider client caches token info, looks up the
+    Facebook profile and picture at the same time, and gives up on a slow
+    provider after its timeout.
+    """
+    server = StubProviderServer()
+    Thread(target=server.serve_forever).start()
+    try:
+        client = ProviderClient(timeout=(1, 0.5), google_api_url=server.url,
+                                facebook_graph_url=server.url)
+        for i in range(3):
+            info = client.google_tokeninfo('token')
+        if (info['user_id'] != '42' or
+                server.counts['/oauth2/v1/tokeninfo'] != 1):
+            raise ValueError("Token info should be fetched once and reused.")
+        print "35. Validated token info is cached."
+
+        use_scratch_database()
+        original_client = gamerater.provider_client
+        gamerater.provider_client = client
+        test_client = gamerater.app.test_client()
+        with test_client.session_transaction() as login_session:
+            login_session['state'] = 'stub-state'
+        start = time.time()
+        response = test_client.post('/fbconnect?state=stub-state',
+                                    data='short-lived-token')
+        seconds = time.time() - start
+        gamerater.provider_client = original_client
+        if 'Stub User' not in response.data or not gamerater.session.query(
+                User).filter_by(email='stub@example.com').count():
+            raise ValueError("Facebook logins should create the user.")
+        if seconds > 2 * server.delay - 0.05:
+            raise ValueError(
+                "The profile and picture should be fetched at the same "
+                "time. The login took {0:.2f} seconds".format(seconds))
+        print "36. Facebook logins look up the profile and picture at once."
+
+        start = time.time()
+        try:
+            client.get_json(server.url + '/slow')
+            raise ValueError("A slow provider should raise ProviderError.")
+        except ProviderError:
+            pass
+        if time.time() - start > 1.5:
+            raise ValueError("Provider calls should give up at the timeout.")
+        print "37. Slow providers time out."
+
+        https = call_concurrently(client.http, client.http)
+        if (client.http() is not client.http() or
+                https[0] is https[1] or client.http() in https):
+            raise ValueError("Each thread should reuse its own Http.")
+        print "38. Each thread reuses one Http for oauth2client calls."
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_secrets_are_reloaded_when_changed():
+    """
+    Test that a secrets file is parsed once, reloaded when its modified
+    time changes, and keeps its last good config if the new file is bad.
+    """
+    secrets_file, secrets_path = tempfile.mkstemp(suffix='.json')
+    os.close(secrets_file)
+
+    def write_secrets(text, mtime):
+        with open(secrets_path, 'w') as secrets:
+            secrets.write(text)
+        os.utime(secrets_path, (mtime, mtime))
+
+    write_secrets('{"web": {"app_id": "1", "app_secret": "old"}}', 1000)
+    secrets = SecretsFile(secrets_path, validate_facebook_secrets,
+                          check_interval=60)
+    if secrets.config['app_secret'] != "old":
+        raise ValueError("The secrets should be loaded on first use.")
+    write_secrets('{"web": {"app_id": "1", "app_secret": "new"}}', 2000)
+    if secrets.config['app_secret'] != "old":
+        raise ValueError(
+            "The file should not be checked again within check_interval.")
+    secrets.check_interval = 0
+    if secrets.config['app_secret'] != "new":
+        raise ValueError("A changed file should be reloaded.")
+    print "39. Secrets are loaded once and reloaded when the file changes."
+
+    write_secrets('{"web": {"app_id": "1"', 3000)
+    if secrets.config['app_secret'] != "new":
+        raise ValueError("A bad file should keep the last good secrets.")
+    try:
+        SecretsFile(secrets_path, validate_facebook_secrets).load()
+        raise ValueError("A bad file should not load the first time.")
+    except ConfigError:
+        pass
+    os.remove(secrets_path)
+    print "40. Bad secrets files are rejected."
+
+
+def test_sessions_are_stored_on_the_server():
+    """
+    Test that the session cookie holds only an id, that the session data
+    is kept on the server, and that expired sessions are deleted in bulk.
+    """
+    client = gamerater.app.test_client()
+    picture = 'http://example.com/' + 'a' * 2000
+    with client.session_transaction() as login_session:
+        login_session['username'] = 'Tester'
+        login_session['picture'] = picture
+    cookie = [c for c in client.cookie_jar
+              if c.name == gamerater.app.session_cookie_name][0]
+    if len(cookie.value) > 64 or 'Tester' in cookie.value:
+        raise ValueError(
+            "The cookie should hold only the session id. Got {0}".format(
+                cookie.value))
+    with client.session_transaction() as login_session:
+        if login_session.get('picture') != picture:
+            raise ValueError("The session data should be kept on the server.")
+    print "41. Session cookies hold only an id; the data stays on the server."
+
+    # A new interface has an empty front cache, so the store is read
+    interface = gamerater.app.session_interface
+    gamerater.app.session_interface = type(interface)(interface.store)
+    with client.session_transaction() as login_session:
+        found = login_session.get('username')
+        login_session.clear()
+    gamerater.app.session_interface = interface
+    if found != 'Tester':
+        raise ValueError("Sessions should be loaded from the store.")
+    if [c for c in client.cookie_jar
+            if c.name == gamerater.app.session_cookie_name]:
+        raise ValueError("Emptied sessions should be forgotten.")
+
+    db_file, db_path = tempfile.mkstemp(suffix='.db', dir=TEST_DIRECTORY)
+    os.close(db_file)
+    store = SQLiteSessionStore('sqlite:///%s' % db_path)
+    now = time.time()
+    for i in range(10):
+        store.set('session%s' % i, 1, 'data', now + (i - 5) * 60 + 30)
+    if store.delete_expired() != 5 or store.get('session2') is not None:
+        raise ValueError("Expired sessions should be deleted in bulk.")
+    if store.get('session7') != (1, 'data', now + 150):
+        raise ValueError("Live sessions should be kept.")
+    os.remove(db_path)
+    print "42. Expired sessions are deleted in bulk."
+
+    # An id handed out before login must not carry the logged in session
+    client = gamerater.app.test_client()
+    client.get('/login/')
+    cookie_name = gamerater.app.session_cookie_name
+    old_cookie = [c for c in client.cookie_jar if c.name == cookie_name][0]
+    with client.session_transaction() as login_session:
+        login_session['username'] = 'Tester'
+        login_session['email'] = 'tester@example.com'
+        login_session['picture'] = 'http://example.com/tester.png'
+        gamerater.login_or_create_user(login_session)
+    new_cookie = [c for c in client.cookie_jar if c.name == cookie_name][0]
+    old_id = old_cookie.value.rsplit('.', 1)[0]
+    if new_cookie.value.rsplit('.', 1)[0] == old_id:
+        raise ValueError("Logging in should give the session a new id.")
+    if interface.store.get(old_id) is not None:
+        raise ValueError("The session's old id should be deleted at login.")
+    attacker = gamerater.app.test_client()
+    attacker.set_cookie('localhost', cookie_name, old_cookie.value)
+    with attacker.session_transaction() as login_session:
+        if 'user_id' in login_session:
+            raise ValueError("The old session id should not be logged in.")
+    print "43. Logging in moves the session to a new id."
+
+
+def test_user_cards_are_cached():
+    """
+    Test that the home page only renders the user cards that changed since
+    they were last rendered.
+    """
+    use_scratch_database()
+    session = gamerater.session
+    session.add(Game(name="Nioh", category="RPG", description="Nioh",
+                     avg_rating=0, modified=datetime.now()))
+    session.commit()
+    add_users_with_ratings(session, 3, [])
+    user_id = session.query(User).first().id
+
+    client = gamerater.app.test_client()
+    client.get('/gamerater/')
+    rendered = gamerater.card_cache.misses
+    gamerater.invalidate_home_fragments()
+    client.get('/gamerater/')
+    if gamerater.card_cache.misses != rendered:
+        raise ValueError("Unchanged user cards should not be rendered again.")
+    print "44. Unchanged user cards are served from the cache."
+
+    log_in(client, user_id)
+    client.post('/gamerater/rate-game/', data={
+        'submit': 'Rate', 'name': 'Nioh', 'rating': 7})
+    client.post('/update_user', data={'submit': 'Submit',
+                                      'username': 'Renamed'})
+    page = client.get('/gamerater/').data
+    if gamerater.card_cache.misses != rendered + 1:
+        raise ValueError(
+            "Only the changed user's card should be rendered again. Got "
+            "{0} renders".format(gamerater.card_cache.misses - rendered))
+    card = page.split('Renamed')[1].split('Check out more')[0]
+    if 'Nioh' not in card:
+        raise ValueError("The card should show the user's new rating.")
+    print "45. Only the cards of users who changed are rendered again."
+
+
+def test_recommendations_come_from_similar_games():
+    """
+    Test that similar games are built from the ratings by the refresher,
+    and that the similar and recommended games are served from them.
+    """
+    engine = use_scratch_database()
+    session = gamerater.session
+    for name in ("Nioh", "Dark Souls", "Portal", "Tetris"):
+        session.add(Game(name=name, category="Any", description=name,
+                         avg_rating=0, modified=datetime.now()))
+    session.commit()
+    games = dict((game.name, game.id) for game in session.query(Game))
+
+    # Half the users like the action games, the other half the puzzles
+    now = datetime.now()
+    for i in xrange(8):
+        user = User(name="User %s" % i, email="user%s@example.com" % i)
+        session.add(user)
+        session.flush()
+        action, puzzle = (9, 2) if i % 2 else (3, 8)
+        for name, rating in (("Nioh", action), ("Dark Souls", action + 1),
+                             ("Portal", puzzle), ("Tetris", puzzle - 1)):
+            session.add(UsersGames(user_id=user.id, game_id=games[name],
+                                   rating=rating, modified=now))
+    user = User(name="Newcomer", email="new@example.com")
+    session.add(user)
+    session.flush()
+    user_id = user.id
+    for name, rating in (("Nioh", 10), ("Portal", 2)):
+        session.add(UsersGames(user_id=user_id, game_id=games[name],
+                               rating=rating, modified=now))
+    session.commit()
+
+    refresher = recommendations.SimilarityRefresher(engine)
+    if not refresher.refresh() or refresher.refresh():
+        raise ValueError(
+            "The similar games should only be rebuilt after a change.")
+
+    client = gamerater.app.test_client()
+    url = '/gamerater/game/%s/similar/' % games["Nioh"]
+    queries = count_queries(engine, lambda: client.get(url))
+    data = json.loads(client.get(url).data)
+    names = [game['name'] for game in data['Game']]
+    if names != ["Dark Souls"]:
+        raise ValueError(
+            "Only games rated alike should be similar. Got {0}".format(names))
+    if queries != 2:
+        raise ValueError(
+            "Similar games should be read in one query. Got {0}".format(
+                queries))
+    print "46. Similar games are precomputed from the ratings."
+
+    data = json.loads(client.get(
+        '/gamerater/user/%s/recommendations/' % user_id).data)
+    names = [game['name'] for game in data['Game']]
+    if names != ["Dark Souls"]:
+        raise ValueError(
+            "Games like the ones the user rated highly should be "
+            "recommended. Got {0}".format(names))
+
+    session.add(UsersGames(user_id=user_id, game_id=games["Dark Souls"],
+                           rating=9, modified=datetime.now()))
+    session.commit()
+    if not refresher.refresh():
+        raise ValueError("A new rating should rebuild the similar games.")
+    data = json.loads(client.get(
+        '/gamerater/user/%s/recommendations/' % user_id).data)
+    if data['Game']:
+        raise ValueError("Rated games should not be recommended.")
+    print "47. Users are recommended unrated games like their favorites."
+
+
+def test_games_are_ranked_by_confidence():
+    """
+    Test that a game with many high ratings outranks one with a single
+    perfect rating, and that rating writes keep the scores in step with
+    the ranking job.
+    """
+    engine = use_scratch_database()
+    session = gamerater.session
+    for name in ("Nioh", "Obscure", "Portal"):
+        session.add(Game(name=name, category="RPG", description=name,
+                         avg_rating=0, modified=datetime.now()))
+    session.commit()
+    games = dict((game.name, game.id) for game in session.query(Game))
+
+    now = datetime.now()
+    for i in xrange(20):
+        user = User(name="User %s" % i, email="user%s@example.com" % i)
+        session.add(user)
+        session.flush()
+        session.add(UsersGames(user_id=user.id, game_id=games["Nioh"],
+                               rating=9, modified=now))
+        session.add(UsersGames(user_id=user.id, game_id=games["Portal"],
+                               rating=4, modified=now))
+        if i == 0:
+            session.add(UsersGames(user_id=user.id, game_id=games["Obscure"],
+                                   rating=10, modified=now))
+    session.commit()
+    reconcile_ratings.fix_drift(session, reconcile_ratings.find_drift(
+        session))
+    user_id = session.query(User).first().id
+    gamerater.leaderboards.rebuild()
+
+    client = gamerater.app.test_client()
+    data = json.loads(client.get('/gamerater/top/json/').data)
+    names = [game['name'] for game in data['Game']]
+    if names != ["Nioh", "Obscure", "Portal"]:
+        raise ValueError(
+            "Games should be ranked by their rank score. Got {0}".format(
+                names))
+    print "48. A single perfect rating doesn't outrank many high ones."
+
+    log_in(client, user_id)
+    client.post('/gamerater/rate-game/', data={
+        'submit': 'Rate', 'name': 'Portal', 'rating': 10})
+    client.post('/gamerater/delete_rating/%s/' % games["Obscure"], data={
+        'submit': 'Yes'})
+    prior = session.query(database_setup.RatingPrior).one()
+    scores = dict((game.name, game.rank_score)
+                  for game in session.query(Game))
+    expected = (86 + prior.mean * prior.weight) / (20 + prior.weight)
+    if abs(scores["Portal"] - expected) > 1e-9:
+        raise ValueError(
+            "A rating should rescore its game from the stored prior. Got "
+            "{0}, expected {1}".format(scores["Portal"], expected))
+    if scores["Obscure"] != 0:
+        raise ValueError("A game without ratings should score 0.")
+    print "49. Rating writes rescore their game from the stored prior."
+
+    # A new database is ranked before it has ratings, with a prior of 0
+    url = '/gamerater/game/%s/json/' % games["Portal"]
+    etag = client.get(url).headers.get('ETag')
+    session.query(database_setup.RatingPrior).update({'mean': 0})
+    session.commit()
+    with engine.begin() as connection:
+        if not ranking.refresh_prior(connection):
+            raise ValueError("A drifted prior should rescore the games.")
+        if ranking.refresh_prior(connection):
+            raise ValueError("A current prior should be left alone.")
+    session.expire_all()
+    prior = session.query(database_setup.RatingPrior).one()
+    mean = session.query(func.avg(UsersGames.rating)).scalar()
+    if abs(prior.mean - mean) > 1e-9:
+        raise ValueError("The prior should follow the ratings.")
+    if client.get(url).headers.get('ETag') == etag:
+        raise ValueError(
+            "Rescoring a game should change the ETag of its JSON.")
+    print "50. The prior follows the ratings, and rescoring moves the ETag."
+
+
+def test_app_factory_prepares_for_forking():
+    """
+    Test that create_app sets the app up before forking, and that forked
+    workers drop the connections they inherit.
+    """
+    engine = use_scratch_database()
+    app_engine, database_setup.engine = database_setup.engine, engine
+    os.environ['GAMERATER_SECRET_KEY'] = 'factory_secret_key'
+    try:
+        application = gamerater.create_app({'LEADERBOARD_SIZE': 3})
+    finally:
+        del os.environ['GAMERATER_SECRET_KEY']
+        gamerater.app.config['LEADERBOARD_SIZE'] = 10
+    if application.debug or application.secret_key != 'factory_secret_key':
+        raise ValueError("The app should be set up for production.")
+    cached = len(application.jinja_env.cache)
+    if cached < len(application.jinja_env.list_templates()):
+        raise ValueError(
+            "Every template should be compiled before forking. Got "
+            "{0}".format(cached))
+    print "51. The app factory loads the config and templates before forking."
+
+    gamerater.app.test_client().get('/gamerater/')
+    if engine.pool.checkedin() == 0:
+        raise ValueError("The request should leave a pooled connection.")
+    try:
+        prefork.run_after_fork()
+    finally:
+        database_setup.engine = app_engine
+    if engine.pool.checkedin() != 0:
+        raise ValueError("Forked workers should not reuse connections.")
+    print "52. Forked workers open their own database connections."
+
+
+def test_rating_trends_are_rolled_up():
+    """
+    Test that every rating change is logged, that the trend is read from
+    hourly and daily rollups, and that old events are compacted.
+    """
+    engine = use_scratch_database()
+    session = gamerater.session
+    session.add(Game(name="Nioh", category="RPG", description="Nioh",
+                     avg_rating=0, modified=datetime.now()))
+    session.commit()
+    add_users_with_ratings(session, 2, [])
+    user_ids = [user.id for user in session.query(User).order_by(User.id)]
+    game_id = session.query(Game).one().id
+
+    client = gamerater.app.test_client()
+    log_in(client, user_ids[0])
+    for rating in (4, 8):
+        client.post('/gamerater/rate-game/', data={
+            'submit': 'Rate', 'name': 'Nioh', 'rating': rating})
+    client.post('/gamerater/delete_rating/%s/' % game_id, data={
+        'submit': 'Yes'})
+    log_in(client, user_ids[1])
+    client.post('/gamerater/rate-game/', data={
+        'submit': 'Rate', 'name': 'Nioh', 'rating': 6})
+    logged = [(event.old_rating, event.new_rating) for event in
+              session.query(database_setup.RatingEvent).order_by(
+                  database_setup.RatingEvent.id)]
+    if logged != [(None, 4), (4, 8), (8, None), (None, 6)]:
+        raise ValueError(
+            "Every rating change should be logged. Got {0}".format(logged))
+    print "53. Rating creates, updates and deletes are logged as events."
+
+    # Roll up in two batches, and once more with nothing new. The events
+    # are moved into one hour first.
+    session.query(database_setup.RatingEvent).update(
+        {'created': datetime.now().replace(minute=30)})
+    session.commit()
+    if trends.roll_up(engine, batch_size=3) != 4 or trends.roll_up(engine):
+        raise ValueError("Each event should be rolled up once.")
+    url = '/gamerater/game/%s/trend/?period=hour' % game_id
+    queries = count_queries(engine, lambda: client.get(url))
+    trend = json.loads(client.get(url).data)['Trend']
+    if queries != 2:
+        raise ValueError(
+            "The trend should be read in one query. Got {0}".format(queries))
+    if len(trend) != 1 or (trend[0]['events'], trend[0]['rating_count'],
+                           trend[0]['avg_rating'],
+                           trend[0]['count_change']) != (4, 3, 6.0, 1):
+        raise ValueError(
+            "The events should be summed per hour. Got {0}".format(trend))
+    print "54. Game trends are read from hourly and daily rollups."
+
+    session.query(database_setup.RatingEvent).update(
+        {'created': datetime.now() - timedelta(days=60)})
+    session.query(database_setup.RatingRollup).update(
+        {'start': datetime.now() - timedelta(days=120)})
+    gamerater.log_rating_event(user_ids[1], game_id, 6, 7)
+    session.commit()
+    deleted = trends.compact(engine)
+    left = session.query(database_setup.RatingEvent).count()
+    periods = [bucket.period for bucket in
+               session.query(database_setup.RatingRollup)]
+    if deleted != (4, 1) or left != 1 or periods != ['day']:
+        raise ValueError(
+            "Old rolled up events and hourly buckets should be deleted. "
+            "Got {0}, {1} events left, {2} buckets left".format(
+                deleted, left, periods))
+
+    # Compact every event, then check a new one isn't given a used id
+    trends.roll_up(engine)
+    session.query(database_setup.RatingEvent).update(
+        {'created': datetime.now() - timedelta(days=60)})
+    session.commit()
+    trends.compact(engine)
+    gamerater.log_rating_event(user_ids[1], game_id, 7, 8)
+    session.commit()
+    if trends.roll_up(engine) != 1:
+        raise ValueError(
+            "An event added after every event was compacted should be "
+            "rolled up.")
+    print "55. Old events are compacted once rolled up."
+
+
+def test_rating_writes_are_group_committed():
+    """
+    Test that a rating is written in one transaction, and that concurrent
+    rating writes can share one commit without a failing write undoing
+    the others.
+    """
+    engine = use_scratch_database()
+    session = gamerater.session
+    for i in xrange(8):
+        session.add(Game(name="Game %s" % i, category="RPG",
+                         description="Game %s" % i, avg_rating=0,
+                         modified=datetime.now()))
+    session.commit()
+    add_users_with_ratings(session, 1, [])
+    user_id = session.query(User).one().id
+    game_ids = [game.id for game in session.query(Game).order_by(Game.id)]
+
+    commits = []
+
+    def count_commit(conn):
+        commits.append(conn)
+
+    results = {}
+
+    def rate(game_id, rating):
+        try:
+            results[game_id] = gamerater.save_rating(user_id, game_id,
+                                                     rating)
+        except Exception as e:
+            results[game_id] = e
+        finally:
+            session.remove()
+
+    def rate_concurrently(game_ids, rating):
+        threads = [Thread(target=rate, args=(game_id, rating))
+                   for game_id in game_ids]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    event.listen(engine, 'commit', count_commit)
+    try:
+        gamerater.save_rating(user_id, game_ids[0], 7)
+        if len(commits) != 1:
+            raise ValueError(
+                "A rating should be written in one transaction. Got "
+                "{0}".format(len(commits)))
+        print "56. A rating and its totals are written in one transaction."
+
+        # Concurrent first ratings of a game by one user add one rating,
+        # and none of them fail
+        failures = []
+
+        def rate_first(rating):
+            try:
+                gamerater.save_rating(user_id, game_ids[1], rating)
+            except Exception as e:
+                failures.append(e)
+            finally:
+                session.remove()
+
+        threads = [Thread(target=rate_first, args=(rating,))
+                   for rating in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        session.expire_all()
+        count = session.query(UsersGames).filter_by(
+            user_id=user_id, game_id=game_ids[1]).count()
+        game = session.query(Game).get(game_ids[1])
+        if count != 1 or game.rating_count != 1 or failures:
+            raise ValueError(
+                "A user should have one rating of a game. Got {0} ratings, "
+                "a count of {1} and {2}".format(count, game.rating_count,
+                                                failures))
+        session.remove()
+        print "57. Concurrent ratings of a game by one user add one rating."
+
+        gamerater.rating_committer = GroupCommitter(session, window=0.2)
+        del commits[:]
+        rate_concurrently(game_ids, 9)
+        # One commit for the writes, and one for each request thread
+        # ending its own transaction
+        writer_commits = len(commits) - len(game_ids)
+        if writer_commits >= len(game_ids) or results[game_ids[0]] != 7:
+            raise ValueError(
+                "Concurrent ratings should share commits. Got {0} for {1} "
+                "ratings".format(writer_commits, len(game_ids)))
+
+        # A rating of a game that doesn't exist can't be inserted
+        rate_concurrently([game_ids[0], None], 4)
+    finally:
+        gamerater.rating_committer = None
+        event.remove(engine, 'commit', count_commit)
+
+    session.expire_all()
+    rated = dict((rating.game_id, rating.rating) for rating in
+                 session.query(UsersGames))
+    expected = dict((game_id, 9) for game_id in game_ids)
+    expected[game_ids[0]] = 4
+    if rated != expected or not isinstance(results[None], Exception):
+        raise ValueError(
+            "Only the failing write should be undone. Got {0}".format(rated))
+    print "58. Concurrent ratings are group committed; failures stay apart."
+
+    class BrokenSession(object):
+        """A session whose commits, rollbacks and removes all fail."""
+        def commit(self):
+            raise ValueError("disk I/O error")
+        rollback = remove = commit
+
+    committer = GroupCommitter(BrokenSession(), window=0, timeout=5)
+    for i in range(2):
+        try:
+            committer.submit(lambda: 1)
+        except ValueError:
+            continue
+        raise ValueError("A write should fail when its rollback fails.")
+    committer.session = session
+    if committer.submit(lambda: 3) != 3:
+        raise ValueError("The writer should survive a failed rollback.")
+    committer.timeout = 0.1
+    try:
+        committer.submit(time.sleep, 0.5)
+    except RuntimeError:
+        pass
+    else:
+        raise ValueError("submit should give up after its timeout.")
+    print "59. The group commit writer survives failures; submit times out."
+
+
+def test_pages_load_relationships_eagerly():
+    """
+    Test that the game, user and my games pages load the ratings' users
+    and games in the same query as the ratings, so their query counts
+    don't grow with the number of ratings.
+    """
+    engine = use_scratch_database()
+    session = gamerater.session
+    for i in xrange(40):
+        session.add(Game(name="Game %s" % i, category="RPG",
+                         description="Game %s" % i, avg_rating=5,
+                         modified=datetime.now()))
+    session.commit()
+    games = session.query(Game).order_by(Game.id).all()
+    game_id = games[0].id
+    add_users_with_ratings(session, 3, games[:3])
+    few_user_id = session.query(User).order_by(User.id).first().id
+
+    client = gamerater.app.test_client()
+    few_raters = count_queries(
+        engine, lambda: client.get('/gamerater/game/%s/' % game_id))
+
+    # The request removed the session, so load the games again
+    games = session.query(Game).order_by(Game.id).all()
+    add_users_with_ratings(session, 30, games)
+    many_user_id = session.query(User).order_by(desc(User.id)).first().id
+    many_raters = count_queries(
+        engine, lambda: client.get('/gamerater/game/%s/' % game_id))
+    if few_raters != many_raters:
+        raise ValueError(
+            "The game page should run the same number of queries for 3 and "
+            "33 raters. Got {0} and {1}".format(few_raters, many_raters))
+    print "60. The game page query count does not grow with its ratings."
+
+    for path in ('/gamerater/user/%s/', '/gamerater/my-games/'):
+        counts = []
+        for user_id in (few_user_id, many_user_id):
+            log_in(client, user_id)
+            counts.append(count_queries(
+                engine, lambda: client.get(path.replace('%s', str(user_id)))))
+        if counts[0] != counts[1]:
+            raise ValueError(
+                "{0} should run the same number of queries for 3 and 40 "
+                "rated games. Got {1} and {2}".format(path, *counts))
+
+    log_in(client, many_user_id)
+    response = client.get('/gamerater/my-games/')
+    top_game = session.query(UsersGames).filter_by(
+        user_id=many_user_id).order_by(desc(UsersGames.rating)).first().game
+    if top_game.name not in response.data:
+        raise ValueError("My games should show the user's top rated game.")
+    print "61. The user and my games pages load the rated games with the " \
+          "ratings."
+
+
+if __name__ == '__main__':
+    gamerater.app.secret_key = 'test_secret_key'
+    gamerater.app.testing = True
+    gamerater.app.config['DEBUG_STATS'] = True
+    test_home_query_count_is_flat()
+    test_rating_totals_follow_writes()
+    test_json_collections_are_paged()
+    test_json_exports_are_streamed()
+    test_sessions_are_request_scoped()
+    test_migrations_upgrade_old_database()
+    test_home_fragments_are_cached()
+    test_json_conditional_get()
+    test_games_are_loaded_in_bulk()
+    test_ratings_are_imported_in_bulk()
+    test_games_are_searchable()
+    test_sqlite_profile_is_applied()
+    test_leaderboards_follow_ratings()
+    test_benchmark_runs_on_synthetic_catalog()
+    test_sql_stats_per_route()
+    test_provider_client()
+    test_secrets_are_reloaded_when_changed()
+    test_sessions_are_stored_on_the_server()
+    test_user_cards_are_cached()
+    test_recommendations_come_from_similar_games()
+    test_games_are_ranked_by_confidence()
+    test_app_factory_prepares_for_forking()
+    test_rating_trends_are_rolled_up()
+    test_rating_writes_are_group_committed()
+    test_pages_load_relationships_eagerly()
+    print "Success!  All tests pass!"
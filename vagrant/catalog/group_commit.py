@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+#
+# Group commit for small write transactions. Request threads hand their
+# writes to one writer thread, which runs every write that arrives within a
+# few milliseconds of the first in a single transaction, so they share one
+# commit (and one fsync) instead of paying for one each.
+#
+import Queue
+import os
+import threading
+import time
+
+# Seconds the writer waits for more writes after the first of a group
+WINDOW = 0.005
+
+# Most writes committed together
+MAX_SIZE = 100
+
+# Seconds submit waits for its write to be committed
+TIMEOUT = 30
+
+
+class GroupCommitter(object):
+    """
+    Runs write functions submitted by many threads in one writer thread,
+    committing each group in one transaction of session (a scoped session,
+    so the functions' own use of it runs in the writer's transaction). If
+    a write in a group fails, the group is rolled back and each of its
+    writes is retried in its own transaction, so only the failing write
+    raises. submit blocks until its write has been committed, or for at
+    most timeout seconds.
+
+    >>> committer = GroupCommitter(session, window=0.005)
+    >>> committer.submit(save_rating, user_id, game_id, 9)
+    7
+    """
+
+    def __init__(self, session, window=WINDOW, max_size=MAX_SIZE,
+                 timeout=TIMEOUT):
+        self.session = session
+        self.window = window
+        self.max_size = max_size
+        self.timeout = timeout
+        self.groups = 0
+        self.writes = 0
+        self._queue = Queue.Queue()
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def submit(self, function, *args):
+        """
+        Runs function(*args) in the writer's next group and returns its
+        result once the group has been committed. Raises RuntimeError if
+        that takes longer than timeout seconds, in which case the write
+        may still be committed later.
+        """
+        self._start()
+        write = {'function': function, 'args': args, 'result': None,
+                 'error': None, 'committed': False,
+                 'done': threading.Event()}
+        self._queue.put(write)
+        if not write['done'].wait(self.timeout):
+            raise RuntimeError("The write wasn't committed within %s "
+                               "seconds" % self.timeout)
+        if write['error'] is not None:
+            raise write['error']
+        return write['result']
+
+    def _start(self):
+        """Starts the writer thread, again in each forked process."""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._queue = Queue.Queue()
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+
+    def _run(self):
+        while True:
+            group = [self._queue.get()]
+            deadline = time.time() + self.window
+            while len(group) < self.max_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    group.append(self._queue.get(timeout=remaining))
+                except Queue.Empty:
+                    break
+
+            try:
+                self._commit(group)
+            except Exception as e:
+                # The rollback failed too; fail the writes not committed
+                for write in group:
+                    if not write['committed'] and write['error'] is None:
+                        write['error'] = e
+            finally:
+                try:
+                    self.session.remove()
+                except Exception:
+                    pass
+                for write in group:
+                    write['done'].set()
+
+    def _commit(self, group):
+        """Runs the group's writes and commits them together."""
+        try:
+            for write in group:
+                write['result'] = write['function'](*write['args'])
+            self.session.commit()
+            for write in group:
+                write['committed'] = True
+            self.groups += 1
+            self.writes += len(group)
+        except Exception as e:
+            self.session.rollback()
+            if len(group) == 1:
+                group[0]['error'] = e
+                return
+            for write in group:
+                self._commit([write])
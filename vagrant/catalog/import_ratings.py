@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+#
+# Bulk imports ratings from a CSV or JSON lines file. Each row has a user's
+# email, a game's name, a rating from 0 to 10 and an optional timestamp:
+#
+#   email,game,rating,timestamp
+#   paul@example.com,Nioh,9,2017-05-01T12:30:00
+#
+#   {"email": "paul@example.com", "game": "Nioh", "rating": 9}
+#
+# Users and games that don't exist yet are created. A user's existing
+# rating of a game is replaced if the imported one is newer. Rows are
+# written in large batches with executemany, and each affected game's
+# rating totals are recomputed once at the end, followed by every game's
+# rank score.
+#
+# Usage: python import_ratings.py FILE [--format csv|jsonl] [--database URL]
+#
+import argparse
+import csv
+import json
+
+from datetime import datetime
+
+from sqlalchemy import func, select, bindparam
+
+import migrations
+import ranking
+from database_setup import (Game, UsersGames, User, RatingEvent,
+                            create_db_engine)
+
+# Number of rows written per transaction
+BATCH_SIZE = 20000
+
+# Most ids or names in one IN (...) query; SQLite allows 999 parameters
+CHUNK_SIZE = 500
+
+users = User.__table__
+games = Game.__table__
+ratings = UsersGames.__table__
+events = RatingEvent.__table__
+
+
+def parse_timestamp(value):
+    """
+    Returns the datetime for an ISO 8601 timestamp or seconds since the
+    epoch, or now if value is empty.
+
+    >>> parse_timestamp('2017-05-01T12:30:00')
+    datetime.datetime(2017, 5, 1, 12, 30)
+    """
+    if value in (None, ''):
+        return datetime.now()
+    try:
+        return datetime.fromtimestamp(float(value))
+    except ValueError:
+        pass
+    for timestamp_format in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S',
+                             '%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, timestamp_format)
+        except ValueError:
+            continue
+    raise ValueError("Unknown timestamp format: %s" % value)
+
+
+def read_rows(ratings_file, file_format, errors):
+    """
+    Yields (line number, row dict) for each row of a CSV file with a
+    header, or a JSON lines file, and appends a message to errors for each
+    line that isn't valid JSON.
+    """
+    if file_format == 'csv':
+        for line_number, row in enumerate(csv.DictReader(ratings_file), 2):
+            yield line_number, row
+    else:
+        for line_number, line in enumerate(ratings_file, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                errors.append("line %s: %s" % (line_number, e))
+                continue
+            yield line_number, row
+
+
+def parse_rows(rows, errors):
+    """
+    Yields (email, game name, rating, modified) for each valid row, and
+    appends a message to errors for each invalid one.
+    """
+    for line_number, row in rows:
+        try:
+            email = row['email'].strip()
+            game_name = row['game'].strip()
+            rating = int(row['rating'])
+            modified = parse_timestamp(row.get('timestamp'))
+            if not (email and game_name):
+                raise ValueError("email and game are required")
+            if rating > 10 or rating < 0:
+                raise ValueError("rating must be from 0 to 10")
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            errors.append("line %s: %s" % (line_number, e))
+            continue
+        yield email, game_name, rating, modified
+
+
+def chunks(values, size=CHUNK_SIZE):
+    """Yields lists of up to size values."""
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def get_or_create_ids(connection, table, key_column, keys, new_row):
+    """
+    Returns a dict of key to id for the given keys of table, inserting a
+    row made by new_row(key) for each key that doesn't exist yet.
+    """
+    ids = {}
+    for chunk in chunks(keys):
+        query = select([key_column, table.c.id]).where(key_column.in_(chunk))
+        ids.update(connection.execute(query).fetchall())
+
+    missing = [key for key in keys if key not in ids]
+    if missing:
+        connection.execute(table.insert(), [new_row(key) for key in missing])
+        for chunk in chunks(missing):
+            query = select([key_column, table.c.id]).where(
+                key_column.in_(chunk))
+            ids.update(connection.execute(query).fetchall())
+    return ids
+
+
+def write_batch(connection, batch):
+    """
+    Writes a batch of (email, game name, rating, modified) rows in one
+    transaction, and returns the ids of the games rated.
+    """
+    now = datetime.now()
+    user_ids = get_or_create_ids(
+        connection, users, users.c.email, set(row[0] for row in batch),
+        lambda email: {'name': email.split('@')[0], 'email': email,
+                       'modified': now})
+    game_ids = get_or_create_ids(
+        connection, games, games.c.name, set(row[1] for row in batch),
+        lambda name: {'name': name, 'avg_rating': 0, 'rating_sum': 0,
+                      'rating_count': 0, 'modified': now})
+
+    # Keep the newest rating of each game by each user
+    newest = {}
+    for email, game_name, rating, modified in batch:
+        key = (user_ids[email], game_ids[game_name])
+        if key not in newest or newest[key][1] <= modified:
+            newest[key] = (rating, modified)
+
+    # Find the ratings that already exist for these users
+    existing = {}
+    for chunk in chunks(set(user_id for user_id, game_id in newest)):
+        query = select([ratings.c.user_id, ratings.c.game_id,
+                        ratings.c.id, ratings.c.rating,
+                        ratings.c.modified]).where(
+            ratings.c.user_id.in_(chunk))
+        for (user_id, game_id, rating_id, old_rating,
+             modified) in connection.execute(query):
+            existing[(user_id, game_id)] = (rating_id, old_rating, modified)
+
+    # Log each new or changed rating at its own time, for the trends
+    inserts = []
+    updates = []
+    rating_events = []
+    for (user_id, game_id), (rating, modified) in newest.items():
+        if (user_id, game_id) not in existing:
+            inserts.append({'user_id': user_id, 'game_id': game_id,
+                            'rating': rating, 'modified': modified})
+            rating_events.append({'user_id': user_id, 'game_id': game_id,
+                                  'old_rating': None, 'new_rating': rating,
+                                  'created': modified})
+        else:
+            rating_id, old_rating, existing_modified = existing[
+                (user_id, game_id)]
+            if existing_modified is None or existing_modified <= modified:
+                updates.append({'rating_id': rating_id, 'new_rating': rating,
+                                'new_modified': modified})
+                rating_events.append({'user_id': user_id,
+                                      'game_id': game_id,
+                                      'old_rating': old_rating,
+                                      'new_rating': rating,
+                                      'created': modified})
+
+    if inserts:
+        connection.execute(ratings.insert(), inserts)
+    if updates:
+        connection.execute(
+            ratings.update().where(
+                ratings.c.id == bindparam('rating_id')).values(
+                rating=bindparam('new_rating'),
+                modified=bindparam('new_modified')),
+            updates)
+    if rating_events:
+        connection.execute(events.insert(), rating_events)
+
+    rated_users = set(user_id for user_id, game_id in newest)
+    for chunk in chunks(rated_users):
+        connection.execute(users.update().where(
+            users.c.id.in_(chunk)).values(modified=now))
+    return set(game_id for user_id, game_id in newest)
+
+
+def recompute_game_totals(connection, game_ids):
+    """
+    Recomputes the rating sum, count and average of the given games from
+    their ratings.
+    """
+    now = datetime.now()
+    for chunk in chunks(game_ids):
+        query = select([ratings.c.game_id, func.sum(ratings.c.rating),
+                        func.count(ratings.c.rating)]).where(
+            ratings.c.game_id.in_(chunk)).group_by(ratings.c.game_id)
+        totals = [{'game_id': game_id, 'new_sum': rating_sum,
+                   'new_count': rating_count,
+                   'new_avg': float(rating_sum) / rating_count,
+                   'new_modified': now}
+                  for game_id, rating_sum, rating_count in
+                  connection.execute(query)]
+        if totals:
+            connection.execute(
+                games.update().where(
+                    games.c.id == bindparam('game_id')).values(
+                    rating_sum=bindparam('new_sum'),
+                    rating_count=bindparam('new_count'),
+                    avg_rating=bindparam('new_avg'),
+                    modified=bindparam('new_modified')),
+                totals)
+
+
+def import_ratings(engine, ratings_file, file_format,
+                   batch_size=BATCH_SIZE):
+    """
+    Imports the ratings in ratings_file, and returns the number of rows
+    imported and a list of messages for the rows that were skipped.
+    """
+    errors = []
+    rated_games = set()
+    imported = 0
+    batch = []
+
+    try:
+        for row in parse_rows(read_rows(ratings_file, file_format, errors),
+                              errors):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                with engine.begin() as connection:
+                    rated_games |= write_batch(connection, batch)
+                imported += len(batch)
+                batch = []
+        if batch:
+            with engine.begin() as connection:
+                rated_games |= write_batch(connection, batch)
+            imported += len(batch)
+    finally:
+        # Rescore every game against the new average rating, even if the
+        # import stopped part way, so the batches written are counted
+        with engine.begin() as connection:
+            recompute_game_totals(connection, rated_games)
+            ranking.rank_games(connection)
+    return imported, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Bulk import ratings from a CSV or JSON lines file.")
+    parser.add_argument('file', help="the file of ratings to import")
+    parser.add_argument('--format', choices=('csv', 'jsonl'),
+                        help="file format (default: from the file name)")
+    parser.add_argument('--database', default='sqlite:///favoritegames.db',
+                        help="database url (default: %(default)s)")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                        help="rows per transaction (default: %(default)s)")
+    args = parser.parse_args()
+
+    file_format = args.format
+    if file_format is None:
+        file_format = 'csv' if args.file.endswith('.csv') else 'jsonl'
+
+    engine = create_db_engine(args.database)
+    migrations.upgrade(engine)
+
+    start = datetime.now()
+    with open(args.file, 'rb') as ratings_file:
+        imported, errors = import_ratings(engine, ratings_file, file_format,
+                                          args.batch_size)
+    seconds = (datetime.now() - start).total_seconds()
+
+    for error in errors:
+        print "Skipped %s" % error
+    print "Imported %s ratings in %.1f seconds." % (imported, seconds)
+
+
+if __name__ == '__main__':
+    main()
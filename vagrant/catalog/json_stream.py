@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+#
+# Streams JSON responses from generators, so large collections are written
+# out as they are read from the database instead of being built in memory.
+#
+import json
+
+from collections import Iterator
+
+from flask import Response, stream_with_context
+
+# Number of rows loaded from the database, and number of items written to
+# the response, at a time
+BATCH_SIZE = 500
+
+
+def iter_serialized(query, attribute='serialize', batch_size=BATCH_SIZE):
+    """
+    Yields the given serialize property of each object from query, loading
+    the objects from the database batch_size rows at a time.
+
+    >>> list(iter_serialized(session.query(User), 'serialize_summary'))
+    [{'name': 'Paul', 'id': 1, ...}, ...]
+    """
+    for item in query.yield_per(batch_size):
+        yield getattr(item, attribute)
+
+
+def iter_json_array(items, batch_size=BATCH_SIZE):
+    """Yields a JSON array of items in chunks of batch_size items."""
+    chunk = ['[']
+    for i, item in enumerate(items):
+        if i:
+            chunk.append(', ')
+        chunk.append(json.dumps(item))
+        if len(chunk) >= 2 * batch_size:
+            yield ''.join(chunk)
+            chunk = []
+    chunk.append(']')
+    yield ''.join(chunk)
+
+
+def iter_json_object(collections, batch_size=BATCH_SIZE):
+    """
+    Yields a JSON object with the keys of collections in sorted order. List,
+    tuple and iterator (e.g. generator) values are written out as arrays
+    item by item, and all other values are written out whole.
+
+    >>> ''.join(iter_json_object({'Game': iter([{'id': 1}]), 'next': None}))
+    '{"Game": [{"id": 1}], "next": null}'
+    """
+    yield '{'
+    for i, key in enumerate(sorted(collections)):
+        prefix = '%s%s: ' % (', ' if i else '', json.dumps(key))
+        value = collections[key]
+        if isinstance(value, (list, tuple, Iterator)):
+            yield prefix
+            for chunk in iter_json_array(value, batch_size):
+                yield chunk
+        else:
+            yield prefix + json.dumps(value)
+    yield '}'
+
+
+def stream_json(**collections):
+    """
+    Returns a chunked JSON response made from the keyword arguments. Routes
+    opt in by returning this instead of jsonify. The request context is
+    kept for the length of the stream, so generators may keep using the
+    database session.
+
+    return stream_json(Game=iter_serialized(session.query(Game)))
+    """
+    return Response(stream_with_context(iter_json_object(collections)),
+                    mimetype='application/json')
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+#
+# In-process leaderboards of the highest rated games, overall and within
+# each category, kept sorted as ratings change so top-N lookups don't touch
+# the database.
+#
+import threading
+import time
+
+from bisect import bisect_left, insort
+
+
+def get_key(game):
+    """
+    Returns the sort key for a serialized game: highest rank score (see
+    ranking.py) first, then lowest id.
+    """
+    return (-(game['rank_score'] or 0), game['id'])
+
+
+class Leaderboards(object):
+    """
+    Thread safe sorted lists of serialized games, one holding every game
+    and one per category. load_games is called to (re)build the lists and
+    returns an iterable of serialized games. Lists older than max_age
+    seconds (if given) are rebuilt on the next lookup, which bounds how
+    stale they can get in worker processes that didn't see an update.
+
+    >>> leaderboards = Leaderboards(load_games)
+    >>> leaderboards.top(3, category='RPG')
+    [{'id': 3, 'name': 'Nioh', 'rank_score': 9.1, ...}, ...]
+    """
+
+    def __init__(self, load_games, max_age=None):
+        self.load_games = load_games
+        self.max_age = max_age
+        self._games = {}
+        self._all = []
+        self._by_category = {}
+        self._built = None
+        self._pending = None
+        self._lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+
+    def rebuild(self):
+        """
+        Rebuilds the lists from load_games. Updates made while the games
+        are loading are applied on top, so none of them are lost.
+        """
+        with self._rebuild_lock:
+            self._load()
+
+    def refresh(self):
+        """
+        Rebuilds the lists if they are stale. If the lists have expired,
+        one thread rebuilds them while the others keep using the old ones;
+        if they were never built or were invalidated, every thread waits
+        for the one rebuilding them.
+        """
+        if not self.is_stale():
+            return
+        if self._built is None:
+            self._rebuild_lock.acquire()
+        elif not self._rebuild_lock.acquire(False):
+            return
+        try:
+            # Another thread may have rebuilt them while this one waited
+            if self.is_stale():
+                self._load()
+        finally:
+            self._rebuild_lock.release()
+
+    def _load(self):
+        """Builds the lists from load_games. Call with _rebuild_lock held."""
+        with self._lock:
+            self._pending = []
+        try:
+            games = {}
+            by_category = {}
+            for game in self.load_games():
+                games[game['id']] = game
+                by_category.setdefault(game['category'], []).append(
+                    get_key(game))
+            for keys in by_category.values():
+                keys.sort()
+            all_keys = sorted(get_key(game) for game in games.values())
+        except:
+            with self._lock:
+                self._pending = None
+            raise
+
+        with self._lock:
+            pending, self._pending = self._pending, None
+            self._games = games
+            self._all = all_keys
+            self._by_category = by_category
+            self._built = time.time()
+            for game_id, game in pending:
+                self._apply(game_id, game)
+
+    def invalidate(self):
+        """Marks the lists as stale, so the next lookup rebuilds them."""
+        with self._lock:
+            self._built = None
+
+    def update(self, game):
+        """Adds a serialized game, or moves it to its new place."""
+        self._change(game['id'], game)
+
+    def remove(self, game_id):
+        """Removes the game with the given id, if it is listed."""
+        self._change(game_id, None)
+
+    def _change(self, game_id, game):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((game_id, game))
+            self._apply(game_id, game)
+
+    def _apply(self, game_id, game):
+        """Replaces the listed game with game (None to remove it)."""
+        old_game = self._games.pop(game_id, None)
+        if old_game is not None:
+            old_key = get_key(old_game)
+            remove_key(self._all, old_key)
+            category = self._by_category.get(old_game['category'], [])
+            remove_key(category, old_key)
+            if not category:
+                self._by_category.pop(old_game['category'], None)
+
+        if game is not None:
+            key = get_key(game)
+            self._games[game_id] = game
+            insort(self._all, key)
+            insort(self._by_category.setdefault(game['category'], []), key)
+
+    def is_stale(self):
+        """Returns True if the lists need to be (re)built."""
+        return self._built is None or (
+            self.max_age is not None and
+            time.time() - self._built > self.max_age)
+
+    def top(self, limit=10, category=None):
+        """
+        Returns the limit highest rated serialized games, in the given
+        category if one is given.
+        """
+        self.refresh()
+        with self._lock:
+            if category is None:
+                keys = self._all[:limit]
+            else:
+                keys = self._by_category.get(category, [])[:limit]
+            return [self._games[game_id] for rating, game_id in keys]
+
+    def categories(self):
+        """Returns a dict of each category to its number of games."""
+        self.refresh()
+        with self._lock:
+            return dict((category, len(keys))
+                        for category, keys in self._by_category.items())
+
+
+def remove_key(keys, key):
+    """Removes key from the sorted list keys, if it is there."""
+    index = bisect_left(keys, key)
+    if index < len(keys) and keys[index] == key:
+        del keys[index]
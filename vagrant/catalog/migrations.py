@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+#
+# Versioned schema migrations for the gamerater database. Brings a
+# favoritegames.db created by an older version of database_setup.py up to
+# date in place. The version of each applied migration is recorded in the
+# schema_version table, so running this again only applies new migrations.
+# The tables are created, and each migration is run, in a BEGIN IMMEDIATE
+# transaction that checks schema_version again once it holds the write
+# lock, so processes starting together apply each migration once.
+#
+# Usage: python migrations.py [--database URL]
+#
+import argparse
+
+from contextlib import contextmanager
+from datetime import datetime
+
+from sqlalchemy import create_engine, inspect
+
+import ranking
+import search
+from database_setup import Base, RatingEvent
+
+
+def add_rating_totals(connection):
+    """
+    Adds the game's running rating sum and count, filled in from the
+    existing ratings.
+    """
+    existing = [column['name'] for column in
+                inspect(connection).get_columns('game')]
+    if 'rating_sum' in existing and 'rating_count' in existing:
+        return
+
+    for name in ('rating_sum', 'rating_count'):
+        if name not in existing:
+            connection.execute('ALTER TABLE game ADD COLUMN %s INTEGER '
+                               'NOT NULL DEFAULT 0' % name)
+    connection.execute(
+        """
+        UPDATE game SET
+            rating_sum = (SELECT COALESCE(SUM(rating), 0) FROM usersgames
+                          WHERE usersgames.game_id = game.id),
+            rating_count = (SELECT COUNT(rating) FROM usersgames
+                            WHERE usersgames.game_id = game.id)
+        """)
+
+
+def add_lookup_indexes(connection):
+    """
+    Adds indexes for the lookups done on every page: a user's top and
+    latest ratings, a game's ratings, the latest ratings, games by name and
+    average rating, and users by email.
+    """
+    for statement in (
+            'CREATE INDEX IF NOT EXISTS ix_usersgames_user_id_rating '
+            'ON usersgames (user_id, rating)',
+            'CREATE INDEX IF NOT EXISTS ix_usersgames_user_id_modified '
+            'ON usersgames (user_id, modified)',
+            'CREATE INDEX IF NOT EXISTS ix_usersgames_game_id_user_id '
+            'ON usersgames (game_id, user_id)',
+            'CREATE INDEX IF NOT EXISTS ix_usersgames_modified '
+            'ON usersgames (modified)',
+            'CREATE INDEX IF NOT EXISTS ix_game_name ON game (name)',
+            'CREATE INDEX IF NOT EXISTS ix_game_avg_rating '
+            'ON game (avg_rating)',
+            'CREATE INDEX IF NOT EXISTS ix_user_email ON user (email)'):
+        connection.execute(statement)
+
+
+def add_user_modified(connection):
+    """Adds the time of the last change to each user or their ratings."""
+    existing = [column['name'] for column in
+                inspect(connection).get_columns('user')]
+    if 'modified' not in existing:
+        connection.execute('ALTER TABLE user ADD COLUMN modified DATETIME')
+
+
+def add_game_search(connection):
+    """
+    Adds the full text search table over the games, and the triggers that
+    keep it up to date.
+    """
+    search.create_search_index(connection)
+
+
+def add_rank_score(connection):
+    """
+    Adds each game's confidence weighted rank score, indexed, and fills it
+    in with the ranking job.
+    """
+    existing = [column['name'] for column in
+                inspect(connection).get_columns('game')]
+    if 'rank_score' not in existing:
+        connection.execute('ALTER TABLE game ADD COLUMN rank_score FLOAT')
+    connection.execute('CREATE INDEX IF NOT EXISTS ix_game_rank_score '
+                       'ON game (rank_score)')
+    ranking.rank_games(connection)
+
+
+def add_rating_events(connection):
+    """
+    Starts the rating event log with an event for each existing rating, at
+    the time it was last changed, so the trends cover the ratings made
+    before the log.
+    """
+    if connection.execute('SELECT 1 FROM rating_event LIMIT 1').first():
+        return
+    connection.execute(
+        """
+        INSERT INTO rating_event (user_id, game_id, old_rating, new_rating,
+                                  created)
+        SELECT user_id, game_id, NULL, rating, COALESCE(modified, ?)
+        FROM usersgames WHERE rating IS NOT NULL ORDER BY modified, id
+        """, (datetime.now(),))
+
+
+def add_rating_event_autoincrement(connection):
+    """
+    Rebuilds the rating event log with AUTOINCREMENT ids, so events added
+    after old ones are compacted don't reuse ids already rolled up.
+    """
+    table_sql = connection.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' "
+        "AND name = 'rating_event'").scalar()
+    if 'AUTOINCREMENT' in table_sql.upper():
+        return
+    connection.execute('DROP INDEX IF EXISTS ix_rating_event_created')
+    connection.execute('ALTER TABLE rating_event RENAME TO rating_event_old')
+    RatingEvent.__table__.create(connection)
+    connection.execute(
+        """
+        INSERT INTO rating_event (id, user_id, game_id, old_rating,
+                                  new_rating, created)
+        SELECT id, user_id, game_id, old_rating, new_rating, created
+        FROM rating_event_old
+        """)
+    connection.execute('DROP TABLE rating_event_old')
+
+    # Start new ids past every event already rolled up, even deleted ones
+    connection.execute(
+        "DELETE FROM sqlite_sequence WHERE name = 'rating_event'")
+    connection.execute(
+        """
+        INSERT INTO sqlite_sequence (name, seq) VALUES ('rating_event',
+            MAX((SELECT COALESCE(MAX(id), 0) FROM rating_event),
+                (SELECT COALESCE(MAX(last_event_id), 0)
+                 FROM rollup_progress)))
+        """)
+
+
+def add_unique_ratings(connection):
+    """
+    Keeps only the latest of each user's ratings of a game, fixing the
+    totals of the games that had more than one, and makes the game and user
+    index unique so there can't be more.
+    """
+    for row in connection.execute('PRAGMA index_list(usersgames)'):
+        if row[1] == 'ix_usersgames_game_id_user_id' and row[2]:
+            return
+
+    game_ids = [row[0] for row in connection.execute(
+        'SELECT DISTINCT game_id FROM usersgames '
+        'GROUP BY game_id, user_id HAVING COUNT(*) > 1')]
+    connection.execute(
+        """
+        DELETE FROM usersgames WHERE id NOT IN (
+            SELECT (SELECT latest.id FROM usersgames AS latest
+                    WHERE latest.game_id = pairs.game_id
+                    AND latest.user_id = pairs.user_id
+                    ORDER BY latest.modified DESC, latest.id DESC LIMIT 1)
+            FROM (SELECT DISTINCT game_id, user_id FROM usersgames) AS pairs)
+        """)
+    for game_id in game_ids:
+        connection.execute(
+            """
+            UPDATE game SET
+                rating_sum = (SELECT COALESCE(SUM(rating), 0)
+                              FROM usersgames WHERE game_id = game.id),
+                rating_count = (SELECT COUNT(rating) FROM usersgames
+                                WHERE game_id = game.id),
+                avg_rating = COALESCE((SELECT AVG(rating) FROM usersgames
+                                       WHERE game_id = game.id), 0)
+            WHERE id = ?
+            """, (game_id,))
+    if game_ids:
+        ranking.rank_games(connection)
+
+    connection.execute('DROP INDEX IF EXISTS ix_usersgames_game_id_user_id')
+    connection.execute('CREATE UNIQUE INDEX ix_usersgames_game_id_user_id '
+                       'ON usersgames (game_id, user_id)')
+
+
+def add_game_trigrams(connection):
+    """
+    Rebuilds the search tables with the game_trigram table that fuzzy
+    searches look names up in, and its triggers.
+    """
+    search.create_search_index(connection)
+
+
+def add_modified_indexes(connection):
+    """
+    Adds indexes for the latest change to any game or user, which the home
+    JSON's validators look up.
+    """
+    connection.execute('CREATE INDEX IF NOT EXISTS ix_game_modified '
+                       'ON game (modified)')
+    connection.execute('CREATE INDEX IF NOT EXISTS ix_user_modified '
+                       'ON user (modified)')
+
+
+# Every migration in the order it must be applied, as (version, function).
+# Add new migrations to the end with the next version number. Migrations
+# must also work on a database that create_all already brought up to date.
+MIGRATIONS = [
+    (1, add_rating_totals),
+    (2, add_lookup_indexes),
+    (3, add_user_modified),
+    (4, add_game_search),
+    (5, add_rank_score),
+    (6, add_rating_events),
+    (7, add_rating_event_autoincrement),
+    (8, add_unique_ratings),
+    (9, add_game_trigrams),
+    (10, add_modified_indexes),
+]
+
+
+def get_applied_versions(connection):
+    """Returns the set of migration versions applied to the database."""
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            applied DATETIME NOT NULL
+        )
+        """)
+    return set(row[0] for row in
+               connection.execute('SELECT version FROM schema_version'))
+
+
+@contextmanager
+def exclusive_transaction(engine):
+    """
+    Yields a connection in a BEGIN IMMEDIATE transaction, which takes the
+    write lock before anything is read, and commits it at the end (or
+    rolls it back on an error). The driver is kept from committing the
+    transaction early, as pysqlite does before DDL statements.
+    """
+    connection = engine.connect().execution_options(autocommit=False)
+    dbapi_connection = connection.connection.connection
+    dbapi_connection.isolation_level = None
+    try:
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+    finally:
+        dbapi_connection.isolation_level = ''
+        connection.close()
+
+
+def apply_migration(engine, version, migration):
+    """
+    Applies migration and records its version in one exclusive
+    transaction, unless another process applied it first, and returns True
+    if it was applied.
+    """
+    with exclusive_transaction(engine) as connection:
+        if connection.execute(
+                'SELECT 1 FROM schema_version WHERE version = ?',
+                (version,)).first():
+            return False
+        migration(connection)
+        connection.execute(
+            'INSERT INTO schema_version (version, applied) VALUES (?, ?)',
+            (version, datetime.now()))
+    return True
+
+
+def upgrade(engine):
+    """
+    Creates any missing tables, then applies every migration that hasn't
+    been applied to the database yet, each in its own transaction, and
+    returns the versions applied.
+
+    >>> upgrade(create_engine('sqlite:///favoritegames.db'))
+    [1, 2, 3, 4, 5, 6, 7, 8]
+    """
+    with exclusive_transaction(engine) as connection:
+        Base.metadata.create_all(connection)
+        applied = get_applied_versions(connection)
+    newly_applied = []
+    for version, migration in MIGRATIONS:
+        if version in applied:
+            continue
+        if apply_migration(engine, version, migration):
+            newly_applied.append(version)
+    return newly_applied
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Bring the gamerater database schema up to date.")
+    parser.add_argument('--database', default='sqlite:///favoritegames.db',
+                        help="database url (default: %(default)s)")
+    args = parser.parse_args()
+
+    newly_applied = upgrade(create_engine(args.database))
+    for version, migration in MIGRATIONS:
+        if version in newly_applied:
+            print "Applied %s: %s" % (version, migration.__name__)
+    if not newly_applied:
+        print "The database is already up to date."
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+#
+# Confidence weighted scores for ranking the games. A game's rank_score is
+# its Bayesian average: its ratings blended with PRIOR_WEIGHT ratings at the
+# average of every rating, so a game with a single 10 doesn't outrank one
+# with hundreds of ratings averaging 9.4, while a game's score approaches
+# its own average as its ratings add up. Games without ratings score 0.
+#
+# The average of every rating and the weight are kept in the rating_prior
+# table. The ranking job recomputes the average from the games' rating
+# totals and rescores every game in one UPDATE, moving the modified time of
+# the games whose score changed; between runs each rating write rescores
+# its game from the stored prior. The prior is also checked at startup and
+# every minute by the refresher, and the games rescored as soon as the
+# average of every rating drifts from it, e.g. as a new database gets its
+# first ratings. Run the job with:
+#
+# Usage: python ranking.py [--weight N] [--database URL]
+#
+import argparse
+import threading
+import time
+
+from datetime import datetime
+
+from sqlalchemy import case, func, or_, select
+
+import migrations
+from database_setup import Game, RatingPrior, create_db_engine
+
+# Ratings at the average of every rating blended into each game's score
+PRIOR_WEIGHT = 10
+
+# Seconds between runs of the ranking job by the background refresher
+RANK_INTERVAL = 3600
+
+# Seconds between checks of the stored prior, and how far the average of
+# every rating may drift from it before the games are rescored
+PRIOR_CHECK_INTERVAL = 60
+PRIOR_TOLERANCE = 0.05
+
+games = Game.__table__
+priors = RatingPrior.__table__
+
+
+def get_score(rating_sum, rating_count, mean, weight):
+    """
+    Returns the SQL expression for a game's rank_score from its rating
+    totals and the prior's mean and weight, which may be numbers or SQL
+    expressions.
+    """
+    return case([(rating_count > 0,
+                  (rating_sum + mean * weight) * 1.0 /
+                  (rating_count + weight))],
+                else_=0)
+
+
+def get_stored_score(rating_sum, rating_count):
+    """
+    Returns the SQL expression for a game's rank_score using the stored
+    prior, looked up by primary key in the same statement.
+    """
+    return get_score(
+        rating_sum, rating_count,
+        select([priors.c.mean]).where(priors.c.id == 1).as_scalar(),
+        select([priors.c.weight]).where(priors.c.id == 1).as_scalar())
+
+
+def rank_games(connection, weight=PRIOR_WEIGHT):
+    """
+    Recomputes the average of every rating from the games' totals, stores
+    it as the prior, and rescores every game with it in one statement.
+    Returns the new average.
+
+    >>> rank_games(connection)
+    6.84
+    """
+    mean = get_mean(connection)
+    now = datetime.now()
+    connection.execute(priors.delete())
+    connection.execute(priors.insert(), {'id': 1, 'mean': mean,
+                                         'weight': float(weight),
+                                         'modified': now})
+
+    # Only games whose score changes are written, and their JSON validators
+    # move with the score
+    score = get_score(games.c.rating_sum, games.c.rating_count, mean,
+                      float(weight))
+    connection.execute(games.update().where(or_(
+        games.c.rank_score == None, games.c.rank_score != score)).values(
+        rank_score=score, modified=now))
+    return mean
+
+
+def get_mean(connection):
+    """Returns the average of every rating, from the games' totals."""
+    rating_sum, rating_count = connection.execute(
+        select([func.sum(games.c.rating_sum),
+                func.sum(games.c.rating_count)])).first()
+    return float(rating_sum) / rating_count if rating_count else 0.0
+
+
+def refresh_prior(connection, weight=PRIOR_WEIGHT,
+                  tolerance=PRIOR_TOLERANCE):
+    """
+    Rescores every game with rank_games if there is no stored prior, it has
+    another weight, or the average of every rating has drifted more than
+    tolerance from it. Returns True if the games were rescored.
+    """
+    prior = connection.execute(
+        select([priors.c.mean, priors.c.weight]).where(
+            priors.c.id == 1)).first()
+    if (prior is not None and prior[1] == weight and
+            abs(get_mean(connection) - prior[0]) <= tolerance):
+        return False
+    rank_games(connection, weight)
+    return True
+
+
+def start_refresher(engine, interval=RANK_INTERVAL, weight=PRIOR_WEIGHT,
+                    check_interval=PRIOR_CHECK_INTERVAL):
+    """
+    Runs the ranking job every interval seconds in a daemon thread, and
+    checks the prior every check_interval seconds in between, so the prior
+    follows the ratings.
+    """
+    def run():
+        ranked = time.time()
+        while True:
+            time.sleep(check_interval)
+            try:
+                with engine.begin() as connection:
+                    if time.time() - ranked >= interval:
+                        rank_games(connection, weight)
+                        ranked = time.time()
+                    elif refresh_prior(connection, weight):
+                        ranked = time.time()
+            except Exception as e:
+                print "Could not rank the games: %s" % e
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Recompute every game's rank score.")
+    parser.add_argument('--database', default='sqlite:///favoritegames.db',
+                        help="database url (default: %(default)s)")
+    parser.add_argument('--weight', type=float, default=PRIOR_WEIGHT,
+                        help="average ratings blended into each game's "
+                             "score (default: %(default)s)")
+    args = parser.parse_args()
+
+    engine = create_db_engine(args.database)
+    migrations.upgrade(engine)
+    with engine.begin() as connection:
+        mean = rank_games(connection, args.weight)
+    print "Ranked the games against an average rating of %.2f." % mean
+
+
+if __name__ == '__main__':
+    main()
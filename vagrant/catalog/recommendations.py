@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+#
+# Item-item recommendations from the ratings in UsersGames. The ratings are
+# loaded into a sparse user x game matrix, each user's ratings are centred
+# on their average, and the cosine similarity of every pair of games rated
+# by the same users is computed with sparse matrix products, a batch of
+# games at a time. Each game's most similar games are written to the
+# game_similarity table in one transaction, so the pages and JSON routes
+# only read precomputed rows.
+#
+# gamerater rebuilds the table in a background thread when the ratings
+# change. To rebuild it by hand (e.g. from cron when running several
+# servers), run:
+#
+# Usage: python recommendations.py [--neighbors K] [--database URL]
+#
+# Needs the numpy and scipy packages.
+#
+import argparse
+import itertools
+import threading
+import time
+
+import migrations
+from database_setup import GameSimilarity, create_db_engine
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:
+    np = None
+    sparse = None
+
+# Similar games kept for each game
+NEIGHBORS = 20
+
+# Fewest users who must have rated both games for them to be similar
+MIN_COMMON_RATERS = 2
+
+# Similarities of games with few common raters are shrunk towards 0 by
+# common / (common + SHRINKAGE), so a couple of matching ratings don't
+# outrank many
+SHRINKAGE = 10
+
+# Games whose similarities are computed in one matrix product
+BATCH_SIZE = 500
+
+# Rows written per executemany
+INSERT_CHUNK_SIZE = 10000
+
+# Seconds between checks for changed ratings by the background refresher
+REFRESH_INTERVAL = 300
+
+similarities = GameSimilarity.__table__
+
+
+def load_ratings(connection):
+    """
+    Returns every rating as an array of (user_id, game_id, rating) rows,
+    read straight from the cursor without building a list of tuples.
+    """
+    result = connection.execute(
+        'SELECT user_id, game_id, rating FROM usersgames '
+        'WHERE rating IS NOT NULL')
+    values = np.fromiter(itertools.chain.from_iterable(result),
+                         dtype=np.int64)
+    return values.reshape(-1, 3)
+
+
+def build_matrices(ratings):
+    """
+    Returns the game ids in column order, the user x game matrix of ratings
+    centred on each user's average, and the user x game matrix of ones
+    marking who rated what.
+    """
+    user_ids, user_index = np.unique(ratings[:, 0], return_inverse=True)
+    game_ids, game_index = np.unique(ratings[:, 1], return_inverse=True)
+    values = ratings[:, 2].astype(np.float64)
+    shape = (len(user_ids), len(game_ids))
+
+    # Centre each user's ratings, so games are similar when the same users
+    # rate them above (or below) their other games, whatever their scale
+    means = (np.bincount(user_index, weights=values) /
+             np.bincount(user_index))
+    centred = sparse.csr_matrix(
+        (values - means[user_index], (user_index, game_index)), shape=shape)
+    rated = sparse.csr_matrix(
+        (np.ones(len(values)), (user_index, game_index)), shape=shape)
+    return game_ids, centred, rated
+
+
+def find_neighbors(game_ids, centred, rated, neighbors=NEIGHBORS,
+                   min_common=MIN_COMMON_RATERS, shrinkage=SHRINKAGE,
+                   batch_size=BATCH_SIZE):
+    """
+    Yields (game_ids, similar_game_ids, ranks, scores) arrays, one set per
+    batch of games, holding up to neighbors positively similar games for
+    each game in the batch, best first.
+    """
+    # Scale each game's column to unit length, so the products of columns
+    # are cosine similarities. Games rated the same by everyone have no
+    # length and stay at 0.
+    lengths = np.sqrt(np.asarray(centred.multiply(centred).sum(axis=0)))
+    lengths = lengths.ravel()
+    lengths[lengths == 0] = 1
+    normalized = (centred * sparse.diags(1.0 / lengths)).tocsc()
+    normalized_rows = normalized.T.tocsr()
+    rated = rated.tocsc()
+    rated_rows = rated.T.tocsr()
+
+    for start in xrange(0, len(game_ids), batch_size):
+        stop = min(start + batch_size, len(game_ids))
+
+        # Weigh each pair by its number of common raters, dropping pairs
+        # with too few
+        common = (rated_rows[start:stop] * rated).tocsr()
+        common.data[common.data < min_common] = 0
+        common.data /= common.data + shrinkage
+        common.eliminate_zeros()
+        scores = (normalized_rows[start:stop] * normalized).multiply(
+            common).tocoo()
+
+        # Keep the positive scores of other games, sorted by game and then
+        # best score first, and cut each game's list at neighbors
+        keep = (scores.data > 0) & (scores.col != scores.row + start)
+        rows = scores.row[keep]
+        cols = scores.col[keep]
+        data = scores.data[keep]
+        order = np.lexsort((cols, -data, rows))
+        rows, cols, data = rows[order], cols[order], data[order]
+        ranks = np.arange(len(rows)) - np.searchsorted(rows, rows)
+        keep = ranks < neighbors
+
+        yield (game_ids[rows[keep] + start], game_ids[cols[keep]],
+               ranks[keep] + 1, data[keep])
+
+
+def rebuild_similarities(engine, neighbors=NEIGHBORS, **options):
+    """
+    Recomputes every game's similar games from the ratings and replaces
+    the game_similarity table with them in one transaction, so readers see
+    either the old or the new table. Returns the number of rows written.
+    options are passed on to find_neighbors.
+
+    >>> rebuild_similarities(engine)
+    48120
+    """
+    if np is None:
+        raise RuntimeError("The numpy and scipy packages are needed to "
+                           "build recommendations")
+
+    with engine.connect() as connection:
+        ratings = load_ratings(connection)
+
+    rows = []
+    if len(ratings):
+        game_ids, centred, rated = build_matrices(ratings)
+        for batch in find_neighbors(game_ids, centred, rated, neighbors,
+                                    **options):
+            rows.extend({'game_id': game_id,
+                         'similar_game_id': similar_game_id,
+                         'rank': rank,
+                         'score': score}
+                        for game_id, similar_game_id, rank, score in
+                        zip(*[values.tolist() for values in batch]))
+
+    with engine.begin() as connection:
+        connection.execute(similarities.delete())
+        for start in xrange(0, len(rows), INSERT_CHUNK_SIZE):
+            connection.execute(similarities.insert(),
+                               rows[start:start + INSERT_CHUNK_SIZE])
+    return len(rows)
+
+
+class SimilarityRefresher(object):
+    """
+    Rebuilds the game_similarity table in a background thread whenever the
+    ratings have changed, checking every interval seconds. The ratings
+    count as changed when their number, latest id or latest modified time
+    differs from the last rebuild.
+
+    >>> refresher = SimilarityRefresher(engine)
+    >>> refresher.start()
+    """
+
+    def __init__(self, engine, interval=REFRESH_INTERVAL, **options):
+        self.engine = engine
+        self.interval = interval
+        self.options = options
+        self._signature = None
+        self._lock = threading.Lock()
+
+    def get_signature(self):
+        """Returns a summary of the ratings that changes when they do."""
+        return tuple(self.engine.execute(
+            'SELECT COUNT(*), MAX(id), MAX(modified) '
+            'FROM usersgames').first())
+
+    def refresh(self):
+        """
+        Rebuilds the table if the ratings have changed since the last
+        rebuild, and returns whether it did.
+        """
+        with self._lock:
+            signature = self.get_signature()
+            if signature == self._signature:
+                return False
+            rebuild_similarities(self.engine, **self.options)
+            self._signature = signature
+            return True
+
+    def run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                print "Could not rebuild the similar games: %s" % e
+            time.sleep(self.interval)
+
+    def start(self):
+        """
+        Starts refreshing in a daemon thread, or does nothing if numpy and
+        scipy aren't installed.
+        """
+        if np is None:
+            print ("numpy and scipy aren't installed, so similar games and "
+                   "recommendations won't be built.")
+            return
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Rebuild the similar games from the ratings.")
+    parser.add_argument('--database', default='sqlite:///favoritegames.db',
+                        help="database url (default: %(default)s)")
+    parser.add_argument('--neighbors', type=int, default=NEIGHBORS,
+                        help="similar games kept per game "
+                             "(default: %(default)s)")
+    args = parser.parse_args()
+
+    engine = create_db_engine(args.database)
+    migrations.upgrade(engine)
+    start = time.time()
+    count = rebuild_similarities(engine, args.neighbors)
+    print "Wrote %s similar games in %.1f seconds." % (
+        count, time.time() - start)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+#
+# Recomputes every game's rating sum, count and average from UsersGames,
+# reports the games whose stored totals had drifted, and fixes them.
+#
+# Usage: python reconcile_ratings.py [--dry-run] [--database URL]
+#
+import argparse
+
+from sqlalchemy import func
+from sqlalchemy.orm import sessionmaker
+
+import migrations
+import ranking
+from database_setup import Game, UsersGames, create_db_engine
+
+
+def find_drift(session):
+    """
+    Returns a list of dicts, one for each game whose stored totals don't
+    match its ratings, holding the stored and actual values.
+
+    >>> find_drift(session)
+    [{'id': 3, 'name': 'Nioh', 'stored_sum': 14, 'actual_sum': 17, ...}]
+    """
+    totals = session.query(
+        UsersGames.game_id.label('game_id'),
+        func.sum(UsersGames.rating).label('rating_sum'),
+        func.count(UsersGames.rating).label('rating_count')).group_by(
+        UsersGames.game_id).subquery()
+
+    rows = session.query(
+        Game.id, Game.name, Game.rating_sum, Game.rating_count,
+        Game.avg_rating, totals.c.rating_sum,
+        totals.c.rating_count).outerjoin(
+        totals, Game.id == totals.c.game_id)
+
+    drift = []
+    for (game_id, name, stored_sum, stored_count, stored_avg,
+         actual_sum, actual_count) in rows:
+        actual_sum = actual_sum or 0
+        actual_count = actual_count or 0
+        if actual_count:
+            actual_avg = float(actual_sum) / actual_count
+        else:
+            actual_avg = 0
+
+        if (stored_sum != actual_sum or stored_count != actual_count or
+                stored_avg is None or abs(stored_avg - actual_avg) > 1e-9):
+            drift.append({
+                'id': game_id,
+                'name': name,
+                'stored_sum': stored_sum,
+                'actual_sum': actual_sum,
+                'stored_count': stored_count,
+                'actual_count': actual_count,
+                'stored_avg': stored_avg,
+                'actual_avg': actual_avg
+            })
+    return drift
+
+
+def fix_drift(session, drift):
+    """
+    Writes the actual totals for the drifted games, and rescores every
+    game against them, in one transaction.
+    """
+    if not drift:
+        return
+    session.bulk_update_mappings(Game, [{
+        'id': game['id'],
+        'rating_sum': game['actual_sum'],
+        'rating_count': game['actual_count'],
+        'avg_rating': game['actual_avg']
+    } for game in drift])
+    ranking.rank_games(session.connection())
+    session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Recompute game rating totals and report drift.")
+    parser.add_argument('--database', default='sqlite:///favoritegames.db',
+                        help="database url (default: %(default)s)")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="only report drift, don't fix it")
+    args = parser.parse_args()
+
+    engine = create_db_engine(args.database)
+    migrations.upgrade(engine)
+    session = sessionmaker(bind=engine)()
+
+    drift = find_drift(session)
+    for game in drift:
+        print ("%(name)s (id %(id)s): sum %(stored_sum)s -> %(actual_sum)s, "
+               "count %(stored_count)s -> %(actual_count)s, "
+               "average %(stored_avg)s -> %(actual_avg)s" % game)
+
+    if args.dry_run:
+        print "%s games have drifted." % len(drift)
+    else:
+        fix_drift(session, drift)
+        print "%s games have been reconciled." % len(drift)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+#
+# Full text search over the games' names, categories and descriptions,
+# using an SQLite FTS5 table (or FTS4 on older SQLite versions). Misspelled
+# names are looked up by the three letter sequences (trigrams) they share
+# with the games' names, which are kept in the indexed game_trigram table.
+# Triggers keep both tables in step with the game table, so games added by
+# the app or by import_ratings.py are searchable straight away.
+#
+import re
+
+from difflib import SequenceMatcher
+
+# Most matching games ordered by rating for each search. Very broad
+# searches (e.g. one letter) are ordered among the first this many matches.
+MATCH_CANDIDATES = 1000
+
+# Most games, sharing the most trigrams with the search text, scored when
+# no game matches it
+FUZZY_CANDIDATES = 40
+
+# Most games read from the index of the search text's rarest trigrams to
+# find the fuzzy candidates among
+FUZZY_POSTINGS = 250
+
+# Longest name whose every trigram is indexed
+TRIGRAM_NAME_LENGTH = 256
+
+# Lowest similarity, from 0 to 1, for a fuzzy match
+FUZZY_CUTOFF = 0.6
+
+
+# Adds the trigrams of the names of the (id, name) rows of a table or
+# subquery, padded as in get_trigrams
+INSERT_TRIGRAMS = """
+    INSERT OR IGNORE INTO game_trigram (trigram, game_id)
+    SELECT substr('  ' || lower(games.name) || ' ', position, 3), games.id
+    FROM %s AS games
+    JOIN trigram_position ON position <= length(games.name) + 1
+"""
+INSERT_NEW_TRIGRAMS = INSERT_TRIGRAMS % (
+    '(SELECT new.id AS id, new.name AS name)')
+
+
+def get_fts_module(connection):
+    """Returns the newest full text search module SQLite supports."""
+    for module in ('fts5', 'fts4'):
+        try:
+            connection.execute(
+                'CREATE VIRTUAL TABLE temp.fts_check USING %s(a)' % module)
+            connection.execute('DROP TABLE temp.fts_check')
+            return module
+        except Exception:
+            continue
+    raise RuntimeError("SQLite was built without full text search.")
+
+
+def create_search_index(connection):
+    """
+    Creates the game_search and game_trigram tables, fills them from the
+    game table and adds the triggers that keep them in step.
+    """
+    connection.execute(
+        'CREATE VIRTUAL TABLE IF NOT EXISTS game_search USING %s('
+        'name, category, description)' % get_fts_module(connection))
+    connection.execute('DELETE FROM game_search')
+    connection.execute(
+        'INSERT INTO game_search (rowid, name, category, description) '
+        'SELECT id, name, category, description FROM game')
+
+    # The trigrams of each name are selected by joining it with the
+    # positions they start at
+    connection.execute('CREATE TABLE IF NOT EXISTS trigram_position ('
+                       'position INTEGER PRIMARY KEY)')
+    connection.execute('DELETE FROM trigram_position')
+    connection.execute('INSERT INTO trigram_position (position) VALUES (?)',
+                       [(position,) for position in
+                        xrange(1, TRIGRAM_NAME_LENGTH + 1)])
+
+    # Each trigram's games, and how many there are, so fuzzy searches only
+    # read the games of the rarest trigrams
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS game_trigram (
+            trigram TEXT NOT NULL,
+            game_id INTEGER NOT NULL,
+            PRIMARY KEY (trigram, game_id)
+        ) WITHOUT ROWID
+        """)
+    connection.execute('CREATE INDEX IF NOT EXISTS ix_game_trigram_game_id '
+                       'ON game_trigram (game_id)')
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS trigram_count (
+            trigram TEXT PRIMARY KEY,
+            games INTEGER NOT NULL
+        ) WITHOUT ROWID
+        """)
+
+    for name in ('game_search_insert', 'game_search_update',
+                 'game_search_delete', 'game_trigram_insert',
+                 'game_trigram_delete'):
+        connection.execute('DROP TRIGGER IF EXISTS %s' % name)
+    connection.execute('DELETE FROM game_trigram')
+    connection.execute(INSERT_TRIGRAMS % 'game')
+    connection.execute('DELETE FROM trigram_count')
+    connection.execute('INSERT INTO trigram_count (trigram, games) '
+                       'SELECT trigram, COUNT(*) FROM game_trigram '
+                       'GROUP BY trigram')
+
+    for statement in (
+            """
+            CREATE TRIGGER game_search_insert
+            AFTER INSERT ON game BEGIN
+                INSERT INTO game_search (rowid, name, category, description)
+                VALUES (new.id, new.name, new.category, new.description);
+                %s;
+            END
+            """ % INSERT_NEW_TRIGRAMS,
+            """
+            CREATE TRIGGER game_search_update
+            AFTER UPDATE OF name, category, description ON game BEGIN
+                DELETE FROM game_search WHERE rowid = old.id;
+                INSERT INTO game_search (rowid, name, category, description)
+                VALUES (new.id, new.name, new.category, new.description);
+                DELETE FROM game_trigram WHERE game_id = old.id;
+                %s;
+            END
+            """ % INSERT_NEW_TRIGRAMS,
+            """
+            CREATE TRIGGER game_search_delete
+            AFTER DELETE ON game BEGIN
+                DELETE FROM game_search WHERE rowid = old.id;
+                DELETE FROM game_trigram WHERE game_id = old.id;
+            END
+            """,
+            """
+            CREATE TRIGGER game_trigram_insert
+            AFTER INSERT ON game_trigram BEGIN
+                INSERT OR IGNORE INTO trigram_count (trigram, games)
+                VALUES (new.trigram, 0);
+                UPDATE trigram_count SET games = games + 1
+                WHERE trigram = new.trigram;
+            END
+            """,
+            """
+            CREATE TRIGGER game_trigram_delete
+            AFTER DELETE ON game_trigram BEGIN
+                UPDATE trigram_count SET games = games - 1
+                WHERE trigram = old.trigram;
+            END
+            """):
+        connection.execute(statement)
+
+
+def get_trigrams(text):
+    """
+    Returns the set of three letter sequences in text, lower cased and
+    padded so the first letters and the end of text have their own.
+
+    >>> sorted(get_trigrams("Nioh"))
+    ['  n', ' ni', 'ioh', 'nio', 'oh ']
+    """
+    text = '  %s ' % text.lower()
+    return set(text[i:i + 3] for i in xrange(len(text) - 2))
+
+
+def get_terms(text):
+    """
+    Returns the lower case words in text, which are safe to use in a full
+    text query.
+
+    >>> get_terms("Nioh: Complete-Edition")
+    ['nioh', 'complete', 'edition']
+    """
+    return [term.lower() for term in re.findall(r'[^\W_]+', text, re.UNICODE)]
+
+
+def match_games(connection, query, limit, candidates=MATCH_CANDIDATES):
+    """
+    Returns (id, name, category, avg_rating) rows for up to limit games
+    matching the full text query, highest rated first among the first
+    candidates matches.
+    """
+    return connection.execute(
+        """
+        SELECT game.id, game.name, game.category, game.avg_rating
+        FROM (SELECT rowid FROM game_search WHERE game_search MATCH ?
+              LIMIT ?) AS matches
+        JOIN game ON game.id = matches.rowid
+        ORDER BY game.avg_rating DESC
+        LIMIT ?
+        """, (query, max(limit, candidates), limit)).fetchall()
+
+
+def rank_by_name(rows, text):
+    """
+    Orders rows with an exact name match first, then names starting with
+    text, then the rest, keeping the rating order within each group.
+    """
+    text = text.strip().lower()
+
+    def name_rank(row):
+        name = row[1].lower()
+        if name == text:
+            return 0
+        if name.startswith(text):
+            return 1
+        return 2
+
+    return sorted(rows, key=name_rank)
+
+
+def get_rare_trigrams(connection, trigrams, postings=FUZZY_POSTINGS):
+    """
+    Returns the rarest of trigrams that any game has: from the rarest, as
+    many as have at most postings games between them, and at least one.
+    """
+    trigrams = list(trigrams)
+    counts = dict(connection.execute(
+        'SELECT trigram, games FROM trigram_count WHERE trigram IN (%s) '
+        'AND games > 0' % ', '.join('?' * len(trigrams)), trigrams).fetchall())
+    rare = []
+    total = 0
+    for trigram in sorted(counts, key=counts.get):
+        if rare and total + counts[trigram] > postings:
+            break
+        rare.append(trigram)
+        total += counts[trigram]
+    return rare
+
+
+def get_fuzzy_candidates(connection, terms, candidates=FUZZY_CANDIDATES,
+                         postings=FUZZY_POSTINGS):
+    """
+    Returns (id, name, category, avg_rating) rows of up to candidates games
+    sharing the most trigrams with terms, out of up to postings games with
+    the rarest of them. Names with a typo anywhere, even in the first
+    letters, are found whatever their rating, and common trigrams don't
+    make the search read most of the games.
+    """
+    trigrams = get_trigrams(' '.join(terms))
+    rare = get_rare_trigrams(connection, trigrams, postings)
+    if not rare:
+        return []
+    rows = connection.execute(
+        """
+        SELECT id, name, category, avg_rating FROM game
+        WHERE id IN (SELECT game_id FROM game_trigram WHERE trigram IN (%s)
+                     LIMIT ?)
+        """ % ', '.join('?' * len(rare)), rare + [postings]).fetchall()
+    rows.sort(key=lambda row: len(trigrams & get_trigrams(row[1])),
+              reverse=True)
+    return rows[:candidates]
+
+
+def search_games(connection, text, limit=10):
+    """
+    Returns a list of up to limit games matching text, and whether the
+    matches are fuzzy. Games whose names have words starting with every
+    word of text come first, then games whose category or description do.
+    If nothing matches, games with names similar to text are returned.
+
+    >>> search_games(connection, "nio")
+    ([{'id': 3, 'name': 'Nioh', 'category': 'RPG', 'avg_rating': 8.5}], False)
+    """
+    terms = get_terms(text)
+    if not terms:
+        return [], False
+
+    # Games named exactly text come first, even for very broad searches
+    rows = connection.execute(
+        'SELECT id, name, category, avg_rating FROM game WHERE name = ? '
+        'LIMIT ?', (text.strip(), limit)).fetchall()
+    found = set(row[0] for row in rows)
+    for row in rank_by_name(match_games(
+            connection, ' '.join('name:%s*' % term for term in terms), limit),
+            text):
+        if row[0] not in found and len(rows) < limit:
+            rows.append(row)
+
+    if len(rows) < limit:
+        found = set(row[0] for row in rows)
+        for row in match_games(connection,
+                               ' '.join('%s*' % term for term in terms),
+                               limit + len(rows)):
+            if row[0] not in found and len(rows) < limit:
+                rows.append(row)
+
+    fuzzy = False
+    if not rows:
+        fuzzy = True
+        candidates = get_fuzzy_candidates(connection, terms)
+        matcher = SequenceMatcher()
+        matcher.set_seq2(' '.join(terms))
+        scored = []
+        for row in candidates:
+            matcher.set_seq1(row[1].lower())
+            # The quick ratios are upper bounds of the real one
+            if (matcher.real_quick_ratio() >= FUZZY_CUTOFF and
+                    matcher.quick_ratio() >= FUZZY_CUTOFF):
+                score = matcher.ratio()
+                if score >= FUZZY_CUTOFF:
+                    scored.append((score, row))
+        scored.sort(key=lambda scored_row: scored_row[0], reverse=True)
+        rows = [row for score, row in scored[:limit]]
+
+    return [{'id': row[0], 'name': row[1], 'category': row[2],
+             'avg_rating': row[3]} for row in rows], fuzzy
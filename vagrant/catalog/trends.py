@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+#
+# Rating trends from the rating_event log. Events are rolled up, in order
+# of id, into per game hourly and daily buckets holding the number of
+# events, the sum and number of the ratings given, and the change in the
+# game's number of ratings. The id of the last event rolled up is kept in
+# rollup_progress, so each run only reads new events. (SQLite has one
+# writer at a time, so events are committed in order of id.) Raw events
+# older than EVENT_RETENTION_DAYS, and hourly buckets older than
+# HOURLY_RETENTION_DAYS, are deleted once rolled up; daily buckets are kept.
+#
+# gamerater rolls up new events in a background thread. To run the job by
+# hand (e.g. from cron when running worker processes), run:
+#
+# Usage: python trends.py [--database URL]
+#
+import argparse
+import threading
+import time
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, bindparam, select
+
+import migrations
+from database_setup import (RatingEvent, RatingRollup, RollupProgress,
+                            create_db_engine)
+
+# Events rolled up per transaction
+BATCH_SIZE = 10000
+
+# Days of raw events and of hourly buckets kept
+EVENT_RETENTION_DAYS = 30
+HOURLY_RETENTION_DAYS = 90
+
+# Seconds between runs of the job by the background refresher
+ROLLUP_INTERVAL = 60
+
+# Most game ids in one IN (...) query; SQLite allows 999 parameters
+CHUNK_SIZE = 500
+
+events = RatingEvent.__table__
+rollups = RatingRollup.__table__
+progress = RollupProgress.__table__
+
+PERIODS = ('hour', 'day')
+
+
+def get_bucket_start(created, period):
+    """
+    Returns the start of the hour or day created falls in.
+
+    >>> get_bucket_start(datetime(2017, 5, 1, 12, 30), 'day')
+    datetime.datetime(2017, 5, 1, 0, 0)
+    """
+    if period == 'hour':
+        return created.replace(minute=0, second=0, microsecond=0)
+    return created.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def sum_events(rows):
+    """
+    Returns a dict of each (game_id, period, start) bucket to its summed
+    [events, rating_sum, rating_count, count_change] for the event rows.
+    """
+    buckets = {}
+    for game_id, old_rating, new_rating, created in rows:
+        count_change = (new_rating is not None) - (old_rating is not None)
+        for period in PERIODS:
+            key = (game_id, period, get_bucket_start(created, period))
+            totals = buckets.setdefault(key, [0, 0, 0, 0])
+            totals[0] += 1
+            if new_rating is not None:
+                totals[1] += new_rating
+                totals[2] += 1
+            totals[3] += count_change
+    return buckets
+
+
+def write_buckets(connection, buckets):
+    """
+    Adds the summed events to their buckets, creating the buckets that
+    don't exist yet.
+    """
+    # Look up the games' buckets from the earliest one touched
+    game_ids = list(set(key[0] for key in buckets))
+    earliest = min(key[2] for key in buckets)
+    existing = set()
+    for start in xrange(0, len(game_ids), CHUNK_SIZE):
+        query = select([rollups.c.game_id, rollups.c.period,
+                        rollups.c.start]).where(and_(
+            rollups.c.game_id.in_(game_ids[start:start + CHUNK_SIZE]),
+            rollups.c.start >= earliest))
+        existing.update(tuple(row) for row in connection.execute(query))
+
+    inserts = []
+    updates = []
+    for (game_id, period, start), totals in buckets.items():
+        values = {'events': totals[0], 'rating_sum': totals[1],
+                  'rating_count': totals[2], 'count_change': totals[3]}
+        if (game_id, period, start) in existing:
+            values.update({'bucket_game_id': game_id,
+                           'bucket_period': period, 'bucket_start': start})
+            updates.append(values)
+        else:
+            values.update({'game_id': game_id, 'period': period,
+                           'start': start})
+            inserts.append(values)
+
+    if inserts:
+        connection.execute(rollups.insert(), inserts)
+    if updates:
+        connection.execute(
+            rollups.update().where(and_(
+                rollups.c.game_id == bindparam('bucket_game_id'),
+                rollups.c.period == bindparam('bucket_period'),
+                rollups.c.start == bindparam('bucket_start'))).values(
+                events=rollups.c.events + bindparam('events'),
+                rating_sum=rollups.c.rating_sum + bindparam('rating_sum'),
+                rating_count=rollups.c.rating_count +
+                bindparam('rating_count'),
+                count_change=rollups.c.count_change +
+                bindparam('count_change')),
+            updates)
+
+
+def roll_up(engine, batch_size=BATCH_SIZE):
+    """
+    Rolls up the events added since the last run into their buckets, a
+    batch per transaction, and returns the number of events rolled up.
+
+    >>> roll_up(engine)
+    412
+    """
+    total = 0
+    while True:
+        with engine.begin() as connection:
+            # Write first, so a concurrent run waits for this one instead
+            # of rolling up the same events
+            now = datetime.now()
+            if not connection.execute(progress.update().where(
+                    progress.c.id == 1).values(modified=now)).rowcount:
+                connection.execute(progress.insert(), {
+                    'id': 1, 'last_event_id': 0, 'modified': now})
+            last_event_id = connection.execute(
+                select([progress.c.last_event_id]).where(
+                    progress.c.id == 1)).scalar()
+
+            rows = connection.execute(
+                select([events.c.id, events.c.game_id, events.c.old_rating,
+                        events.c.new_rating, events.c.created]).where(
+                    events.c.id > last_event_id).order_by(
+                    events.c.id).limit(batch_size)).fetchall()
+            if not rows:
+                return total
+
+            write_buckets(connection, sum_events(row[1:] for row in rows))
+            connection.execute(progress.update().where(
+                progress.c.id == 1).values(last_event_id=rows[-1][0]))
+            total += len(rows)
+
+
+def compact(engine, event_days=EVENT_RETENTION_DAYS,
+            hourly_days=HOURLY_RETENTION_DAYS):
+    """
+    Deletes the rolled up events older than event_days and the hourly
+    buckets older than hourly_days, and returns the number of each deleted.
+    """
+    now = datetime.now()
+    with engine.begin() as connection:
+        last_event_id = connection.execute(
+            select([progress.c.last_event_id]).where(
+                progress.c.id == 1)).scalar() or 0
+        deleted_events = connection.execute(events.delete().where(and_(
+            events.c.id <= last_event_id,
+            events.c.created < now - timedelta(days=event_days)))).rowcount
+        deleted_buckets = connection.execute(rollups.delete().where(and_(
+            rollups.c.period == 'hour',
+            rollups.c.start < now - timedelta(days=hourly_days)))).rowcount
+    return deleted_events, deleted_buckets
+
+
+def start_refresher(engine, interval=ROLLUP_INTERVAL):
+    """
+    Rolls up new events and compacts old ones every interval seconds in a
+    daemon thread.
+    """
+    def run():
+        while True:
+            try:
+                roll_up(engine)
+                compact(engine)
+            except Exception as e:
+                print "Could not roll up the rating events: %s" % e
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Roll up the rating events into hourly and daily "
+                    "trends, and delete old events.")
+    parser.add_argument('--database', default='sqlite:///favoritegames.db',
+                        help="database url (default: %(default)s)")
+    args = parser.parse_args()
+
+    engine = create_db_engine(args.database)
+    migrations.upgrade(engine)
+    rolled_up = roll_up(engine)
+    deleted_events, deleted_buckets = compact(engine)
+    print "Rolled up %s events, and deleted %s old events and %s old " \
+          "hourly buckets." % (rolled_up, deleted_events, deleted_buckets)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,10 @@
+#!/usr/bin/env python
+#
+# WSGI entry point for serving gamerater with worker processes. Run from
+# the catalog folder:
+#
+#   gunicorn -c ../shared/gunicorn_config.py wsgi:application
+#
+from gamerater import create_app
+
+application = create_app()
@@ -1,32 +1,63 @@
 from flask import Flask, render_template, url_for, redirect, request, flash, jsonify
 app = Flask(__name__)
 
-from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 from database_setup import Base, Restaurant, MenuItem, User
 
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from shared.sqlite_profile import create_sqlite_engine
+from shared.sql_stats import SQLStats, debug_only
+from shared.oauth_client import ProviderClient, ProviderError
+from shared.oauth_config import (SecretsFile, ConfigError, make_google_flow,
+                                 validate_google_secrets,
+                                 validate_facebook_secrets)
+from shared.session_store import ServerSessionInterface, create_store
+from shared import prefork
+
 from flask import session as login_session
 import random, string
 
-from oauth2client.client import flow_from_clientsecrets
 from oauth2client.client import FlowExchangeError
 import httplib2
 import json
+import socket
 from flask import make_response
-import requests
 
-CLIENT_ID = json.loads(
-    open('client_secrets.json', 'r').read())['web']['client_id']
+# Keep login sessions on the server, with only their id in the cookie
+app.session_interface = ServerSessionInterface(create_store())
+
+# Client secrets, loaded once and reloaded when the files change. The
+# Google secrets are loaded now so a bad file stops the app from starting.
+google_secrets = SecretsFile('client_secrets.json', validate_google_secrets)
+facebook_secrets = SecretsFile('fb_client_secrets.json',
+                               validate_facebook_secrets)
+google_secrets.load()
+
 APPLICATION_NAME = "Restauranterator"
 
-# Create database
-engine = create_engine('sqlite:///restaurantmenuwithusers.db')
+# Pooled, timeout-bounded client for the Google and Facebook APIs
+provider_client = ProviderClient()
+
+# Create database, with the SQLITE_PROFILE connection settings. Connections
+# are pooled, so the PRAGMAs run and the statement cache fills once per
+# connection instead of once per request; pooled connections are handed
+# between threads, one at a time.
+engine = create_sqlite_engine('sqlite:///restaurantmenuwithusers.db',
+                              poolclass = QueuePool,
+                              connect_args = {'check_same_thread': False})
 Base.metadata.create_all(engine)
 
 # Create database connector
 DBSession = sessionmaker(bind = engine)
 session = DBSession()
 
+# Count and time the SQL statements of each route, see /debug/sql-stats
+# The /debug pages are only served in debug mode or with DEBUG_STATS=1.
+sql_stats = SQLStats(app, engine)
+app.config.setdefault('DEBUG_STATS', os.environ.get('DEBUG_STATS') == '1')
+
 # Common urls
 restaurant_url = '/restaurant/<int:restaurant_id>'
 menu_id_url = restaurant_url + '/menu/<int:menu_id>'
@@ -91,6 +122,8 @@ def login_or_create_user(login_session):
     if not user_id:
         user_id = create_user(login_session)
 
+    # Log in under a new session id
+    login_session.regenerate()
     login_session['user_id'] = user_id
 
     output = ''
@@ -116,19 +149,21 @@ def gconnect():
 
     try:
         # Upgrade the authorization code into a credentials object
-        oauth_flow = flow_from_clientsecrets('client_secrets.json', scope='')
-        oauth_flow.redirect_uri = 'postmessage'
-        credentials = oauth_flow.step2_exchange(code)
+        oauth_flow = make_google_flow(google_secrets.config)
+        credentials = oauth_flow.step2_exchange(
+            code, http=provider_client.http())
     except FlowExchangeError:
         return make_json_response(
             'Failed to upgrade the authorization code', 401)
+    except (httplib2.HttpLib2Error, socket.error):
+        return make_json_response('Could not reach Google.', 502)
 
     # Check that the access token is valid
     access_token = credentials.access_token
-    url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?access_token=%s' % (
-        access_token))
-    h = httplib2.Http()
-    result = json.loads(h.request(url, 'GET')[1])
+    try:
+        result = provider_client.google_tokeninfo(access_token)
+    except ProviderError:
+        return make_json_response('Could not reach Google.', 502)
 
     # If there was an error in the access token info, abort.
     if result.get('error') is not None:
@@ -141,7 +176,7 @@ def gconnect():
         return make_json_response(message, 401)
 
     # Verify that the access token is valid for this app
-    if result['issued_to'] != CLIENT_ID:
+    if result['issued_to'] != google_secrets.config['client_id']:
         message = "Token's client ID does not match app's."
         print message
         return make_json_response(message, 401)
@@ -157,10 +192,10 @@ def gconnect():
     login_session['gplus_id'] = gplus_id
 
     # Get user info
-    userinfo_url = "https://www.googleapis.com/oauth2/v1/userinfo"
-    params = {'access_token': credentials.access_token, 'alt' : 'json'}
-    answer = requests.get(userinfo_url, params=params)
-    data = json.loads(answer.text)
+    try:
+        data = provider_client.google_userinfo(credentials.access_token)
+    except ProviderError:
+        return make_json_response('Could not reach Google.', 502)
 
     login_session['username'] = data['name']
     login_session['picture'] = data['picture']
@@ -184,13 +219,12 @@ def gdisconnect():
         return make_json_response("Current user not connected.", 401)
 
     # Execute HTTP GET request to revoke current token.
-    access_token = credentials.access_token
-    url = ('https://accounts.google.com/o/oauth2/revoke?token=%s' % (
-        access_token))
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[0]
+    try:
+        revoked = provider_client.google_revoke(credentials.access_token)
+    except ProviderError:
+        revoked = False
 
-    if result['status'] == '200':
+    if revoked:
         return make_json_response('Successfully disconnected.', 200)
     else:
         # For whatever reason, the given token was invalid.
@@ -207,41 +241,26 @@ def fbconnect():
     # /oauth/access_token?grant_type=fb_exchange_token&client_id=
     # {app-id}&client_secret={app-secret}&fb_exchange_token=
     # {short-lived-token}
-    app_id = json.loads(
-        open('fb_client_secrets.json', 'r').read())['web']['app_id']
-    app_secret = json.loads(
-        open('fb_client_secrets.json', 'r').read())['web']['app_secret']
-    url = ('https://graph.facebook.com/oauth/access_token?grant_type=fb_exchange_token&client_id='
-           '%s&client_secret=%s&fb_exchange_token=%s' % (
-            app_id, app_secret, access_token))
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[1]
-
-    # Use token to user info from API
-    userinfo_url = "https://graph.facebook.com/v2.4/me"
-    # Strip expire tag from access token
-    token = result.split("&")[0]
-
-    url = 'https://graph.facebook.com/v2.4/me?%s&fields=name,id,email' % token
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[1]
-    #print "url sent for API access: %s" % url
-    #print "API JSON result: %s" % result
-    data = json.loads(result)
+    try:
+        secrets = facebook_secrets.config
+    except ConfigError as e:
+        print e
+        return make_json_response('Facebook login is not configured.', 500)
+
+    try:
+        token = provider_client.facebook_exchange_token(
+            secrets['app_id'], secrets['app_secret'], access_token)
+
+        # Get the user's info and picture at the same time
+        data, picture = provider_client.facebook_user(token)
+    except ProviderError:
+        return make_json_response('Could not reach Facebook.', 502)
+
     login_session['provider'] = 'facebook'
     login_session['username'] = data["name"]
     login_session['email'] = data["email"]
     login_session['facebook_id'] = data["id"]
-    login_session['provider'] = 'facebook'
-
-    # Get user picture
-    url = ('https://graph.facebook.com/v2.4/me/picture?%s&redirect=0'
-           '&height=100&width=100' % token)
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[1]
-    data = json.loads(result)
-
-    login_session['picture'] = data['data']['url']
+    login_session['picture'] = picture
 
     # See if user exists, and create the user if not.
     output = login_or_create_user(login_session)
@@ -252,9 +271,10 @@ def fbconnect():
 @app.route('/fbdisconnect/')
 def fbdisconnect():
     facebook_id = login_session['facebook_id']
-    url = 'https://graph.facebook.com/%s/permissions' % facebook_id
-    h = httplib2.Http()
-    result = h.request(url, 'DELETE')[1]
+    try:
+        provider_client.facebook_revoke(facebook_id)
+    except ProviderError:
+        pass
 
 @app.route('/disconnect/')
 def disconnect():
@@ -534,6 +554,33 @@ def menu_item_json(restaurant_id, menu_id):
     menu_item = get_menu_item_by_id(menu_id)
     return jsonify(MenuItems=[menu_item.serialize])
 
+@app.route('/debug/sql-stats')
+@debug_only
+def sql_stats_json():
+    return jsonify(sql_stats.stats)
+
+def dispose_connections():
+    """
+    Closes the database session and pooled connections, so a forked worker
+    process opens its own instead of sharing its parent's.
+    """
+    session.close()
+    engine.dispose()
+    app.session_interface.store.dispose()
+
+def create_app(config=None):
+    """
+    Returns the app set up for a prefork server: debug off, the secret key
+    from RESTAURANTS_SECRET_KEY, config applied on top of the defaults, and
+    every template compiled. Call once before the workers are forked.
+    """
+    app.debug = False
+    app.secret_key = prefork.get_secret_key('RESTAURANTS_SECRET_KEY')
+    if config:
+        app.config.update(config)
+    prefork.preload_templates(app)
+    prefork.register_after_fork(dispose_connections)
+    return app
 
 
 if __name__ == '__main__':
@@ -0,0 +1,10 @@
+#!/usr/bin/env python
+#
+# WSGI entry point for serving the restaurant menus with worker processes.
+# Run from the restaurant_menus folder:
+#
+#   gunicorn -c ../shared/gunicorn_config.py -b 0.0.0.0:5000 wsgi:application
+#
+from final_project import create_app
+
+application = create_app()
@@ -0,0 +1,2 @@
+# Code shared by the Flask apps in catalog and restaurant_menus. The apps
+# add the vagrant folder to sys.path to import it.
@@ -0,0 +1,38 @@
+#
+# gunicorn settings for the Flask apps. Run from an app's folder, e.g.
+#
+#   gunicorn -c ../shared/gunicorn_config.py wsgi:application
+#
+# The app is loaded once before forking. Two worker processes are started
+# per core, plus one (WEB_CONCURRENCY to change it), and each is replaced
+# after a few thousand requests. Send the master SIGHUP to reload this
+# config and replace the workers gracefully, letting each finish its
+# requests. The new workers are forked from the app the master already
+# loaded, so deploying new code needs a full restart of the master (or
+# SIGUSR2 to start a new master, then SIGTERM to the old one).
+#
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY',
+                             multiprocessing.cpu_count() * 2 + 1))
+
+# Import the app and set it up in the master, so the workers share it
+preload_app = True
+
+# Seconds a worker may spend on a request, and to finish its requests
+# when told to stop
+timeout = 30
+graceful_timeout = 30
+
+# Replace workers now and then to bound their memory, spread out so they
+# don't all restart at once
+max_requests = 5000
+max_requests_jitter = 500
+
+
+def post_fork(server, worker):
+    # Each worker opens its own database connections
+    from shared import prefork
+    prefork.run_after_fork()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+#
+# Client for the Google and Facebook APIs used to log users in. One client
+# is shared by all of an app's requests, so its connections to each
+# provider are pooled and kept alive between logins. Every call has a
+# connect and read timeout, so a slow provider fails the login quickly
+# instead of holding the worker. Lookups that don't depend on each other
+# run at the same time.
+#
+import json
+import threading
+import time
+import urllib
+import urlparse
+
+from collections import OrderedDict
+
+import httplib2
+import requests
+from requests.adapters import HTTPAdapter
+
+# Seconds to wait for a provider to accept a connection, and then between
+# bytes of its response
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 5
+
+# Connections kept alive to each provider host
+POOL_SIZE = 10
+
+# Seconds a validated Google token's info is reused, and most tokens kept
+TOKENINFO_MAX_AGE = 60
+TOKENINFO_MAX_SIZE = 1000
+
+GOOGLE_API_URL = 'https://www.googleapis.com'
+GOOGLE_ACCOUNTS_URL = 'https://accounts.google.com'
+FACEBOOK_GRAPH_URL = 'https://graph.facebook.com'
+
+
+class ProviderError(Exception):
+    """A provider couldn't be reached, or sent a response we can't use."""
+
+
+def call_concurrently(*calls):
+    """
+    Calls each of the given functions in its own thread and returns their
+    results in order. If any call raises an exception, the first one is
+    raised once every call has finished.
+
+    >>> call_concurrently(lambda: 1, lambda: 2)
+    [1, 2]
+    """
+    results = [None] * len(calls)
+    errors = [None] * len(calls)
+
+    def run(index, call):
+        try:
+            results[index] = call()
+        except Exception as e:
+            errors[index] = e
+
+    threads = [threading.Thread(target=run, args=(index, call))
+               for index, call in enumerate(calls)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for error in errors:
+        if error is not None:
+            raise error
+    return results
+
+
+class ProviderClient(object):
+    """
+    Pooled, timeout-bounded client for the OAuth providers. The base urls
+    can be changed to point the client at a stub server.
+
+    >>> client = ProviderClient()
+    >>> client.google_tokeninfo(access_token)
+    {'user_id': '1234', 'issued_to': '...apps.googleusercontent.com', ...}
+    """
+
+    def __init__(self, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+                 pool_size=POOL_SIZE, tokeninfo_max_age=TOKENINFO_MAX_AGE,
+                 google_api_url=GOOGLE_API_URL,
+                 google_accounts_url=GOOGLE_ACCOUNTS_URL,
+                 facebook_graph_url=FACEBOOK_GRAPH_URL):
+        self.timeout = timeout
+        self.tokeninfo_max_age = tokeninfo_max_age
+        self.google_api_url = google_api_url
+        self.google_accounts_url = google_accounts_url
+        self.facebook_graph_url = facebook_graph_url
+
+        # requests sessions pool connections per host and are safe to
+        # share between threads for simple GETs
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self._tokeninfo = OrderedDict()
+        self._lock = threading.Lock()
+
+        # httplib2.Http objects keep their connections alive but aren't
+        # safe to share between threads, so each thread gets its own
+        self._local = threading.local()
+
+    def http(self):
+        """
+        Returns the calling thread's httplib2.Http, with the client's read
+        timeout, for oauth2client calls such as step2_exchange. It is made
+        on the thread's first call and reused after, so its connections to
+        the provider are kept alive between logins.
+        """
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = self._local.http = httplib2.Http(timeout=self.timeout[1])
+        return http
+
+    def request(self, method, url, params=None):
+        """
+        Sends a request to a provider and returns the response, raising
+        ProviderError if it can't be reached in time.
+        """
+        try:
+            return self.session.request(method, url, params=params,
+                                        timeout=self.timeout)
+        except requests.RequestException as e:
+            # Name only the host, since the url may hold an access token
+            raise ProviderError("Could not reach %s: %s" % (
+                urlparse.urlparse(url).netloc, type(e).__name__))
+
+    def get_json(self, url, params=None):
+        """Returns the decoded JSON of a GET of url."""
+        response = self.request('GET', url, params)
+        try:
+            return response.json()
+        except ValueError:
+            raise ProviderError("%s did not return JSON (status %s)" % (
+                urlparse.urlparse(url).netloc, response.status_code))
+
+    def google_tokeninfo(self, access_token):
+        """
+        Returns Google's info for the access token. Info for valid tokens
+        is reused for up to tokeninfo_max_age seconds (or until the token
+        expires, if that is sooner).
+        """
+        now = time.time()
+        with self._lock:
+            cached = self._tokeninfo.get(access_token)
+            if cached is not None and cached[0] > now:
+                return cached[1]
+
+        result = self.get_json(self.google_api_url + '/oauth2/v1/tokeninfo',
+                               {'access_token': access_token})
+        if result.get('error') is None:
+            max_age = self.tokeninfo_max_age
+            if result.get('expires_in') is not None:
+                max_age = min(max_age, int(result['expires_in']))
+            with self._lock:
+                self._tokeninfo.pop(access_token, None)
+                self._tokeninfo[access_token] = (now + max_age, result)
+                while len(self._tokeninfo) > TOKENINFO_MAX_SIZE:
+                    self._tokeninfo.popitem(last=False)
+        return result
+
+    def google_userinfo(self, access_token):
+        """Returns the Google user's name, picture and email."""
+        return self.get_json(self.google_api_url + '/oauth2/v1/userinfo',
+                             {'access_token': access_token, 'alt': 'json'})
+
+    def google_revoke(self, access_token):
+        """Revokes the access token, and returns True if it worked."""
+        with self._lock:
+            self._tokeninfo.pop(access_token, None)
+        response = self.request('GET',
+                                self.google_accounts_url + '/o/oauth2/revoke',
+                                {'token': access_token})
+        return response.status_code == 200
+
+    def facebook_exchange_token(self, app_id, app_secret, access_token):
+        """
+        Exchanges a short lived Facebook token for a long lived one, and
+        returns it as an access_token=... query string.
+        """
+        response = self.request(
+            'GET', self.facebook_graph_url + '/oauth/access_token', {
+                'grant_type': 'fb_exchange_token', 'client_id': app_id,
+                'client_secret': app_secret,
+                'fb_exchange_token': access_token})
+        try:
+            return urllib.urlencode({
+                'access_token': json.loads(response.text)['access_token']})
+        except (KeyError, TypeError, ValueError):
+            # Older API versions answer access_token=...&expires=...
+            if not response.text.startswith('access_token='):
+                raise ProviderError("Facebook did not return a token.")
+            return response.text.split('&')[0]
+
+    def facebook_user(self, token):
+        """
+        Returns the Facebook user's profile (name, id and email) and
+        picture url for the token, looked up at the same time.
+        """
+        profile, picture = call_concurrently(
+            lambda: self.get_json(
+                '%s/v2.4/me?%s&fields=name,id,email' % (
+                    self.facebook_graph_url, token)),
+            lambda: self.get_json(
+                '%s/v2.4/me/picture?%s&redirect=0&height=100&width=100' % (
+                    self.facebook_graph_url, token)))
+        try:
+            return profile, picture['data']['url']
+        except (KeyError, TypeError):
+            raise ProviderError("Facebook did not return a picture.")
+
+    def facebook_revoke(self, facebook_id):
+        """Removes the app's permissions for the Facebook user."""
+        self.request('DELETE', '%s/%s/permissions' % (
+            self.facebook_graph_url, facebook_id))
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+#
+# The Google and Facebook client secrets, parsed and validated once and
+# kept in memory. The files' modified times are checked at most every few
+# seconds, and a changed file is reloaded and swapped in whole, so logins
+# don't read or parse the files.
+#
+import json
+import os
+import threading
+import time
+
+from oauth2client.client import OAuth2WebServerFlow
+
+# Most seconds between checks of a secrets file's modified time
+CHECK_INTERVAL = 5
+
+
+class ConfigError(Exception):
+    """A secrets file is missing or doesn't hold the expected keys."""
+
+
+def get_keys(data, section, required, optional=()):
+    """
+    Returns a dict of the required and optional keys in data[section],
+    raising ConfigError if a required key is missing.
+
+    >>> get_keys({'web': {'app_id': '1', 'app_secret': 's'}}, 'web',
+    ...          ('app_id', 'app_secret'))
+    {'app_id': '1', 'app_secret': 's'}
+    """
+    try:
+        values = data[section]
+    except (KeyError, TypeError):
+        raise ConfigError("Missing the %r section" % section)
+    missing = [key for key in required if not values.get(key)]
+    if missing:
+        raise ConfigError("Missing %s in the %r section" % (
+            ', '.join(missing), section))
+    keys = tuple(required) + tuple(optional)
+    return dict((key, values[key]) for key in keys if key in values)
+
+
+def validate_google_secrets(data):
+    """Returns the web client settings from a Google client_secrets.json."""
+    return get_keys(data, 'web',
+                    ('client_id', 'client_secret', 'auth_uri', 'token_uri'),
+                    ('revoke_uri',))
+
+
+def validate_facebook_secrets(data):
+    """Returns the app id and secret from a fb_client_secrets.json."""
+    return get_keys(data, 'web', ('app_id', 'app_secret'))
+
+
+class SecretsFile(object):
+    """
+    A JSON secrets file, loaded the first time its config is read and
+    reloaded when its modified time changes. validate is called with the
+    parsed JSON and returns the config, or raises ConfigError. If a changed
+    file can't be loaded (e.g. it is half written), the last good config is
+    kept and the file is tried again at the next check.
+
+    >>> google_secrets = SecretsFile('client_secrets.json',
+    ...                              validate_google_secrets)
+    >>> google_secrets.config['client_id']
+    '1234.apps.googleusercontent.com'
+    """
+
+    def __init__(self, path, validate, check_interval=CHECK_INTERVAL):
+        self.path = path
+        self.validate = validate
+        self.check_interval = check_interval
+        self._config = None
+        self._mtime = None
+        self._checked = 0
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Loads the file if it is new or has changed since it was loaded."""
+        with self._lock:
+            self._checked = time.time()
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except OSError as e:
+                if self._config is None:
+                    raise ConfigError("Could not read %s: %s" % (
+                        self.path, e.strerror))
+                return
+            if mtime == self._mtime:
+                return
+
+            try:
+                with open(self.path, 'r') as secrets_file:
+                    config = self.validate(json.load(secrets_file))
+            except (IOError, ValueError, ConfigError) as e:
+                if self._config is None:
+                    raise ConfigError("Could not load %s: %s" % (
+                        self.path, e))
+                print "Keeping the last good %s: %s" % (self.path, e)
+                return
+
+            # Swap in the new config whole
+            self._config = config
+            self._mtime = mtime
+
+    @property
+    def config(self):
+        """Returns the current config, loading the file if it is due."""
+        if (self._config is None or
+                time.time() - self._checked > self.check_interval):
+            self.load()
+        return self._config
+
+
+def make_google_flow(config, redirect_uri='postmessage'):
+    """
+    Returns an oauth2client flow for exchanging a Google authorization code,
+    built from a validated client_secrets.json config instead of the file.
+    """
+    optional = {}
+    if 'revoke_uri' in config:
+        optional['revoke_uri'] = config['revoke_uri']
+    return OAuth2WebServerFlow(client_id=config['client_id'],
+                               client_secret=config['client_secret'],
+                               scope='',
+                               redirect_uri=redirect_uri,
+                               auth_uri=config['auth_uri'],
+                               token_uri=config['token_uri'],
+                               **optional)
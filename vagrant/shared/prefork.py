@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+#
+# Helpers for serving the Flask apps from a prefork server such as gunicorn
+# (see gunicorn_config.py). The app is imported and set up once in the
+# master process and then forked into the workers, so every worker starts
+# with the config loaded and the templates compiled. Functions registered
+# with register_after_fork run in each new worker, to drop the database
+# connections it inherited so it opens its own.
+#
+import os
+
+_after_fork = []
+
+
+def register_after_fork(function):
+    """Calls function with no arguments in each newly forked worker."""
+    if function not in _after_fork:
+        _after_fork.append(function)
+
+
+def run_after_fork():
+    """Runs the registered functions. Called by the server's post_fork."""
+    for function in _after_fork:
+        function()
+
+
+def preload_templates(app):
+    """
+    Compiles every template of app into its Jinja cache, and returns the
+    number compiled.
+    """
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+
+def get_secret_key(name):
+    """
+    Returns the secret key in the environment variable name. Without one a
+    random key is made; set before forking, it is shared by the workers but
+    changes when the server restarts.
+    """
+    secret_key = os.environ.get(name)
+    if not secret_key:
+        print "%s isn't set, so a random secret key is used." % name
+        secret_key = os.urandom(24)
+    return secret_key
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+#
+# Server-side sessions for the Flask apps. The session cookie holds only a
+# random session id and a version number; the session data (credentials,
+# tokens, user names, ...) is pickled into an SQLite table or Redis, with an
+# in-process LRU cache of recently used sessions in front.
+#
+# The store is picked with the SESSION_STORE_URL environment variable,
+# e.g. sqlite:///sessions.db (the default) or redis://localhost:6379/0.
+#
+# Sessions expire after the app's PERMANENT_SESSION_LIFETIME without use.
+# Expired sessions are deleted from SQLite in bulk every few minutes; Redis
+# expires them itself.
+#
+import binascii
+import cPickle as pickle
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+from flask.sessions import SessionInterface, SessionMixin
+from sqlalchemy.pool import QueuePool
+from werkzeug.datastructures import CallbackDict
+
+from shared.sqlite_profile import create_sqlite_engine
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+DEFAULT_STORE_URL = 'sqlite:///sessions.db'
+
+# Sessions kept in each process's front cache
+CACHE_SIZE = 1000
+
+# Seconds between bulk deletes of expired sessions
+PURGE_INTERVAL = 300
+
+# An unchanged session's expiry is pushed back when it has been used after
+# this share of its lifetime, instead of on every request
+REFRESH_SHARE = 0.1
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    """
+    Session data with the id and version it was stored under. Any change
+    marks it modified, so it is saved at the end of the request.
+    """
+
+    def __init__(self, data=None, session_id=None, version=0, expires=None):
+        def on_update(session):
+            session.modified = True
+        CallbackDict.__init__(self, data, on_update)
+        self.session_id = session_id
+        self.version = version
+        self.expires = expires
+        self.modified = False
+        self.regenerated = False
+
+    def regenerate(self):
+        """
+        Saves the session under a new id at the end of the request, and
+        deletes it under the old one. Call it when the user logs in, so an
+        id planted in the user's cookie before then is of no use.
+        """
+        self.regenerated = True
+        self.modified = True
+
+
+class SQLiteSessionStore(object):
+    """Stores pickled sessions in an SQLite table, indexed by expiry."""
+
+    def __init__(self, url):
+        self.engine = create_sqlite_engine(
+            url, connect_args={'check_same_thread': False},
+            poolclass=QueuePool)
+        with self.engine.begin() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS session_store ('
+                'id TEXT PRIMARY KEY, version INTEGER NOT NULL, '
+                'data BLOB NOT NULL, expires REAL NOT NULL)')
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS ix_session_store_expires '
+                'ON session_store (expires)')
+
+    def get(self, session_id):
+        """Returns the (version, data, expires) of a live session, or None."""
+        row = self.engine.execute(
+            'SELECT version, data, expires FROM session_store '
+            'WHERE id = ? AND expires > ?',
+            (session_id, time.time())).first()
+        if row is None:
+            return None
+        return row[0], str(row[1]), row[2]
+
+    def set(self, session_id, version, data, expires):
+        self.engine.execute(
+            'INSERT OR REPLACE INTO session_store (id, version, data, '
+            'expires) VALUES (?, ?, ?, ?)',
+            (session_id, version, buffer(data), expires))
+
+    def delete(self, session_id):
+        self.engine.execute('DELETE FROM session_store WHERE id = ?',
+                            (session_id,))
+
+    def delete_expired(self):
+        """Deletes every expired session in one statement."""
+        return self.engine.execute(
+            'DELETE FROM session_store WHERE expires <= ?',
+            (time.time(),)).rowcount
+
+    def dispose(self):
+        """Closes the pooled connections, e.g. after forking."""
+        self.engine.dispose()
+
+
+class RedisSessionStore(object):
+    """Stores pickled sessions in Redis, which expires them itself."""
+
+    prefix = 'session:'
+
+    def __init__(self, url):
+        if redis is None:
+            raise RuntimeError("The redis package is needed for %s" % url)
+        self.redis = redis.StrictRedis.from_url(url)
+
+    def get(self, session_id):
+        values = self.redis.hmget(self.prefix + session_id,
+                                  'version', 'data', 'expires')
+        if values[0] is None:
+            return None
+        return int(values[0]), values[1], float(values[2])
+
+    def set(self, session_id, version, data, expires):
+        key = self.prefix + session_id
+        pipeline = self.redis.pipeline()
+        pipeline.hmset(key, {'version': version, 'data': data,
+                             'expires': expires})
+        pipeline.expireat(key, int(expires) + 1)
+        pipeline.execute()
+
+    def delete(self, session_id):
+        self.redis.delete(self.prefix + session_id)
+
+    def delete_expired(self):
+        return 0
+
+    def dispose(self):
+        self.redis.connection_pool.disconnect()
+
+
+def create_store(url=None):
+    """
+    Returns the session store for url, or for the SESSION_STORE_URL
+    environment variable.
+    """
+    url = url or os.environ.get('SESSION_STORE_URL', DEFAULT_STORE_URL)
+    if url.startswith('redis://'):
+        return RedisSessionStore(url)
+    if url.startswith('sqlite://'):
+        return SQLiteSessionStore(url)
+    raise ValueError("Unknown session store %s" % url)
+
+
+class ServerSessionInterface(SessionInterface):
+    """
+    Flask session interface keeping the session data in store. The cookie
+    holds "<session id>.<version>"; the version goes up on every save, so a
+    cached session is only used if it is the version the client last saw,
+    even when another worker process saved a newer one.
+
+    >>> app.session_interface = ServerSessionInterface(create_store())
+    """
+
+    def __init__(self, store, cache_size=CACHE_SIZE):
+        self.store = store
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._purged = time.time()
+
+    def _cache_get(self, session_id, version):
+        with self._lock:
+            cached = self._cache.pop(session_id, None)
+            if cached is None:
+                return None
+            self._cache[session_id] = cached
+        if cached[0] != version or cached[2] <= time.time():
+            return None
+        return cached
+
+    def _cache_set(self, session_id, version, data, expires):
+        with self._lock:
+            self._cache.pop(session_id, None)
+            self._cache[session_id] = (version, data, expires)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _cache_delete(self, session_id):
+        with self._lock:
+            self._cache.pop(session_id, None)
+
+    def open_session(self, app, request):
+        cookie = request.cookies.get(app.session_cookie_name)
+        if cookie and '.' in cookie:
+            session_id, version = cookie.rsplit('.', 1)
+            try:
+                version = int(version)
+            except ValueError:
+                return ServerSession()
+
+            stored = self._cache_get(session_id, version)
+            if stored is None:
+                stored = self.store.get(session_id)
+                if stored is not None:
+                    self._cache_set(session_id, *stored)
+            if stored is not None:
+                version, data, expires = stored
+                return ServerSession(pickle.loads(data), session_id, version,
+                                     expires)
+        return ServerSession()
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        now = time.time()
+        self.purge_expired(now)
+
+        if not session:
+            # Forget emptied sessions, and don't store new empty ones
+            if session.session_id is not None:
+                self.store.delete(session.session_id)
+                self._cache_delete(session.session_id)
+                response.delete_cookie(app.session_cookie_name,
+                                       domain=domain, path=path)
+            return
+
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        expires = now + lifetime
+        if not session.modified and session.session_id is not None and (
+                session.expires is None or
+                session.expires - now > lifetime * (1 - REFRESH_SHARE)):
+            # Unchanged and recently refreshed
+            return
+
+        if session.regenerated and session.session_id is not None:
+            self.store.delete(session.session_id)
+            self._cache_delete(session.session_id)
+            session.session_id = None
+        if session.session_id is None:
+            session.session_id = binascii.hexlify(os.urandom(20))
+        session.version += 1
+        data = pickle.dumps(dict(session), pickle.HIGHEST_PROTOCOL)
+        self.store.set(session.session_id, session.version, data, expires)
+        self._cache_set(session.session_id, session.version, data, expires)
+
+        response.set_cookie(
+            app.session_cookie_name,
+            '%s.%s' % (session.session_id, session.version),
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain, path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app))
+
+    def purge_expired(self, now):
+        """Deletes expired sessions if it's been PURGE_INTERVAL seconds."""
+        if now - self._purged < PURGE_INTERVAL:
+            return
+        self._purged = now
+        self.store.delete_expired()
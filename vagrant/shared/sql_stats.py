@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+#
+# Per-route SQL statistics for the Flask apps. Statements run while a
+# sampled request is being handled are counted and timed against the
+# request's endpoint. Statements of the same shape run many times in one
+# request (e.g. one query per row of an earlier query) are reported as N+1
+# suspects.
+#
+# The share of requests sampled is set with the SQL_STATS_SAMPLE_RATE
+# environment variable, from 0 (off) to 1 (every request, the default).
+# Requests that aren't sampled only pay for one random number.
+#
+# The statistics pages are only served in debug mode, or when the app's
+# DEBUG_STATS config is set (e.g. from the DEBUG_STATS=1 environment
+# variable); otherwise they are not found.
+#
+import os
+import random
+import re
+import threading
+import time
+
+from functools import wraps
+
+from flask import abort, current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Times one statement shape must run in a request to be an N+1 suspect
+REPEAT_THRESHOLD = 5
+
+# Most N+1 suspects kept per endpoint
+MAX_SUSPECTS = 20
+
+
+def get_shape(statement):
+    """
+    Returns statement with its whitespace collapsed and its lists of bound
+    parameters shortened, so statements that differ only in their
+    parameters have the same shape.
+
+    >>> get_shape('SELECT * FROM game\\nWHERE id IN (?, ?, ?)')
+    'SELECT * FROM game WHERE id IN (?, ...)'
+    """
+    statement = re.sub(r'\s+', ' ', statement).strip()
+    return re.sub(r'\?(\s*,\s*\?)+', '?, ...', statement)
+
+
+class SQLStats(object):
+    """
+    Collects SQL statistics per endpoint for a Flask app, from the given
+    engine or, by default, every engine.
+
+    >>> sql_stats = SQLStats(app)
+    >>> sql_stats.stats
+    {'sample_rate': 1.0, 'endpoints': {'game_info': {'requests': 12, ...}}}
+    """
+
+    def __init__(self, app, engine=Engine, sample_rate=None,
+                 repeat_threshold=REPEAT_THRESHOLD):
+        if sample_rate is None:
+            sample_rate = float(os.environ.get('SQL_STATS_SAMPLE_RATE', 1))
+        self.sample_rate = sample_rate
+        self.repeat_threshold = repeat_threshold
+        self._endpoints = {}
+        self._lock = threading.Lock()
+        # Name of the request's statistics in flask.g, unique to this
+        # instance since every instance listens to every engine by default
+        self._key = 'sql_stats_%s' % id(self)
+
+        if sample_rate > 0:
+            app.before_request(self.start_request)
+            app.teardown_request(self.end_request)
+            self.listen(engine)
+
+    def listen(self, engine):
+        """Also collects the statements run on engine."""
+        if self.sample_rate > 0:
+            event.listen(engine, 'before_cursor_execute',
+                         self.before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute',
+                         self.after_cursor_execute)
+
+    def start_request(self):
+        """Decides whether to sample the request."""
+        if random.random() < self.sample_rate:
+            setattr(g, self._key, {'queries': 0, 'seconds': 0.0,
+                                   'shapes': {}})
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany):
+        if has_request_context() and self._key in g:
+            conn.info.setdefault(self._key, []).append(time.time())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters,
+                             context, executemany):
+        if not (has_request_context() and self._key in g):
+            return
+        starts = conn.info.get(self._key)
+        if not starts:
+            return
+        seconds = time.time() - starts.pop()
+        request_stats = getattr(g, self._key)
+        request_stats['queries'] += 1
+        request_stats['seconds'] += seconds
+        shapes = request_stats['shapes']
+        shapes[statement] = shapes.get(statement, 0) + 1
+
+    def end_request(self, exception=None):
+        """Adds the sampled request's statistics to its endpoint's."""
+        request_stats = g.pop(self._key, None)
+        if request_stats is None:
+            return
+
+        # Count repeats by shape, which also joins statements differing
+        # only in the length of an IN (...) list
+        repeats = {}
+        for statement, count in request_stats['shapes'].items():
+            shape = get_shape(statement)
+            repeats[shape] = repeats.get(shape, 0) + count
+
+        with self._lock:
+            endpoint = self._endpoints.setdefault(
+                request.endpoint or request.path, {
+                    'requests': 0, 'queries': 0, 'max_queries': 0,
+                    'sql_seconds': 0.0, 'max_sql_seconds': 0.0,
+                    'suspects': {}})
+            endpoint['requests'] += 1
+            endpoint['queries'] += request_stats['queries']
+            endpoint['max_queries'] = max(endpoint['max_queries'],
+                                          request_stats['queries'])
+            endpoint['sql_seconds'] += request_stats['seconds']
+            endpoint['max_sql_seconds'] = max(endpoint['max_sql_seconds'],
+                                              request_stats['seconds'])
+            suspects = endpoint['suspects']
+            for shape, count in repeats.items():
+                if count < self.repeat_threshold:
+                    continue
+                if shape in suspects:
+                    suspect = suspects[shape]
+                elif len(suspects) < MAX_SUSPECTS:
+                    suspect = suspects[shape] = {'requests': 0,
+                                                 'max_repeats': 0}
+                else:
+                    continue
+                suspect['requests'] += 1
+                suspect['max_repeats'] = max(suspect['max_repeats'], count)
+
+    def reset(self):
+        """Forgets the statistics collected so far."""
+        with self._lock:
+            self._endpoints = {}
+
+    @property
+    def stats(self):
+        """Returns the statistics per endpoint in serializable format."""
+        with self._lock:
+            stats = {}
+            for name, endpoint in self._endpoints.items():
+                requests = endpoint['requests']
+                stats[name] = {
+                    'requests': requests,
+                    'queries': endpoint['queries'],
+                    'mean_queries': round(
+                        float(endpoint['queries']) / requests, 2),
+                    'max_queries': endpoint['max_queries'],
+                    'sql_ms': round(endpoint['sql_seconds'] * 1000, 2),
+                    'mean_sql_ms': round(
+                        endpoint['sql_seconds'] * 1000 / requests, 3),
+                    'max_sql_ms': round(
+                        endpoint['max_sql_seconds'] * 1000, 3),
+                    'n_plus_one_suspects': [
+                        dict(suspect, statement=shape)
+                        for shape, suspect in sorted(
+                            endpoint['suspects'].items(),
+                            key=lambda item: -item[1]['requests'])]
+                }
+            return {'sample_rate': self.sample_rate, 'endpoints': stats}
+
+
+def debug_only(view):
+    """
+    Makes view answer 404 unless the app is in debug mode or its
+    DEBUG_STATS config is set.
+
+    >>> @app.route('/debug/sql-stats')
+    ... @debug_only
+    ... def sql_stats_json():
+    """
+    @wraps(view)
+    def debug_view(*args, **kwargs):
+        if not (current_app.debug or current_app.config.get('DEBUG_STATS')):
+            abort(404)
+        return view(*args, **kwargs)
+    return debug_view
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+#
+# Measures mixed read/write throughput of a scratch SQLite database under
+# each connection profile in sqlite_profile.py. Reader threads look up rows
+# by id and sum small ranges, like the apps' pages do, while writer threads
+# update rows and commit one at a time, like ratings being saved.
+#
+# Usage: python sqlite_benchmark.py [--seconds 5] [--readers 4] [--writers 2]
+#                                   [--profiles stock wal durable]
+#
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+from sqlalchemy.pool import QueuePool
+
+import sqlite_profile
+
+ROWS = 10000
+
+
+def create_database(engine, rows=ROWS):
+    """Creates and fills the benchmark's item table."""
+    with engine.begin() as connection:
+        connection.execute(
+            'CREATE TABLE item (id INTEGER PRIMARY KEY, value INTEGER, '
+            'modified REAL)')
+        connection.execute(
+            'INSERT INTO item (id, value, modified) VALUES (?, ?, ?)',
+            [(row_id, 0, time.time()) for row_id in range(1, rows + 1)])
+
+
+def read(engine, rows=ROWS):
+    """Reads one row by id and the sum of a range of rows."""
+    row_id = random.randint(1, rows - 100)
+    with engine.connect() as connection:
+        connection.execute('SELECT value FROM item WHERE id = ?',
+                           (row_id,)).fetchall()
+        connection.execute(
+            'SELECT sum(value) FROM item WHERE id BETWEEN ? AND ?',
+            (row_id, row_id + 100)).fetchall()
+
+
+def write(engine, rows=ROWS):
+    """Updates one row in its own transaction."""
+    with engine.begin() as connection:
+        connection.execute(
+            'UPDATE item SET value = value + 1, modified = ? WHERE id = ?',
+            (time.time(), random.randint(1, rows)))
+
+
+def run_profile(profile_name, seconds, readers, writers):
+    """
+    Returns the number of reads and writes per second, and the number of
+    writes that failed because the database was locked, for a profile.
+    """
+    directory = tempfile.mkdtemp()
+    engine = sqlite_profile.create_sqlite_engine(
+        'sqlite:///' + os.path.join(directory, 'benchmark.db'),
+        profile_name,
+        connect_args={'check_same_thread': False},
+        poolclass=QueuePool, pool_size=readers + writers)
+    try:
+        create_database(engine)
+        counts = {'read': 0, 'write': 0, 'locked': 0}
+        lock = threading.Lock()
+        stop = time.time() + seconds
+
+        def worker(operation, name):
+            done = 0
+            locked = 0
+            while time.time() < stop:
+                try:
+                    operation(engine)
+                    done += 1
+                except Exception as e:
+                    if 'locked' not in str(e):
+                        raise
+                    locked += 1
+            with lock:
+                counts[name] += done
+                counts['locked'] += locked
+
+        threads = ([threading.Thread(target=worker, args=(read, 'read'))
+                    for i in range(readers)] +
+                   [threading.Thread(target=worker, args=(write, 'write'))
+                    for i in range(writers)])
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return (counts['read'] / float(seconds),
+                counts['write'] / float(seconds), counts['locked'])
+    finally:
+        engine.dispose()
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare SQLite throughput under each connection profile.")
+    parser.add_argument('--seconds', type=float, default=5,
+                        help="seconds to run each profile (default: 5)")
+    parser.add_argument('--readers', type=int, default=4,
+                        help="reader threads (default: 4)")
+    parser.add_argument('--writers', type=int, default=2,
+                        help="writer threads (default: 2)")
+    parser.add_argument('--profiles', nargs='+',
+                        default=['stock', 'wal', 'durable'],
+                        choices=sorted(sqlite_profile.PROFILES),
+                        help="profiles to run (default: all)")
+    args = parser.parse_args()
+
+    print "%-8s %12s %12s %8s" % ('profile', 'reads/s', 'writes/s', 'locked')
+    for profile_name in args.profiles:
+        reads, writes, locked = run_profile(profile_name, args.seconds,
+                                            args.readers, args.writers)
+        print "%-8s %12.0f %12.0f %8d" % (profile_name, reads, writes, locked)
+
+
+if __name__ == '__main__':
+    main()
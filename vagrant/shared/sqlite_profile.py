@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+#
+# Connection settings for SQLite engines. A profile is a dict of PRAGMAs run
+# on every new connection, plus the sqlite3 module's statement cache size
+# and busy timeout.
+#
+# The profile is picked with the SQLITE_PROFILE environment variable:
+#
+#   wal      (default) write-ahead log, so readers don't block on writers,
+#            and a sync at checkpoints instead of on every commit
+#   durable  write-ahead log, with a sync on every commit
+#   stock    SQLite's own defaults, for comparison
+#
+import os
+
+from sqlalchemy import create_engine, event
+
+PROFILES = {
+    'stock': {
+        'pragmas': [],
+        'cached_statements': 100,
+        'busy_timeout': 5,
+    },
+    'wal': {
+        'pragmas': [
+            ('journal_mode', 'WAL'),
+            ('synchronous', 'NORMAL'),
+            ('mmap_size', 256 * 1024 * 1024),
+            # negative sizes are in KiB
+            ('cache_size', -64 * 1024),
+            ('temp_store', 'MEMORY'),
+            ('busy_timeout', 10000),
+        ],
+        'cached_statements': 500,
+        'busy_timeout': 10,
+    },
+    'durable': {
+        'pragmas': [
+            ('journal_mode', 'WAL'),
+            ('synchronous', 'FULL'),
+            ('mmap_size', 256 * 1024 * 1024),
+            ('cache_size', -64 * 1024),
+            ('temp_store', 'MEMORY'),
+            ('busy_timeout', 10000),
+        ],
+        'cached_statements': 500,
+        'busy_timeout': 10,
+    },
+}
+
+DEFAULT_PROFILE = 'wal'
+
+
+def get_profile(name=None):
+    """
+    Returns the profile with the given name, or the one named by the
+    SQLITE_PROFILE environment variable.
+    """
+    name = name or os.environ.get('SQLITE_PROFILE', DEFAULT_PROFILE)
+    try:
+        return PROFILES[name]
+    except KeyError:
+        raise ValueError("Unknown SQLite profile %r, expected one of %s" % (
+            name, ', '.join(sorted(PROFILES))))
+
+
+def apply_profile(engine, profile):
+    """Runs the profile's PRAGMAs on each new connection of engine."""
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in profile['pragmas']:
+            cursor.execute('PRAGMA %s = %s' % (pragma, value))
+        cursor.close()
+
+    return engine
+
+
+def create_sqlite_engine(url, profile_name=None, **kwargs):
+    """
+    Returns an engine for the SQLite database at url with the named
+    profile applied. Other keyword arguments are passed to create_engine.
+
+    >>> create_sqlite_engine('sqlite:///favoritegames.db')
+    Engine(sqlite:///favoritegames.db)
+    """
+    profile = get_profile(profile_name)
+    connect_args = kwargs.pop('connect_args', {})
+    connect_args.setdefault('cached_statements', profile['cached_statements'])
+    connect_args.setdefault('timeout', profile['busy_timeout'])
+    engine = create_engine(url, connect_args=connect_args, **kwargs)
+    return apply_profile(engine, profile)